@@ -1,18 +1,170 @@
-from django import get_version
+from datetime import datetime
+
+from django import forms, get_version
+from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
+from django.contrib.admin import helpers
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse
+from django.db.models import Q, Count
+from django.forms.models import BaseInlineFormSet
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.shortcuts import get_object_or_404, render_to_response
+from django.template import RequestContext
+from django.utils import simplejson
+from django.utils.html import escape
+from django.utils.encoding import force_unicode
+from django.utils.translation import ugettext_lazy as _, ungettext
 
+from flag import settings as flag_settings
+from flag import export
+from flag import moderation
 from flag.models import FlaggedContent, FlagInstance
+from flag.exceptions import FlagCommentException
+
+# format of the `when_added` part of the cursors of the flags inline
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class FlagInstanceInlineFormSet(BaseInlineFormSet):
+    """
+    Formset showing only one page of the flags of a flagged content, newest
+    first, starting after the flag given by `cursor` (keyset paging on
+    `when_added` and `id`, so the cost of a page doesn't depend on the
+    number of flags). Comments are not loaded.
+    When the formset is posted, the flags are the ones of the posted forms,
+    so flags added in the meantime don't shift the page.
+    """
+    cursor = None
+    per_page = 50
+
+    def get_cursor(self):
+        """
+        Return the `(when_added, id)` tuple of the cursor, or None if no
+        cursor or an invalid one
+        """
+        try:
+            when_added, id = self.cursor.split('-')
+            return datetime.strptime(when_added, CURSOR_DATE_FORMAT), int(id)
+        except (AttributeError, ValueError):
+            return None
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            queryset = self.queryset.select_related('user').defer('comment')\
+                    .order_by('-when_added', '-id')
+            self.next_cursor = None
+            if self.is_bound:
+                # a queryset is needed to save the forms
+                self._queryset = queryset.filter(id__in=self.get_posted_ids())
+                return self._queryset
+            cursor = self.get_cursor()
+            if cursor:
+                when_added, id = cursor
+                queryset = queryset.filter(Q(when_added__lt=when_added) |
+                                           Q(when_added=when_added, id__lt=id))
+            flags = list(queryset[:self.per_page + 1])
+            # the flagged content is used to display each flag
+            cache_name = self.fk.get_cache_name()
+            for flag in flags:
+                setattr(flag, cache_name, self.instance)
+            if len(flags) > self.per_page:
+                flags = flags[:self.per_page]
+                self.next_cursor = '%s-%d' % (
+                        flags[-1].when_added.strftime(CURSOR_DATE_FORMAT),
+                        flags[-1].id)
+            self._queryset = flags
+        return self._queryset
+
+    def get_posted_ids(self):
+        """
+        Return the ids of the flags of the posted forms
+        """
+        pk_name = self.model._meta.pk.name
+        ids = []
+        for i in range(0, self.initial_form_count()):
+            try:
+                ids.append(int(self.data['%s-%s' % (self.add_prefix(i),
+                                                    pk_name)]))
+            except (KeyError, ValueError):
+                pass
+        return ids
+
+    def get_status_summary(self):
+        """
+        Return a list of `(status display, number of flags)`, for all the
+        flags of the flagged content, computed in one query
+        """
+        statuses = dict(flag_settings.get_for_model(
+                self.instance.content_type_id, 'STATUSES'))
+        counts = FlagInstance.objects.filter(flagged_content=self.instance)\
+                .values_list('status').annotate(count=Count('id'))\
+                .order_by('status')
+        return [(force_unicode(statuses.get(status, status)), count)
+                for status, count in counts]
 
 
 class InlineFlagInstance(admin.TabularInline):
+    """
+    Inline of the flags of a flagged content, paginated (see
+    `FlagInstanceInlineFormSet`), with a link to load each comment. Only
+    the status can be changed (and the flags deleted), and no flags can be
+    added, as the comments are not loaded.
+    """
     model = FlagInstance
+    formset = FlagInstanceInlineFormSet
+    template = 'admin/flag/flaginstance/tabular.html'
+    fields = ('user', 'when_added', 'status', 'comment_link')
+    readonly_fields = ('user', 'when_added', 'comment_link')
     extra = 0
-    raw_id_fields = ('user', )
+    max_num = 0
+    per_page = 50
+    cursor_param = 'flags_after'
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super(InlineFlagInstance, self).get_formset(request, obj,
+                                                             **kwargs)
+        formset.per_page = self.per_page
+        formset.cursor = request.GET.get(self.cursor_param)
+        formset.cursor_param = self.cursor_param
+        return formset
+
+    def comment_link(self, obj):
+        """
+        Link to the comment of the flag, which is not loaded with the flags
+        """
+        return u'<a href="%s">%s</a>' % (
+                reverse('admin:flag_flaginstance_comment', args=(obj.id,)),
+                _('show'))
+    comment_link.allow_tags = True
+    comment_link.short_description = _('comment')
+
+
+class FlaggedContentChangeList(ChangeList):
+    """
+    Change list loading the flagged objects of the displayed page in one
+    query for each content type
+    """
+
+    def get_results(self, request):
+        super(FlaggedContentChangeList, self).get_results(request)
+        FlaggedContent.objects.load_content_objects(self.result_list)
+
+
+class SetStatusForm(forms.Form):
+    """
+    Form asking the comment of a status change of the selected flagged
+    contents
+    """
+    comment = forms.CharField(label=_('comment'), required=False,
+                              widget=forms.Textarea)
 
 
 class FlaggedContentAdmin(admin.ModelAdmin):
     inlines = [InlineFlagInstance]
-    list_display = ('id', '__unicode__', 'status', 'count')
+    list_display = ('id', '__unicode__', 'flagged_object', 'creator',
+                    'status', 'count', 'moderator', 'when_updated')
     list_display_links = ('id', '__unicode__')
     list_filter = ('status',)
     readonly_fields = ('content_type', 'object_id')
@@ -31,5 +183,192 @@ class FlaggedContentAdmin(admin.ModelAdmin):
                   'count',
                   'moderator')
 
+    def queryset(self, request):
+        """
+        Load the creators and moderators with the flagged contents (the
+        flagged objects are loaded by FlaggedContentChangeList)
+        """
+        return super(FlaggedContentAdmin, self).queryset(request)\
+                .select_related('creator', 'moderator')
+
+    def get_changelist(self, request, **kwargs):
+        return FlaggedContentChangeList
+
+    def get_actions(self, request):
+        """
+        Add an action to set each status (but the first one) on the selected
+        flagged contents
+        """
+        actions = super(FlaggedContentAdmin, self).get_actions(request)
+        for status, label in flag_settings.STATUSES[1:]:
+            name = 'set_status_%s' % status
+            actions[name] = (self._make_set_status_action(status), name,
+                             _('Set the status to "%s"') %
+                                 force_unicode(label))
+        return actions
+
+    def _make_set_status_action(self, status):
+        """
+        Return an action setting the given status
+        """
+        def action(modeladmin, request, queryset):
+            return modeladmin.set_status(request, queryset, status)
+        return action
+
+    def set_status(self, request, queryset, status):
+        """
+        Ask a comment then set the given status on the selected flagged
+        contents, in bulk (see `FlaggedContent.objects.set_status`)
+        """
+        if request.POST.get('post'):
+            form = SetStatusForm(request.POST)
+            if form.is_valid():
+                try:
+                    count = FlaggedContent.objects.set_status(queryset,
+                            status, request.user,
+                            form.cleaned_data['comment'])
+                except FlagCommentException, e:
+                    form._errors['comment'] = form.error_class([e])
+                except ValueError, e:
+                    # status not allowed for the model of a flagged content
+                    self.message_user(request, _(
+                            'No flagged content updated: %s') % e)
+                    return None
+                else:
+                    self.message_user(request, ungettext(
+                            '%d flagged content updated',
+                            '%d flagged contents updated',
+                            count) % count)
+                    return None
+        else:
+            form = SetStatusForm()
+
+        return render_to_response('admin/flag/flaggedcontent/set_status.html',
+            {
+                'form': form,
+                'status_display': dict(flag_settings.STATUSES)[status],
+                'action': 'set_status_%s' % status,
+                'queryset': queryset,
+                'select_across': request.POST.get('select_across'),
+                'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+                'opts': self.model._meta,
+                'app_label': self.model._meta.app_label,
+            }, context_instance=RequestContext(request))
+
+    def get_urls(self):
+        return patterns('',
+            url(r'^flag/(\d+)/comment/$',
+                self.admin_site.admin_view(self.flag_comment_view),
+                name='flag_flaginstance_comment'),
+            url(r'^export/$',
+                self.admin_site.admin_view(self.export_view),
+                name='flag_flaginstance_export'),
+            url(r'^queue/$',
+                self.admin_site.admin_view(self.moderation_queue_view),
+                name='flag_flaggedcontent_queue'),
+            url(r'^queue/json/$',
+                self.admin_site.admin_view(self.moderation_queue_view),
+                {'format': 'json'},
+                name='flag_flaggedcontent_queue_json'),
+        ) + super(FlaggedContentAdmin, self).get_urls()
+
+    def export_view(self, request):
+        """
+        Stream the export of all the flags (see `flag.export`), in the format
+        given by the `format` parameter (csv or jsonl), filtered by the
+        `content_type`, `status`, `since` and `until` parameters
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        format = request.GET.get('format', 'csv')
+        if format not in export.FORMATS:
+            return HttpResponseBadRequest('Invalid format')
+        try:
+            filters = export.parse_filters(
+                    content_type=request.GET.get('content_type'),
+                    status=request.GET.get('status'),
+                    since=request.GET.get('since'),
+                    until=request.GET.get('until'))
+        except ValueError, e:
+            return HttpResponseBadRequest('Invalid filter: %s' % e)
+
+        iter_lines, mimetype = export.FORMATS[format]
+        response = HttpResponse(iter_lines(export.iter_flags(**filters)),
+                                mimetype=mimetype)
+        response['Content-Disposition'] = 'attachment; filename=flags.%s' % (
+                format)
+        return response
+
+    def moderation_queue_view(self, request, format='html'):
+        """
+        Display (or return as json) one page of the moderation queue (see
+        `flag.moderation`), filtered by the `status`, `content_type` and
+        `creator` parameters, ordered by the `order` one (`oldest` or
+        `newest`), and starting after the `after` cursor
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            filters = moderation.parse_filters(
+                    status=request.GET.get('status'),
+                    content_type=request.GET.get('content_type'),
+                    creator=request.GET.get('creator'),
+                    order=request.GET.get('order'))
+            flagged_contents, next_cursor = moderation.get_page(
+                    cursor=request.GET.get('after'),
+                    per_page=self.list_per_page, **filters)
+        except ValueError, e:
+            return HttpResponseBadRequest('Invalid parameter: %s' % e)
+
+        next_url = None
+        if next_cursor:
+            params = request.GET.copy()
+            params['after'] = next_cursor
+            next_url = '?%s' % params.urlencode()
+
+        if format == 'json':
+            return HttpResponse(simplejson.dumps({
+                    'results': moderation.get_page_data(flagged_contents),
+                    'next': next_cursor,
+                }), mimetype='application/json')
+
+        return render_to_response(
+            'admin/flag/flaggedcontent/moderation_queue.html',
+            {
+                'flagged_contents': flagged_contents,
+                'next_url': next_url,
+                'statuses': flag_settings.STATUSES,
+                'orders': sorted(moderation.ORDERS),
+                'params': request.GET,
+                'opts': self.model._meta,
+                'app_label': self.model._meta.app_label,
+            }, context_instance=RequestContext(request))
+
+    def flag_comment_view(self, request, flag_instance_id):
+        """
+        Return the comment of a flag, as plain text (loaded on demand from
+        the flags inline)
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        flag_instance = get_object_or_404(FlagInstance, id=flag_instance_id)
+        return HttpResponse(flag_instance.comment or u'',
+                            mimetype='text/plain; charset=utf-8')
+
+    def flagged_object(self, obj):
+        """
+        Show the flagged object, with a link to its admin page if any
+        """
+        content_object = obj.content_object
+        if content_object is None:
+            return u'-'
+        url = obj.get_content_object_admin_url()
+        if not url:
+            return escape(force_unicode(content_object))
+        return u'<a href="%s">%s</a>' % (escape(url),
+                                         escape(force_unicode(content_object)))
+    flagged_object.allow_tags = True
+    flagged_object.short_description = _('flagged object')
+
 
 admin.site.register(FlaggedContent, FlaggedContentAdmin)
@@ -0,0 +1,160 @@
+"""
+Optional cache of the state (status and count) of flagged objects, shared
+between all processes/nodes via the django cache framework.
+It's activated by setting FLAG_CACHE to the name of a cache defined in the
+CACHES settings.
+
+For each object a compact `(status, count)` tuple is stored (or an empty
+tuple if the object was never flagged), with a key based on the content
+type id and the object id.
+The keys also include a generation number, stored in the cache too:
+incrementing it (see `bump_generation`) invalidates all the entries for all
+the nodes at once.
+When an entry is missing, only one process loads it from the database, the
+other ones wait a little for it to be set (to avoid a stampede on objects
+viewed by many users at the same time)
+"""
+import time
+
+from django.core.cache import get_cache
+
+from flag import settings as flag_settings
+from flag import memo
+
+# stored for objects never flagged
+NOT_FLAGGED = ()
+
+KEY_PREFIX = 'flag'
+GENERATION_KEY = '%s:generation' % KEY_PREFIX
+GENERATION_TIMEOUT = 60 * 60 * 24 * 30
+
+# single-flight: the lock is kept at most LOCK_TIMEOUT seconds, and other
+# processes check LOCK_RETRIES times, every LOCK_WAIT seconds, if the entry
+# was set, before loading it themselves
+LOCK_TIMEOUT = 10
+LOCK_RETRIES = 5
+LOCK_WAIT = 0.02
+
+_backends = {}
+
+
+def get_backend():
+    """
+    Return the cache backend defined by the FLAG_CACHE settings, or None if
+    no cache is used
+    """
+    name = flag_settings.CACHE
+    if not name:
+        return None
+    if name not in _backends:
+        _backends[name] = get_cache(name)
+    return _backends[name]
+
+
+def get_generation(backend):
+    """
+    Return the current generation number, fetched only once per request
+    """
+    generation = memo.get(('cache_generation',))
+    if generation is memo.MISSING:
+        generation = backend.get(GENERATION_KEY)
+        if generation is None:
+            # use the time to never reuse a previous (evicted) generation
+            backend.add(GENERATION_KEY, int(time.time()), GENERATION_TIMEOUT)
+            generation = backend.get(GENERATION_KEY)
+        memo.set(('cache_generation',), generation)
+    return generation
+
+
+def bump_generation():
+    """
+    Invalidate all the cached entries, for all the processes
+    """
+    backend = get_backend()
+    if backend is None:
+        return
+    try:
+        backend.incr(GENERATION_KEY)
+    except ValueError:
+        # no generation yet
+        backend.add(GENERATION_KEY, int(time.time()), GENERATION_TIMEOUT)
+    memo.forget(('cache_generation',))
+
+
+def make_key(backend, *parts):
+    """
+    Return a key, for the current generation, made with the given parts
+    """
+    return ':'.join([KEY_PREFIX, str(get_generation(backend))] +
+                    [str(part) for part in parts])
+
+
+def _get_key(backend, content_type_id, object_id):
+    """
+    Return the key for the given object, for the current generation
+    """
+    return make_key(backend, content_type_id, object_id)
+
+
+def get_state(content_type_id, object_id, load):
+    """
+    Return the `(status, count)` tuple for the given object, or None if it
+    was never flagged.
+    If not in the cache, `load` is called (only by one process at a time) to
+    get it from the database. It must return the same kind of value.
+    """
+    backend = get_backend()
+    if backend is None:
+        return load()
+
+    key = _get_key(backend, content_type_id, object_id)
+    state = backend.get(key)
+
+    if state is None:
+        lock_key = '%s:lock' % key
+        if backend.add(lock_key, 1, LOCK_TIMEOUT):
+            try:
+                state = load() or NOT_FLAGGED
+                # `add` and not `set` to not replace a fresher value set
+                # while we were loading it
+                backend.add(key, state, flag_settings.CACHE_TIMEOUT)
+            finally:
+                backend.delete(lock_key)
+        else:
+            for i in range(LOCK_RETRIES):
+                time.sleep(LOCK_WAIT)
+                state = backend.get(key)
+                if state is not None:
+                    break
+            else:
+                state = load() or NOT_FLAGGED
+
+    return tuple(state) or None
+
+
+def set_state(content_type_id, object_id, state):
+    """
+    Save in the cache the `(status, count)` tuple (or None if never flagged)
+    for the given object
+    """
+    backend = get_backend()
+    if backend is None:
+        return
+    backend.set(_get_key(backend, content_type_id, object_id),
+                state and tuple(state) or NOT_FLAGGED,
+                flag_settings.CACHE_TIMEOUT)
+
+
+def set_states(states):
+    """
+    Save in the cache many `(status, count)` tuples at once. `states` is a
+    dict with `(content_type_id, object_id)` tuples as keys
+    """
+    backend = get_backend()
+    if backend is None:
+        return
+    backend.set_many(dict(
+            (_get_key(backend, content_type_id, object_id),
+                state and tuple(state) or NOT_FLAGGED)
+            for (content_type_id, object_id), state in states.items()),
+        flag_settings.CACHE_TIMEOUT)
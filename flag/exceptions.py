@@ -2,14 +2,18 @@ __all__ = ('FlagException',
            'ModelCannotBeFlaggedException',
            'ContentAlreadyFlaggedByUserException',
            'ContentFlaggedEnoughException',
-           'FlagCommentException')
+           'FlagCommentException',
+           'FlagRateLimitExceeded',
+           'FlagInProgressException')
 
 
 class FlagException(Exception):
     """
     Base class for django-flag exceptions
+    `code` identifies the error in the json responses (see
+    `views.flag_json`)
     """
-    pass
+    code = 'flag_error'
 
 
 class ModelCannotBeFlaggedException(FlagException):
@@ -17,7 +21,7 @@ class ModelCannotBeFlaggedException(FlagException):
     Exception raised when a user try to flag a object that is not defined
     in the FLAG_MODELS settings (only if this settings if defined)
     """
-    pass
+    code = 'model_cannot_be_flagged'
 
 
 class ContentAlreadyFlaggedByUserException(FlagException):
@@ -26,7 +30,7 @@ class ContentAlreadyFlaggedByUserException(FlagException):
     already flagged and the number of its flags raised the
     LIMIT_SAME_OBJECT_FOR_USER value
     """
-    pass
+    code = 'already_flagged_by_user'
 
 
 class ContentFlaggedEnoughException(FlagException):
@@ -34,7 +38,7 @@ class ContentFlaggedEnoughException(FlagException):
     Exception raised when someone try to flag an object which is
     already flagged and the LIMIT_FOR_OBJECT is raised
     """
-    pass
+    code = 'flagged_enough'
 
 
 class FlagCommentException(FlagException):
@@ -42,7 +46,7 @@ class FlagCommentException(FlagException):
     Exception raised when someone try to add a comment while flagging an
     object but with the ALLOW_COMMENTS settings to False (or the opposite)
     """
-    pass
+    code = 'invalid_comment'
 
 
 class OnlyStaffCanUpdateStatus(FlagException):
@@ -50,4 +54,25 @@ class OnlyStaffCanUpdateStatus(FlagException):
     Exception raised when someone not in staff try to update the status
     of a flagged content
     """
-    pass
+    code = 'only_staff_can_update_status'
+
+
+class FlagRateLimitExceeded(FlagException):
+    """
+    Exception raised when a user flags faster than the FLAG_RATE_LIMIT
+    settings allows. `retry_after` is the number of seconds before the next
+    flag is allowed
+    """
+    code = 'rate_limit_exceeded'
+
+    def __init__(self, message, retry_after=0):
+        super(FlagRateLimitExceeded, self).__init__(message)
+        self.retry_after = retry_after
+
+
+class FlagInProgressException(FlagException):
+    """
+    Exception raised when a flag is added with the same idempotency key as a
+    flag still being added
+    """
+    code = 'in_progress'
@@ -0,0 +1,135 @@
+"""
+Export of the flags (with their flagged content), as CSV or JSON Lines,
+with a constant memory usage: the FlagInstance table is read by chunks, in
+the order of the primary key (each chunk starting after the last id of the
+previous one), only as values (no model instances), and the lines are
+generated one by one, to be written to a file or streamed in a response.
+Used by the `flag_export` management command and by the admin.
+"""
+import csv
+import itertools
+from datetime import datetime
+from StringIO import StringIO
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import simplejson
+
+from flag.models import FlagInstance
+from flag.utils import (get_content_type_tuple, get_content_type_id,
+        parse_date)
+
+# exported columns
+FIELDS = ('id', 'when_added', 'user_id', 'status', 'comment',
+          'flagged_content_id', 'content_type', 'object_id',
+          'flagged_content_status', 'flagged_content_count')
+
+# columns loaded from the database (the content type id is replaced by an
+# `app_label.model` string)
+_VALUES = ('id', 'when_added', 'user', 'status', 'comment',
+           'flagged_content', 'flagged_content__content_type',
+           'flagged_content__object_id', 'flagged_content__status',
+           'flagged_content__count')
+
+
+def parse_filters(content_type=None, status=None, since=None, until=None):
+    """
+    Return a dict with the filters to pass to `iter_flags`, from the given
+    strings (empty ones are ignored), or raise a ValueError if one is invalid
+    """
+    filters = {}
+    if content_type:
+        try:
+            filters['content_type'] = get_content_type_id(content_type)
+        except ContentType.DoesNotExist:
+            raise ValueError('Unknown content type %r' % content_type)
+    if status:
+        filters['status'] = int(status)
+    if since:
+        filters['since'] = parse_date(since)
+    if until:
+        filters['until'] = parse_date(until)
+    return filters
+
+
+def iter_flags(content_type=None, status=None, since=None, until=None,
+               chunk_size=1000):
+    """
+    Return an iterator on a tuple of values (see FIELDS) for each flag,
+    ordered by id, read by chunks of `chunk_size` flags.
+    The flags can be filtered by the content type of the flagged object (see
+    `utils.get_content_type_tuple` for the accepted values, a ValueError or
+    a ContentType.DoesNotExist is raised for invalid ones), by status, and
+    by date (`since` included, `until` excluded)
+    """
+    queryset = FlagInstance.objects.order_by('id')
+    if content_type is not None:
+        queryset = queryset.filter(
+                flagged_content__content_type=get_content_type_id(
+                    content_type))
+    if status is not None:
+        queryset = queryset.filter(status=status)
+    if since is not None:
+        queryset = queryset.filter(when_added__gte=since)
+    if until is not None:
+        queryset = queryset.filter(when_added__lt=until)
+    return _iter_chunks(queryset.values_list(*_VALUES), chunk_size)
+
+
+def _iter_chunks(queryset, chunk_size):
+    """
+    Yield the rows of the given values queryset, by chunks (see
+    `iter_flags`)
+    """
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id)[:chunk_size])
+        if not rows:
+            break
+        for row in rows:
+            yield row[:6] + ('%s.%s' % get_content_type_tuple(row[6]),) + \
+                    row[7:]
+        last_id = rows[-1][0]
+
+
+def _format_value(value):
+    """
+    Return the given value as a string (dates in the ISO format)
+    """
+    if value is None:
+        return u''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return unicode(value)
+
+
+def iter_csv(rows):
+    """
+    Yield the lines of a CSV file (utf-8 encoded, with a header line) for
+    the given rows
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for row in itertools.chain([FIELDS], rows):
+        writer.writerow([_format_value(value).encode('utf-8')
+                         for value in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def iter_jsonl(rows):
+    """
+    Yield the lines of a JSON Lines file (one JSON object by row) for the
+    given rows
+    """
+    for row in rows:
+        yield '%s\n' % simplejson.dumps(dict(zip(FIELDS, [
+                isinstance(value, datetime) and value.isoformat() or value
+                    for value in row])))
+
+
+# line generators, and content type, by format
+FORMATS = {
+    'csv': (iter_csv, 'text/csv; charset=utf-8'),
+    'jsonl': (iter_jsonl, 'application/x-ndjson'),
+}
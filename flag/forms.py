@@ -58,6 +58,18 @@ class SecurityForm(forms.Form):
                 raise forms.ValidationError("Security hash check failed.")
         return actual_hash
 
+    def get_idempotency_key(self):
+        """
+        Return a key identifying this rendering of the form (its timestamp
+        and security hash) and the posted values (status and comment), the
+        same for all the resends of the form (to be used when the form is
+        valid), but not if another status or comment is sent with it
+        """
+        return u'%s:%s:%s:%s' % (self.cleaned_data['timestamp'],
+                                 self.cleaned_data['security_hash'],
+                                 self.cleaned_data.get('status') or '',
+                                 self.cleaned_data.get('comment') or '')
+
     def clean_timestamp(self):
         """Make sure the timestamp isn't too far (> 2 hours) in the past."""
         ts = self.cleaned_data["timestamp"]
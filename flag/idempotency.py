@@ -0,0 +1,102 @@
+"""
+Idempotency keys for the flags: a flag added with a key (given by the
+client, or taken from the flag form, see `SecurityForm.get_idempotency_key`)
+is added only once, the same flag being returned for each resend of the same
+key by the same user, for the same object, comment and status (retries of
+mobile clients, double-clicks...), while the key is kept in the cache
+defined by FLAG_IDEMPOTENCY_CACHE (see the FLAG_IDEMPOTENCY_TIMEOUT
+settings).
+The first request claims the key with an atomic `add`, so concurrent resends
+never add the flag twice: they wait a little for the result of the first
+one.
+"""
+import time
+
+from django.core.cache import get_cache
+from django.utils.hashcompat import md5_constructor
+from django.utils.translation import ugettext as _
+
+from flag import settings as flag_settings
+from flag.exceptions import FlagInProgressException
+from flag.utils import get_content_type_id
+
+KEY_PREFIX = 'flag:idempotency'
+
+# stored while the flag is being added
+PENDING = 'pending'
+
+# the resends of a key being added check WAIT_RETRIES times, every WAIT
+# seconds, if its flag was added
+WAIT_RETRIES = 10
+WAIT = 0.05
+
+_backends = {}
+
+
+def get_backend():
+    """
+    Return the cache backend defined by the FLAG_IDEMPOTENCY_CACHE settings
+    """
+    name = flag_settings.IDEMPOTENCY_CACHE
+    if name not in _backends:
+        _backends[name] = get_cache(name)
+    return _backends[name]
+
+
+def _get_key(user, idempotency_key):
+    """
+    Return the cache key for the given idempotency key of the given user
+    """
+    return '%s:%s:%s' % (KEY_PREFIX, user.id, md5_constructor(
+            unicode(idempotency_key).encode('utf-8')).hexdigest())
+
+
+def get_flag_key(idempotency_key, content_object, comment=None,
+                 status=None):
+    """
+    Return the key to pass to `call_once` to add a flag of the given object,
+    with the given comment and status: the same key sent by the client for
+    another object (or with another comment or status) is another flag
+    """
+    return u'%s:%s:%s:%s:%s' % (get_content_type_id(content_object),
+                                content_object.pk, status or '',
+                                comment or '', idempotency_key)
+
+
+def call_once(user, idempotency_key, function, *args, **kwargs):
+    """
+    Call the given function (adding a flag) and return its result, or, if it
+    was already called with the same key by the same user, return the result
+    of the first call, kept in the cache.
+    The result returned again has a `replayed` attribute set to True.
+    If the first call is not finished after a few tries, raise a
+    FlagInProgressException. If it raises an exception, the key is released,
+    so the next call is done.
+    """
+    timeout = flag_settings.IDEMPOTENCY_TIMEOUT
+    if not idempotency_key or not timeout:
+        return function(*args, **kwargs)
+
+    backend = get_backend()
+    key = _get_key(user, idempotency_key)
+    if backend.add(key, PENDING, timeout):
+        try:
+            result = function(*args, **kwargs)
+        except:
+            backend.delete(key)
+            raise
+        backend.set(key, result, timeout)
+        return result
+
+    for i in range(WAIT_RETRIES):
+        result = backend.get(key)
+        if result != PENDING:
+            break
+        time.sleep(WAIT)
+    else:
+        raise FlagInProgressException(_('This flag is already being added'))
+    if result is None:
+        # released (or expired) in the meantime
+        return call_once(user, idempotency_key, function, *args, **kwargs)
+    result.replayed = True
+    return result
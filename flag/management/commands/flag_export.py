@@ -0,0 +1,89 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from flag import export
+
+
+class Command(NoArgsCommand):
+    help = "Export the flags, with their flagged content, as CSV or JSON " \
+           "Lines, to stdout or to a file. The flags are read by chunks, " \
+           "so the memory usage doesn't depend on their number."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--format',
+            action='store',
+            type='choice',
+            choices=export.FORMATS.keys(),
+            dest='format',
+            default='csv',
+            help='Format of the export: csv (default) or jsonl'),
+        make_option('--output',
+            action='store',
+            dest='output',
+            default=None,
+            help='File to write the export to (default to stdout)'),
+        make_option('--content-type',
+            action='store',
+            dest='content_type',
+            default=None,
+            help='Only export the flags of objects of this model '
+                 '("app_label.model")'),
+        make_option('--status',
+            action='store',
+            dest='status',
+            default=None,
+            help='Only export the flags with this status'),
+        make_option('--since',
+            action='store',
+            dest='since',
+            default=None,
+            help='Only export the flags added since this date '
+                 '("YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS")'),
+        make_option('--until',
+            action='store',
+            dest='until',
+            default=None,
+            help='Only export the flags added before this date '
+                 '("YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS")'),
+        make_option('--chunk-size',
+            action='store',
+            type='int',
+            dest='chunk_size',
+            default=1000,
+            help='Number of flags loaded per query'),
+    )
+
+    def handle_noargs(self, **options):
+        try:
+            filters = export.parse_filters(
+                    content_type=options['content_type'],
+                    status=options['status'],
+                    since=options['since'],
+                    until=options['until'])
+        except ValueError, e:
+            raise CommandError('Invalid filter: %s' % e)
+
+        total = [0]
+
+        def count(rows):
+            for row in rows:
+                total[0] += 1
+                yield row
+
+        lines = export.FORMATS[options['format']][0](
+                count(export.iter_flags(chunk_size=options['chunk_size'],
+                                       **filters)))
+        if options['output']:
+            output = open(options['output'], 'wb')
+        else:
+            output = self.stdout
+        try:
+            for line in lines:
+                output.write(line)
+        finally:
+            if options['output']:
+                output.close()
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stderr.write('%d flags exported\n' % total[0])
@@ -0,0 +1,69 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from flag.models import FlagMail
+
+
+class Command(NoArgsCommand):
+    help = "Send the flag alert mails and digests saved in the outbox (when " \
+           "the FLAG_SEND_MAILS_QUEUED or FLAG_SEND_MAILS_DIGEST settings " \
+           "are set), by batches, trying again later the ones that failed"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=100,
+            help='Number of mails sent using the same connection'),
+        make_option('--max-tries',
+            action='store',
+            type='int',
+            dest='max_tries',
+            default=5,
+            help='Number of tries before marking a mail as failed'),
+        make_option('--backoff',
+            action='store',
+            type='int',
+            dest='backoff',
+            default=60,
+            help='Seconds to wait before trying again a mail after its '
+                 'first error, doubled after each try'),
+        make_option('--loop',
+            action='store_true',
+            dest='loop',
+            default=False,
+            help='Do not stop when the outbox is empty, but wait for new '
+                 'mails'),
+        make_option('--interval',
+            action='store',
+            type='float',
+            dest='interval',
+            default=5,
+            help='With --loop, seconds to wait when the outbox is empty'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        total_sent, total_failed = 0, 0
+        while True:
+            sent, failed = FlagMail.objects.send_pending(
+                    batch_size=options['batch_size'],
+                    max_tries=options['max_tries'],
+                    backoff=options['backoff'])
+            total_sent += sent
+            total_failed += failed
+            if verbosity > 1 and (sent or failed):
+                self.stdout.write('%d mails sent, %d failed\n' % (sent,
+                                                                  failed))
+            if sent or failed:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        if verbosity > 0:
+            self.stdout.write('%d mails sent, %d failed\n' % (total_sent,
+                                                              total_failed))
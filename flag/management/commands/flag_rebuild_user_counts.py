@@ -0,0 +1,27 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from flag.models import UserFlagCount
+
+
+class Command(NoArgsCommand):
+    help = "Compute again, from the existing flags, the number of flags " \
+           "by each user on each flagged object (used to check the " \
+           "FLAG_LIMIT_SAME_OBJECT_FOR_USER settings)"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size',
+            action='store',
+            type='int',
+            dest='chunk_size',
+            default=1000,
+            help='Number of counts inserted per query'),
+    )
+
+    @transaction.commit_on_success
+    def handle_noargs(self, **options):
+        created = UserFlagCount.objects.rebuild(options['chunk_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%d counts created\n' % created)
@@ -0,0 +1,101 @@
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Min, Max
+
+from flag.models import FlaggedContent
+from flag.utils import parse_date
+
+
+@transaction.commit_on_success
+def reconcile_range(args):
+    """
+    Reconcile the counts of a range of flagged contents (run in a worker)
+    """
+    start_id, end_id, fix, since = args
+    return FlaggedContent.objects.reconcile_counts(start_id, end_id, fix=fix,
+                                                   since=since)
+
+
+class Command(NoArgsCommand):
+    help = "Compute again the count of the flagged contents from their " \
+           "flags (with a status of 1), by ranges of ids, in parallel, and " \
+           "report (and optionally fix) the wrong ones"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers',
+            action='store',
+            type='int',
+            dest='workers',
+            default=1,
+            help='Number of worker processes (default to 1, the current '
+                 'process)'),
+        make_option('--chunk-size',
+            action='store',
+            type='int',
+            dest='chunk_size',
+            default=1000,
+            help='Number of ids of flagged contents in each range'),
+        make_option('--fix',
+            action='store_true',
+            dest='fix',
+            default=False,
+            help='Fix the wrong counts'),
+        make_option('--since',
+            action='store',
+            dest='since',
+            default=None,
+            help='Only check the flagged contents updated or flagged since '
+                 'this date ("YYYY-MM-DD" or "YYYY-MM-DD HH:MM:SS")'),
+    )
+
+    def handle_noargs(self, **options):
+        since = options['since']
+        if since:
+            try:
+                since = parse_date(since)
+            except ValueError, e:
+                raise CommandError(e)
+
+        bounds = FlaggedContent.objects.aggregate(min=Min('id'),
+                                                  max=Max('id'))
+        chunk_size = options['chunk_size']
+        ranges = []
+        if bounds['min'] is not None:
+            ranges = [(start, start + chunk_size, options['fix'], since)
+                      for start in range(bounds['min'], bounds['max'] + 1,
+                                         chunk_size)]
+
+        if options['workers'] > 1:
+            # each worker must open its own connection
+            connection.close()
+            pool = Pool(options['workers'])
+            try:
+                results = pool.imap_unordered(reconcile_range, ranges)
+                self.report(results, options)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self.report(map(reconcile_range, ranges), options)
+
+    def report(self, results, options):
+        """
+        Write the mismatches (with a verbosity > 1) and the totals
+        """
+        verbosity = int(options.get('verbosity', 1))
+        total_checked, total_mismatches, total_fixed = 0, 0, 0
+        for checked, mismatches, fixed in results:
+            total_checked += checked
+            total_mismatches += len(mismatches)
+            total_fixed += fixed
+            if verbosity > 1:
+                for id, count, actual in mismatches:
+                    self.stdout.write('flagged content #%d: count %d, %d '
+                                      'flags\n' % (id, count, actual))
+        if verbosity > 0:
+            self.stdout.write('%d flagged contents checked, %d wrong counts, '
+                              '%d fixed\n' % (total_checked, total_mismatches,
+                                              total_fixed))
@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from flag.models import FlagInstance
+
+
+class Command(NoArgsCommand):
+    help = "Move out of the flags table the flags older than the " \
+           "FLAG_RETENTION_DAYS settings (of their model) on resolved " \
+           "flagged contents, to the archive or the aggregates table, " \
+           "depending on the FLAG_RETENTION_MODE settings"
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size',
+            action='store',
+            type='int',
+            dest='batch_size',
+            default=1000,
+            help='Number of flags moved in each transaction'),
+    )
+
+    def handle_noargs(self, **options):
+        moved = FlagInstance.objects.apply_retention(
+                batch_size=options['batch_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%d flags archived, %d flags aggregated\n' % (
+                    moved['archive'], moved['aggregate']))
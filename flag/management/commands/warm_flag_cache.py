@@ -0,0 +1,54 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from flag import settings as flag_settings
+from flag import cache as flag_cache
+from flag.models import FlaggedContent
+
+
+class Command(NoArgsCommand):
+    help = "Load in the cache defined by FLAG_CACHE the status and count " \
+           "of the flagged objects (by default only the ones with the " \
+           "first status of FLAG_STATUSES). To run after a deploy."
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Load all flagged objects, whatever their status'),
+        make_option('--chunk-size',
+            action='store',
+            type='int',
+            dest='chunk_size',
+            default=1000,
+            help='Number of flagged objects loaded per query'),
+    )
+
+    def handle_noargs(self, **options):
+        if not flag_cache.get_backend():
+            raise CommandError('No cache defined in the FLAG_CACHE settings')
+
+        queryset = FlaggedContent.objects.order_by('id')
+        if not options['all']:
+            queryset = queryset.filter(status=flag_settings.STATUSES[0][0])
+
+        chunk_size = options['chunk_size']
+        last_id, total = 0, 0
+        while True:
+            rows = list(queryset.filter(id__gt=last_id).values_list(
+                    'id', 'content_type', 'object_id', 'status', 'count')[
+                        :chunk_size])
+            if not rows:
+                break
+            flag_cache.set_states(dict(
+                    ((content_type_id, object_id), (status, count))
+                        for id, content_type_id, object_id, status, count
+                            in rows))
+            last_id = rows[-1][0]
+            total += len(rows)
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%d flagged objects loaded in the cache\n' %
+                              total)
@@ -0,0 +1,136 @@
+"""
+Request-scoped memo of the FlaggedContent lookups (and of the number of
+flags by user), used by the FlaggedContentManager and so by the template
+filters.
+The memo is created when a request starts and dropped when it ends, so
+nothing is kept between two requests, and nothing is memoized outside of
+requests (in a shell, a management command...)
+Negative results (objects never flagged) are memoized too, with `None` as
+value.
+"""
+import threading
+
+from django.core.signals import request_started, request_finished
+
+# returned by getters when nothing is memoized for the given key
+MISSING = object()
+
+_state = threading.local()
+
+
+def activate(**kwargs):
+    """
+    Start a new empty memo for the current thread (called when a request
+    starts)
+    """
+    _state.memo = {}
+
+
+def deactivate(**kwargs):
+    """
+    Drop the memo of the current thread (called when a request ends)
+    """
+    _state.memo = None
+
+
+request_started.connect(activate, dispatch_uid='flag.memo.activate')
+request_finished.connect(deactivate, dispatch_uid='flag.memo.deactivate')
+
+
+def is_active():
+    """
+    Return True if a memo is active for the current thread
+    """
+    return getattr(_state, 'memo', None) is not None
+
+
+def get(key):
+    """
+    Return the memoized value for the given key, or MISSING
+    """
+    if not is_active():
+        return MISSING
+    return _state.memo.get(key, MISSING)
+
+
+def set(key, value):
+    """
+    Memoize the value for the given key
+    """
+    if is_active():
+        _state.memo[key] = value
+
+
+def forget(key):
+    """
+    Remove the memoized value for the given key
+    """
+    if is_active():
+        _state.memo.pop(key, None)
+
+
+def get_flagged_content(content_type_id, object_id):
+    """
+    Return the memoized FlaggedContent for the given object, None if we
+    know this object was never flagged, or MISSING if we don't know
+    """
+    return get(('flagged_content', content_type_id, object_id))
+
+
+def set_flagged_content(content_type_id, object_id, flagged_content):
+    """
+    Memoize the FlaggedContent (or None if never flagged) for the given
+    object
+    """
+    set(('flagged_content', content_type_id, object_id), flagged_content)
+    forget(('state', content_type_id, object_id))
+
+
+def forget_flagged_content(content_type_id, object_id):
+    """
+    Remove the memoized FlaggedContent for the given object
+    """
+    forget(('flagged_content', content_type_id, object_id))
+    forget(('state', content_type_id, object_id))
+
+
+def get_state(content_type_id, object_id):
+    """
+    Return the memoized `(status, count)` tuple for the given object, None
+    if we know this object was never flagged, or MISSING if we don't know
+    """
+    return get(('state', content_type_id, object_id))
+
+
+def set_state(content_type_id, object_id, state):
+    """
+    Memoize the `(status, count)` tuple (or None if never flagged) for the
+    given object
+    """
+    set(('state', content_type_id, object_id), state)
+
+
+def get_flags_by_user(flagged_content_id, user_id):
+    """
+    Return the memoized number of flags by the given user on the given
+    flagged content, or MISSING if we don't know
+    """
+    return get(('flags_by_user', flagged_content_id, user_id))
+
+
+def set_flags_by_user(flagged_content_id, user_id, count):
+    """
+    Memoize the number of flags by the given user on the given flagged
+    content
+    """
+    set(('flags_by_user', flagged_content_id, user_id), count)
+
+
+def increment_flags_by_user(flagged_content_id, user_id):
+    """
+    Increment the memoized number of flags by the given user on the given
+    flagged content, if known
+    """
+    count = get_flags_by_user(flagged_content_id, user_id)
+    if count is not MISSING:
+        set_flags_by_user(flagged_content_id, user_id, count + 1)
@@ -1,18 +1,90 @@
-from django.db import models
+import itertools
+import math
+import operator
+import time
+from datetime import datetime, timedelta
+
+from django.db import models, connections, transaction, IntegrityError
+from django.db.backends.signals import connection_created
+from django.db.models import Count, Sum
 from django.core import urlresolvers
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.utils.translation import ugettext_lazy as _, ungettext
-from django.core.mail import send_mail
+from django.core.mail import send_mail, get_connection
 from django.template.loader import render_to_string
 from django.contrib.sites.models import Site
 from django.utils.encoding import force_unicode
 
 from flag import settings as flag_settings
 from flag import signals
+from flag import memo
+from flag import cache as flag_cache
+from flag import idempotency
 from flag.exceptions import *
-from flag.utils import get_content_type_tuple
+from flag.utils import (get_content_type_tuple, get_content_type_id,
+        get_admin_url, bulk_create, must_send_mail)
+
+
+# name of the attribute used to store the prefetched FlaggedContent (or None)
+# on a flagged object
+PREFETCH_CACHE_ATTR = '_flagged_content_cache'
+
+# origin of the time in the priorities of the flagged contents (see
+# `FlaggedContent.get_priority`)
+PRIORITY_EPOCH = datetime(2000, 1, 1)
+
+# above this difference between the logs of the priority and of a new term,
+# the smallest one is ignored (its exponential would underflow)
+PRIORITY_MAX_DIFFERENCE = 700
+
+
+def _sqlite_exp(x):
+    """
+    EXP function of the sqlite connections, raising an error, like
+    postgresql, instead of returning 0 on underflow
+    """
+    result = math.exp(x)
+    if not result:
+        raise ValueError('value out of range: underflow')
+    return result
+
+
+def get_priority_sql(connection, term):
+    """
+    Return the sql expression adding `term` (see
+    `FlaggedContent.get_priority_term`) to the priority column: the log of
+    the sum of the exponentials of the priority and of the term, computed
+    without overflow, nor underflow (postgresql raises an error when EXP
+    returns 0): the smallest one is ignored if the difference is more than
+    PRIORITY_MAX_DIFFERENCE, and the term is assigned to an empty priority.
+    The LN and EXP functions are added to sqlite connections (see
+    `add_sqlite_functions`).
+    """
+    priority, term = connection.ops.quote_name('priority'), repr(float(term))
+    return 'CASE WHEN %(priority)s = 0 THEN %(term)s ' \
+           'WHEN %(priority)s >= %(term)s + %(max)d THEN %(priority)s ' \
+           'WHEN %(term)s >= %(priority)s + %(max)d THEN %(term)s ' \
+           'WHEN %(priority)s >= %(term)s ' \
+           'THEN %(priority)s + LN(1 + EXP(%(term)s - %(priority)s)) ' \
+           'ELSE %(term)s + LN(1 + EXP(%(priority)s - %(term)s)) END' % {
+                'priority': priority, 'term': term,
+                'max': PRIORITY_MAX_DIFFERENCE}
+
+
+def add_sqlite_functions(sender, connection, **kwargs):
+    """
+    Add the LN and EXP functions, used by `get_priority_sql`, to each new
+    sqlite connection
+    """
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function('ln', 1, math.log)
+        connection.connection.create_function('exp', 1, _sqlite_exp)
+
+
+connection_created.connect(add_sqlite_functions,
+                           dispatch_uid='flag.models.add_sqlite_functions')
 
 
 class FlaggedContentManager(models.Manager):
@@ -23,10 +95,189 @@ class FlaggedContentManager(models.Manager):
     def get_for_object(self, content_object):
         """
         Helper to get a FlaggedContent instance for the given object
+        If the object was prefetched (see `prefetch_for_objects`), or already
+        looked up during the current request (see `flag.memo`), no query is
+        done
+        """
+        if hasattr(content_object, PREFETCH_CACHE_ATTR):
+            flagged_content = getattr(content_object, PREFETCH_CACHE_ATTR)
+        else:
+            content_type = ContentType.objects.get_for_model(content_object)
+            flagged_content = memo.get_flagged_content(content_type.id,
+                                                       content_object.id)
+            if flagged_content is memo.MISSING:
+                try:
+                    flagged_content = self.get(
+                            content_type__id=content_type.id,
+                            object_id=content_object.id)
+                except self.model.DoesNotExist:
+                    flagged_content = None
+                else:
+                    # avoid loading the object again via the generic fk
+                    setattr(flagged_content,
+                            FlaggedContent.content_object.cache_attr,
+                            content_object)
+                memo.set_flagged_content(content_type.id, content_object.id,
+                                         flagged_content)
+
+        if flagged_content is None:
+            raise self.model.DoesNotExist(
+                    'FlaggedContent matching query does not exist.')
+        return flagged_content
+
+    def get_state_for_object(self, content_object):
+        """
+        Return a tuple `(status, count)` for the given object, or None if it
+        was never flagged.
+        The prefetched data, the request memo and the shared cache (see
+        `flag.cache`) are used, in this order, before querying the database.
         """
+        if hasattr(content_object, PREFETCH_CACHE_ATTR):
+            flagged_content = getattr(content_object, PREFETCH_CACHE_ATTR)
+            return flagged_content and flagged_content.get_state()
+
         content_type = ContentType.objects.get_for_model(content_object)
-        return self.get(content_type__id=content_type.id,
-                        object_id=content_object.id)
+        flagged_content = memo.get_flagged_content(content_type.id,
+                                                   content_object.id)
+        if flagged_content is not memo.MISSING:
+            return flagged_content and flagged_content.get_state()
+
+        state = memo.get_state(content_type.id, content_object.id)
+        if state is memo.MISSING:
+
+            def load():
+                try:
+                    return self.get_for_object(content_object).get_state()
+                except self.model.DoesNotExist:
+                    return None
+
+            state = flag_cache.get_state(content_type.id, content_object.id,
+                                         load)
+            memo.set_state(content_type.id, content_object.id, state)
+
+        return state
+
+    def get_status_display(self, content_type, status):
+        """
+        Return the displayable value of the given status for the given
+        model (see `utils.get_content_type_tuple` for description of the
+        `content_type` parameter)
+        """
+        statuses = dict(flag_settings.get_for_model(content_type, 'STATUSES'))
+        return force_unicode(statuses[status], strings_only=True)
+
+    def get_for_objects(self, content_objects):
+        """
+        Batched version of `get_for_object`, for objects of any models, in
+        only one query.
+        Return a dict with a tuple `(content_type_id, object_id)` as key, and
+        the matching FlaggedContent instance as value. Objects that were never
+        flagged are not in this dict.
+        """
+        return self.get_for_keys([
+                (ContentType.objects.get_for_model(content_object).id,
+                 content_object.id) for content_object in content_objects])
+
+    def get_for_keys(self, keys):
+        """
+        Same as `get_for_objects`, but for the given `(content_type_id,
+        object_id)` tuples, without loading the objects
+        """
+        ids_by_content_type = {}
+        for content_type_id, object_id in keys:
+            ids_by_content_type.setdefault(content_type_id, set()).add(
+                    object_id)
+
+        if not ids_by_content_type:
+            return {}
+
+        query = reduce(operator.or_, [
+                models.Q(content_type__id=content_type_id, object_id__in=ids)
+                    for content_type_id, ids in ids_by_content_type.items()])
+
+        return dict(((flagged_content.content_type_id,
+                      flagged_content.object_id), flagged_content)
+                    for flagged_content in self.filter(query).order_by())
+
+    def load_content_objects(self, flagged_contents):
+        """
+        Load the flagged objects of the given FlaggedContent instances, in
+        one query for each content type, and set them as their
+        `content_object` (None if the object doesn't exist anymore)
+        """
+        cache_attr = FlaggedContent.content_object.cache_attr
+        flagged_contents = [flagged_content
+                            for flagged_content in flagged_contents
+                            if not hasattr(flagged_content, cache_attr)]
+
+        ids_by_content_type = {}
+        for flagged_content in flagged_contents:
+            ids_by_content_type.setdefault(flagged_content.content_type_id,
+                    set()).add(flagged_content.object_id)
+
+        content_objects = {}
+        for content_type_id, ids in ids_by_content_type.items():
+            model = ContentType.objects.get_for_id(
+                    content_type_id).model_class()
+            if model is None:
+                # stale content type
+                continue
+            for object_id, content_object in model._default_manager\
+                    .in_bulk(list(ids)).items():
+                content_objects[(content_type_id, object_id)] = content_object
+
+        for flagged_content in flagged_contents:
+            setattr(flagged_content, cache_attr, content_objects.get(
+                    (flagged_content.content_type_id,
+                     flagged_content.object_id)))
+
+    def prefetch_for_objects(self, content_objects, user=None):
+        """
+        Load the FlaggedContent of all the given objects (of any models) and
+        attach it to them, so `get_for_object` will not do any query for
+        these objects. If a `user` is given, the number of flags made by this
+        user on each object is also loaded, to be used by
+        `FlaggedContent.count_flags_by_user`.
+        Only two queries are done, whatever the number of objects.
+        Return the same dict as `get_for_objects`
+        """
+        content_objects = list(content_objects)
+        flagged_contents = self.get_for_objects(content_objects)
+
+        # number of flags by the user for each flagged content
+        if user and user.is_authenticated():
+            self.load_flags_by_user(flagged_contents.values(), user)
+
+        for content_object in content_objects:
+            content_type = ContentType.objects.get_for_model(content_object)
+            flagged_content = flagged_contents.get(
+                    (content_type.id, content_object.id))
+            setattr(content_object, PREFETCH_CACHE_ATTR, flagged_content)
+            memo.set_flagged_content(content_type.id, content_object.id,
+                                     flagged_content)
+            if flagged_content is not None:
+                # avoid loading the object again via the generic foreign key
+                setattr(flagged_content,
+                        FlaggedContent.content_object.cache_attr,
+                        content_object)
+
+        return flagged_contents
+
+    def load_flags_by_user(self, flagged_contents, user):
+        """
+        Load, in one query, the number of flags made by the given user on
+        each of the given FlaggedContent instances, to be used by
+        `FlaggedContent.count_flags_by_user`
+        """
+        if not flagged_contents:
+            return
+        counts = dict(UserFlagCount.objects.filter(
+                flagged_content__in=[flagged_content.id
+                    for flagged_content in flagged_contents],
+                user=user).values_list('flagged_content', 'count'))
+        for flagged_content in flagged_contents:
+            flagged_content.set_flags_by_user_cache(user,
+                    counts.get(flagged_content.id, 0))
 
     def filter_for_model(self, model, only_object_ids=False):
         """
@@ -38,9 +289,10 @@ class FlaggedContentManager(models.Manager):
             User.objects.filter(id__in=FlaggedContent.objects.filter_for_model(
                 User, True).filter(status=2))
         """
-        app_label, model = get_content_type_tuple(model)
-        queryset = self.filter(content_type__app_label=app_label,
-                content_type__model=model)
+        try:
+            queryset = self.filter(content_type=get_content_type_id(model))
+        except ContentType.DoesNotExist:
+            queryset = self.none()
         if only_object_ids:
             queryset = queryset.values_list('object_id', flat=True)
         return queryset
@@ -52,18 +304,215 @@ class FlaggedContentManager(models.Manager):
         """
         A wrapper around get_or_create to easily manage the fields
         `content_creator` and `status` are only set when creating the object
+        A prefetched FlaggedContent (see `prefetch_for_objects`) is returned
+        without any query
         """
-        defaults = {}
-        if content_creator is not None:
-            defaults['creator'] = content_creator
-        if status is not None:
-            defaults['status'] = status
-        flagged_content, created = FlaggedContent.objects.get_or_create(
-            content_type=ContentType.objects.get_for_model(content_object),
-            object_id=content_object.id,
-            defaults=defaults)
+        if getattr(content_object, PREFETCH_CACHE_ATTR, None) is not None:
+            return getattr(content_object, PREFETCH_CACHE_ATTR), False
+
+        content_type = ContentType.objects.get_for_model(content_object)
+        flagged_content = memo.get_flagged_content(content_type.id,
+                                                   content_object.id)
+        if flagged_content in (None, memo.MISSING):
+            defaults = {}
+            if content_creator is not None:
+                defaults['creator'] = content_creator
+            if status is not None:
+                defaults['status'] = status
+            flagged_content, created = FlaggedContent.objects.get_or_create(
+                content_type=content_type,
+                object_id=content_object.id,
+                defaults=defaults)
+            memo.set_flagged_content(content_type.id, content_object.id,
+                                     flagged_content)
+        else:
+            created = False
+
+        # avoid loading the object again via the generic foreign key
+        setattr(flagged_content, FlaggedContent.content_object.cache_attr,
+                content_object)
+
         return flagged_content, created
 
+    @transaction.commit_on_success
+    def set_status(self, queryset, status, moderator, comment=None,
+                   send_signal=True, chunk_size=500):
+        """
+        Set the status and the moderator of all the flagged contents of the
+        given queryset, with one UPDATE query for each chunk of `chunk_size`
+        flagged contents (the count is not changed), and record the change
+        with a flag by the moderator on each one, inserted with
+        `bulk_create`. The comment is saved only for the models allowing
+        comments, and is mandatory for them.
+        The `contents_moderated` signal is sent once for all the flagged
+        contents if `send_signal` is True (no mails are sent).
+        Return the number of updated flagged contents.
+        """
+        if status == flag_settings.STATUSES[0][0]:
+            raise ValueError('The status of flagged contents cannot be set '
+                             'back to %s in bulk' % status)
+
+        rows = list(queryset.order_by().values_list('id', 'content_type',
+                                                    'object_id'))
+
+        # check the status and the comment for each model
+        allow_comments = {}
+        for content_type_id in set([row[1] for row in rows]):
+            statuses = flag_settings.get_for_model(content_type_id,
+                                                   'STATUSES')
+            if status not in dict(statuses):
+                raise ValueError('Invalid status %s for the content type %s'
+                                 % (status, content_type_id))
+            allow_comments[content_type_id] = flag_settings.get_for_model(
+                    content_type_id, 'ALLOW_COMMENTS')
+            if allow_comments[content_type_id] and not comment:
+                raise FlagCommentException(_('You must add a comment'))
+
+        now = datetime.now()
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            ids = [row[0] for row in chunk]
+            self.filter(id__in=ids).update(status=status, moderator=moderator,
+                                           when_updated=now)
+
+            bulk_create(FlagInstance, [FlagInstance(
+                    flagged_content_id=id,
+                    user=moderator,
+                    status=status,
+                    comment=allow_comments[content_type_id] and comment or
+                            None)
+                for id, content_type_id, object_id in chunk])
+
+            # keep the request memo and the shared cache up to date
+            for id, content_type_id, object_id in chunk:
+                memo.forget_flagged_content(content_type_id, object_id)
+            if flag_cache.get_backend() is not None:
+                flag_cache.set_states(dict(
+                        ((content_type_id, object_id), (status, count))
+                        for content_type_id, object_id, count
+                            in self.filter(id__in=ids).values_list(
+                                'content_type', 'object_id', 'count')))
+
+        if send_signal and rows:
+            signals.contents_moderated.send(
+                sender=FlaggedContent,
+                flagged_content_ids=[row[0] for row in rows],
+                status=status,
+                moderator=moderator)
+
+        return len(rows)
+
+    def bulk_update_for_new_flags(self, ids, increments, statuses,
+                                  moderators, priorities=None, now=None):
+        """
+        Update with only one query the `when_updated` field of the flagged
+        contents with the given ids (to `now`) and, for the ids in the given
+        dicts, the count (incremented by the value in `increments`), the
+        status, the moderator (a user id) and the priority (with the term
+        in `priorities`, see `FlaggedContent.get_priority_term`). Return the
+        date set in `when_updated`.
+        """
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        meta = self.model._meta
+        now = now or datetime.now()
+
+        def case(values, default):
+            return 'CASE %s %s ELSE %s END' % (qn(meta.pk.column), ' '.join([
+                    'WHEN %d THEN %d' % (int(id), int(value))
+                        for id, value in values.items()]), default)
+
+        assignments = ['%s = %%s' % qn('when_updated')]
+        if increments:
+            assignments.append('%s = %s + %s' % (qn('count'), qn('count'),
+                                                 case(increments, '0')))
+        if statuses:
+            assignments.append('%s = %s' % (qn('status'),
+                                            case(statuses, qn('status'))))
+        if moderators:
+            column = qn(meta.get_field('moderator').column)
+            assignments.append('%s = %s' % (column,
+                                            case(moderators, column)))
+        if [term for term in priorities.values() if term is not None]:
+            assignments.append('%s = CASE %s %s ELSE %s END' % (
+                    qn('priority'), qn(meta.pk.column), ' '.join([
+                        'WHEN %d THEN %s' % (int(id),
+                                             get_priority_sql(connection,
+                                                              term))
+                            for id, term in priorities.items()
+                                if term is not None]),
+                    qn('priority')))
+
+        connection.cursor().execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+                    qn(meta.db_table),
+                    ', '.join(assignments),
+                    qn(meta.pk.column),
+                    ', '.join(['%d' % int(id) for id in ids])),
+                [meta.get_field('when_updated').get_db_prep_save(now,
+                        connection=connection)])
+        transaction.commit_unless_managed(using=connection.alias)
+        return now
+
+    def reconcile_counts(self, start_id, end_id, fix=False, since=None):
+        """
+        Compare the count of the flagged contents with an id in
+        `[start_id, end_id[` with their number of flags with a status of 1,
+        computed with one grouped query on the flags, and one on each table
+        of the retention (see `FlagInstanceManager.apply_retention`).
+        If `since` is given, only the flagged contents updated, or flagged,
+        since this date are checked.
+        If `fix` is True, the wrong counts are updated, only if they were
+        not changed in the meantime (by a new flag).
+        Return a tuple with the number of checked flagged contents, a list
+        of `(id, count, number of flags)` tuples for the mismatches, and the
+        number of fixed counts.
+        """
+        queryset = self.filter(id__gte=start_id, id__lt=end_id)
+        range_filter = dict(flagged_content__gte=start_id,
+                            flagged_content__lt=end_id)
+        flags = FlagInstance.objects.filter(**range_filter)
+        archived = FlagInstanceArchive.objects.filter(**range_filter)
+        aggregated = FlagInstanceAggregate.objects.filter(**range_filter)
+        if since is not None:
+            ids = set(queryset.filter(when_updated__gte=since)
+                              .values_list('id', flat=True))
+            ids.update(flags.filter(when_added__gte=since).order_by()
+                            .values_list('flagged_content', flat=True)
+                            .distinct())
+            queryset = queryset.filter(id__in=ids)
+            flags = flags.filter(flagged_content__in=ids)
+            archived = archived.filter(flagged_content__in=ids)
+            aggregated = aggregated.filter(flagged_content__in=ids)
+
+        # read before the flags: a count changed by a new flag in the meantime
+        # is not fixed (see below) instead of being set too low
+        rows = list(queryset.order_by().values_list('id', 'content_type',
+                                                    'object_id', 'status',
+                                                    'count'))
+        # flags in the table, and moved by the retention
+        counts = {}
+        for counted, aggregate in ((flags, Count('id')),
+                                   (archived, Count('id')),
+                                   (aggregated, Sum('count'))):
+            for id, count in counted.filter(status=1).order_by()\
+                    .values_list('flagged_content')\
+                    .annotate(count=aggregate):
+                counts[id] = counts.get(id, 0) + count
+
+        checked, mismatches, fixed = 0, [], 0
+        for id, content_type_id, object_id, status, count in rows:
+            checked += 1
+            actual = counts.get(id, 0)
+            if count == actual:
+                continue
+            mismatches.append((id, count, actual))
+            if fix and self.filter(id=id, count=count).update(count=actual):
+                fixed += 1
+                memo.forget_flagged_content(content_type_id, object_id)
+                flag_cache.set_state(content_type_id, object_id,
+                                     (status, actual))
+        return checked, mismatches, fixed
+
     def model_can_be_flagged(self, content_type):
         """
         Return True if the model is listed in the MODELS settings (or if this
@@ -112,6 +561,8 @@ class FlaggedContent(models.Model):
                                   related_name="moderated_content")
     count = models.PositiveIntegerField(default=0)
     when_updated = models.DateTimeField(auto_now=True, auto_now_add=True)
+    # log of the decayed sum of the weights of the flags (see `get_priority`)
+    priority = models.FloatField(default=0)
 
     # manager
     objects = FlaggedContentManager()
@@ -122,23 +573,79 @@ class FlaggedContent(models.Model):
 
     def __unicode__(self):
         """
-        Show the flagged object in the unicode string
+        Show the flagged object in the unicode string (without loading it)
         """
-        app_label, model = get_content_type_tuple(self.content_object)
+        app_label, model = get_content_type_tuple(self.content_type_id)
         return u'%s.%s #%s' % (app_label, model, self.object_id)
 
     def content_settings(self, name):
         """
-        Return the settings `name` for the current content object
+        Return the settings `name` for the model of the current content
+        object (without loading it)
+        """
+        return flag_settings.get_for_model(self.content_type_id, name)
+
+    def get_priority_term(self, increment, when):
+        """
+        Return the log of the weight, in the priority, of `increment` flags
+        added at the date `when` (see `get_priority`), or None if the weight
+        is 0 (the priority is not updated)
+        """
+        weight = self.content_settings('PRIORITY_WEIGHT')
+        if weight <= 0:
+            return None
+        return math.log(increment * weight) + self._get_priority_decay(when)
+
+    def _get_priority_decay(self, when):
+        """
+        Return the log of the factor by which the weights of the flags are
+        divided between the date `when` and `PRIORITY_EPOCH`
         """
-        return flag_settings.get_for_model(self.content_object, name)
+        delta = when - PRIORITY_EPOCH
+        seconds = delta.days * 86400 + delta.seconds + \
+                delta.microseconds / 1000000.0
+        return math.log(2) * seconds / float(
+                flag_settings.PRIORITY_HALF_LIFE)
+
+    def get_priority(self, now=None):
+        """
+        Return the priority of the flagged content at the date `now`: the sum
+        of the weights of its flags (with a status of 1), each one divided by
+        2 every `PRIORITY_HALF_LIFE` seconds since it was added.
+        The `priority` field stores the log of this sum at `PRIORITY_EPOCH`,
+        so it's updated by each flag without reading the previous ones, and
+        its order is the order of the priorities, whatever the date.
+        """
+        if not self.priority:
+            return 0.0
+        return math.exp(self.priority - self._get_priority_decay(
+                now or datetime.now()))
 
     def count_flags_by_user(self, user):
         """
         Helper to get the number of flags on this flagged content by the
         given user
+        The result is taken from the cache filled by
+        `set_flags_by_user_cache` or from the request memo if available,
+        else from the UserFlagCount table (no flags are counted)
+        """
+        flags_by_user = getattr(self, '_flags_by_user_cache', {})
+        if user.id in flags_by_user:
+            return flags_by_user[user.id]
+        count = memo.get_flags_by_user(self.id, user.id)
+        if count is memo.MISSING:
+            count = UserFlagCount.objects.get_count(self, user)
+            memo.set_flags_by_user(self.id, user.id, count)
+        return count
+
+    def set_flags_by_user_cache(self, user, count):
         """
-        return self.flag_instances.filter(user=user, status=1).count()
+        Store the number of flags on this flagged content by the given user,
+        to avoid a query in `count_flags_by_user`
+        """
+        if not hasattr(self, '_flags_by_user_cache'):
+            self._flags_by_user_cache = {}
+        self._flags_by_user_cache[user.id] = count
 
     def can_be_flagged(self):
         """
@@ -190,18 +697,10 @@ class FlaggedContent(models.Model):
 
     def get_content_object_admin_url(self):
         """
-        Return the admin url for the content object
+        Return the admin url for the content object (without loading it)
         """
-        url = None
-        if self.content_object:
-            try:
-                url = urlresolvers.reverse("admin:%s_%s_change" % (
-                        self.content_object._meta.app_label,
-                        self.content_object._meta.module_name),
-                    args=(self.object_id,))
-            except urlresolvers.NoReverseMatch:
-                pass
-        return url
+        app_label, model = get_content_type_tuple(self.content_type_id)
+        return get_admin_url(app_label, model, self.object_id)
 
     def get_content_object_absolute_url(self):
         """
@@ -219,14 +718,9 @@ class FlaggedContent(models.Model):
         """
         Return the admin url for the content object's creator
         """
-        url = None
-        if self.creator:
-            try:
-                url = urlresolvers.reverse("admin:auth_user_change",
-                    args=(self.creator_id,))
-            except urlresolvers.NoReverseMatch:
-                pass
-        return url
+        if not self.creator_id:
+            return None
+        return get_admin_url('auth', 'user', self.creator_id)
 
     def get_creator_absolute_url(self):
         """
@@ -235,7 +729,7 @@ class FlaggedContent(models.Model):
         url = None
         if self.creator:
             try:
-                url = User.objects.get(id=self.creator_id).get_absolute_url()
+                url = self.creator.get_absolute_url()
             except (AttributeError,  urlresolvers.NoReverseMatch):
                 pass
         return url
@@ -245,58 +739,171 @@ class FlaggedContent(models.Model):
         Before the save, we check that we can flag this object
         """
 
-        # check if we can flag this model
-        FlaggedContent.objects.assert_model_can_be_flagged(self.content_object)
+        # check if we can flag this model (without loading the object)
+        FlaggedContent.objects.assert_model_can_be_flagged(
+                self.content_type_id)
 
         super(FlaggedContent, self).save(*args, **kwargs)
 
-    def flag_added(self, flag_instance, send_signal=False, send_mails=False):
+        # keep the request memo and the shared cache up to date
+        memo.set_flagged_content(self.content_type_id, self.object_id, self)
+        if isinstance(self.count, (int, long)):
+            flag_cache.set_state(self.content_type_id, self.object_id,
+                                 self.get_state())
+
+    def delete(self, *args, **kwargs):
         """
-        Called when a flag is added, to update the count and send a signal
+        Remove the deleted object from the request memo and the shared cache
         """
-        # increment the count if status == 1
-        if self.status == 1:
-            self.count = models.F('count') + 1
-            self.save()
+        memo.forget_flagged_content(self.content_type_id, self.object_id)
+        flag_cache.set_state(self.content_type_id, self.object_id, None)
+        super(FlaggedContent, self).delete(*args, **kwargs)
 
-            # update count of the current object
-            new_self = FlaggedContent.objects.get(id=self.id)
-            self.count = new_self.count
+    def get_state(self):
+        """
+        Return a tuple `(status, count)`, as stored in the shared cache
+        """
+        return (self.status, self.count)
 
-        # send a signal if wanted
+    def update_for_new_flag(self, increment, **fields):
+        """
+        Update in only one query the given `fields`, the `when_updated` one
+        and, if `increment` is True, the count and the priority, and return
+        the new count.
+        The count is directly returned by the UPDATE query if the database
+        supports it (postgresql), else it's read in the same transaction, so
+        in all cases it's exactly the one set by this update, even with
+        concurrent flags.
+        """
+        connection = connections[self._state.db or
+                                 FlaggedContent.objects.db]
+        qn = connection.ops.quote_name
+        fields['when_updated'] = datetime.now()
+
+        assignments, params = [], []
+        for name, value in fields.items():
+            field = self._meta.get_field(name)
+            if isinstance(field, models.ForeignKey) and value is not None:
+                value = value.pk
+            assignments.append('%s = %%s' % qn(field.column))
+            params.append(field.get_db_prep_save(value,
+                                                 connection=connection))
+        if increment:
+            assignments.append('%s = %s + 1' % (qn('count'), qn('count')))
+            term = self.get_priority_term(1, fields['when_updated'])
+            if term is not None:
+                assignments.append('%s = %s' % (qn('priority'),
+                        get_priority_sql(connection, term)))
+        params.append(self.pk)
+
+        sql = 'UPDATE %s SET %s WHERE %s = %%s' % (
+                qn(self._meta.db_table),
+                ', '.join(assignments),
+                qn(self._meta.pk.column))
+
+        cursor = connection.cursor()
+        returned = '%s, %s' % (qn('count'), qn('priority'))
+        if connection.vendor == 'postgresql':
+            cursor.execute('%s RETURNING %s' % (sql, returned), params)
+        else:
+            cursor.execute(sql, params)
+            cursor.execute('SELECT %s FROM %s WHERE %s = %%s' % (
+                        returned,
+                        qn(self._meta.db_table),
+                        qn(self._meta.pk.column)),
+                    [self.pk])
+        count, priority = cursor.fetchone()
+        transaction.commit_unless_managed(using=connection.alias)
+
+        # update the current object
+        for name, value in fields.items():
+            setattr(self, name, value)
+        self.count, self.priority = count, priority
+
+        # keep the request memo and the shared cache up to date
+        memo.set_flagged_content(self.content_type_id, self.object_id, self)
+        flag_cache.set_state(self.content_type_id, self.object_id,
+                             self.get_state())
+
+        return count
+
+    def flag_added(self, flag_instance, send_mails=False, **fields):
+        """
+        Called when a flag is added, in its transaction, to update the count
+        (and the given `fields`) and, if `send_mails` is True, queue the
+        mails (see `dispatch_mails`). Return the count for which the mails
+        must be sent after the commit (see `flag_committed`), or None.
+        """
+        # keep the cached number of flags by the user up to date
+        flags_by_user = getattr(self, '_flags_by_user_cache', {})
+        if flag_instance.status == 1:
+            if flag_instance.user_id in flags_by_user:
+                flags_by_user[flag_instance.user_id] += 1
+            memo.increment_flags_by_user(self.id, flag_instance.user_id)
+
+        # increment the count if status == 1 (always update the
+        # `when_updated` field)
+        increment = fields.get('status', self.status) == 1
+        count = self.update_for_new_flag(increment, **fields)
+
+        # send emails if wanted, only if this flag incremented the count : as
+        # each count is returned by `update_for_new_flag` for only one flag,
+        # even with concurrent flags, each mail is sent only once
+        if send_mails and increment and self.must_send_mails(count):
+            if not self.mails_are_queued():
+                return count
+            self.dispatch_mails(flag_instance, count)
+        return None
+
+    def flag_committed(self, flag_instance, send_signal=False,
+                       mails_count=None):
+        """
+        Called when a flag is added, after the commit of its transaction (so
+        the flagged content is not locked), to send the signal if wanted,
+        and the mails for the count `mails_count` (see `flag_added`)
+        """
         if send_signal:
             signals.content_flagged.send(
                 sender=FlaggedContent,
                 flagged_content=self,
                 flagged_instance=flag_instance)
 
-        # send emails if wanted
-        if send_mails and self.content_settings('SEND_MAILS'):
-
-            # always send mail if the max flag is reached
-            limit = self.content_settings('LIMIT_FOR_OBJECT')
-            really_send_mails = limit \
-                and self.count >= limit
-
-            # limit not reached, check rules
-            if not really_send_mails:
-                # check rule
-                current_min_count, current_step = 0, 0
-                for min_count, step in self.content_settings(
-                        'SEND_MAILS_RULES'):
-                    if self.count >= min_count:
-                        current_min_count, current_step = min_count, step
-                    else:
-                        break
-
-                # do we need to send mail ?
-                if current_step and \
-                        not (self.count - current_min_count) % current_step:
-                    really_send_mails = True
-
-            # finally send mails if we really want to do it
-            if really_send_mails:
-                flag_instance.send_mails()
+        if mails_count is not None:
+            self.dispatch_mails(flag_instance, mails_count)
+
+    def must_send_mails(self, count):
+        """
+        Return True if mails must be sent for the flag which set the count
+        to `count`: always if the max flag is reached, else if a rule of
+        SEND_MAILS_RULES matches
+        """
+        if not self.content_settings('SEND_MAILS'):
+            return False
+        limit = self.content_settings('LIMIT_FOR_OBJECT')
+        return bool((limit and count >= limit) or
+                    must_send_mail(self.content_settings('SEND_MAILS_RULES'),
+                                   count))
+
+    def mails_are_queued(self):
+        """
+        Return True if the mails are saved in the outbox (or in the
+        digests) instead of being sent while the flag is added
+        """
+        return bool(self.content_settings('SEND_MAILS_DIGEST') or
+                    self.content_settings('SEND_MAILS_QUEUED'))
+
+    def dispatch_mails(self, flag_instance, count, connection=None):
+        """
+        Send the mails for the given flag, or queue them (or add them to the
+        digests) depending on the settings
+        `connection` is the mail backend connection to use to send them
+        """
+        if self.content_settings('SEND_MAILS_DIGEST'):
+            FlagMail.objects.add_to_digests(flag_instance, count)
+        elif self.content_settings('SEND_MAILS_QUEUED'):
+            FlagMail.objects.create(flag_instance=flag_instance, count=count)
+        else:
+            flag_instance.send_mails(count=count, connection=connection)
 
     def get_status_display(self):
         """
@@ -304,9 +911,8 @@ class FlaggedContent(models.Model):
         (replace the original get_FIELD_display for this field which act as a
         field with choices)
         """
-        statuses = dict(flag_settings.get_for_model(self.content_object,
-                                                    'STATUSES'))
-        return force_unicode(statuses[self.status], strings_only=True)
+        return FlaggedContent.objects.get_status_display(self.content_type_id,
+                                                         self.status)
 
 
 class FlagInstanceManager(models.Manager):
@@ -315,13 +921,26 @@ class FlagInstanceManager(models.Manager):
     """
 
     def add(self, user, content_object, content_creator=None, comment=None,
-            status=None, send_signal=False, send_mails=False):
+            status=None, send_signal=False, send_mails=False,
+            idempotency_key=None):
         """
         Helper to easily create a flag of an object
         `content_creator` can only be set if it's the first flag
         if `status` is updated, no signal/mails will be sent (update by staff)
+        With an `idempotency_key`, the flag is added only once, the same flag
+        being returned for each call with the same key by the same user, for
+        the same object, comment and status (see `flag.idempotency`), with
+        its `replayed` attribute set to True (its flagged content is the one
+        of the first call)
         TODO : move things in the `save` method of the `FlagInstance` model
         """
+        if idempotency_key:
+            idempotency_key = idempotency.get_flag_key(idempotency_key,
+                    content_object, comment, status)
+            return idempotency.call_once(user, idempotency_key, self.add,
+                                         user, content_object, content_creator,
+                                         comment, status, send_signal,
+                                         send_mails)
 
         # get or create the FlaggedContent object
         flagged_content, created = FlaggedContent.objects.\
@@ -329,14 +948,14 @@ class FlagInstanceManager(models.Manager):
                                          content_creator,
                                          status)
 
-        # save new status, moderator and updated date
+        # new status and moderator, saved with the count and updated date
+        # in the same query, when the flag is added
+        flagged_content_fields = {}
         if status:
-            flagged_content.status = status
+            flagged_content_fields['status'] = status
             # if the status is not the default one, we save the moderator
             if status != flag_settings.STATUSES[0][0]:
-                flagged_content.moderator = user
-        # always update the `when_updated` field
-        flagged_content.save()
+                flagged_content_fields['moderator'] = user
 
         # add the flag
         params = dict(
@@ -350,10 +969,340 @@ class FlagInstanceManager(models.Manager):
 
         flag_instance = FlagInstance(**params)
         flag_instance.save(send_signal=send_signal,
-                           send_mails=send_mails)
+                           send_mails=send_mails,
+                           flagged_content_fields=flagged_content_fields)
+
+        # keep a prefetched FlaggedContent up to date
+        if hasattr(content_object, PREFETCH_CACHE_ATTR):
+            setattr(content_object, PREFETCH_CACHE_ATTR, flagged_content)
 
         return flag_instance
 
+    @transaction.commit_on_success
+    def bulk_add(self, records, send_signal=False, send_mails=False,
+                 chunk_size=400):
+        """
+        Add many flags at once (for imports), from an iterable of
+        `(user, content_object, comment, status)` records, with the rules of
+        `add` (comments and limits are checked in memory, a status of None
+        keeps the current one).
+        The records are handled by chunks of `chunk_size`, with a few
+        queries for each chunk (see `_bulk_add_chunk`).
+        Then, if `send_mails` is True, the mails are sent (or queued) using
+        only one connection, and if `send_signal` is True, one
+        `contents_flagged` signal is sent for all the flags.
+        Return a tuple with the list of added flags, and a list of
+        `(record, exception)` tuples for the rejected records.
+        """
+        flag_instances, errors, mails = [], [], []
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            self._bulk_add_chunk(chunk, send_mails, flag_instances, errors,
+                                 mails)
+
+        if mails:
+            connection = get_connection()
+            try:
+                for flag_instance, count in mails:
+                    flag_instance.flagged_content.dispatch_mails(
+                            flag_instance, count, connection=connection)
+            finally:
+                connection.close()
+
+        if send_signal and flag_instances:
+            flagged_contents = dict((flag_instance.flagged_content_id,
+                                     flag_instance.flagged_content)
+                                    for flag_instance in flag_instances)
+            signals.contents_flagged.send(
+                sender=FlaggedContent,
+                flagged_contents=flagged_contents.values(),
+                flag_instances=flag_instances)
+
+        return flag_instances, errors
+
+    def _bulk_add_chunk(self, records, send_mails, flag_instances, errors,
+                        mails):
+        """
+        Add the flags of a chunk of records (see `bulk_add`): the flagged
+        contents are loaded, and the missing ones created, with two queries
+        for each content type, the numbers of flags by user are loaded in one
+        query, then the counts, statuses and moderators are updated with one
+        UPDATE, and the flags inserted with `bulk_create` (except the ones
+        sending mails, which need an id).
+        The added flags, rejected records and `(flag, count)` tuples of the
+        mails to send are appended to the given lists.
+        """
+        flagged_contents = {}
+        keys = []
+        for record in records:
+            content_object = record[1]
+            try:
+                content_type_id = get_content_type_id(content_object)
+                FlaggedContent.objects.assert_model_can_be_flagged(
+                        content_type_id)
+            except ModelCannotBeFlaggedException, e:
+                errors.append((record, e))
+                keys.append(None)
+                continue
+            key = (content_type_id, content_object.pk)
+            flagged_contents[key] = None
+            keys.append(key)
+
+        # load the flagged contents, and create the missing ones
+        object_ids = {}
+        for content_type_id, object_id in flagged_contents:
+            object_ids.setdefault(content_type_id, []).append(object_id)
+        for content_type_id, ids in object_ids.items():
+            queryset = FlaggedContent.objects.filter(
+                    content_type=content_type_id)
+            for flagged_content in queryset.filter(object_id__in=ids):
+                flagged_contents[(content_type_id, flagged_content.object_id)]\
+                        = flagged_content
+            missing = [object_id for object_id in ids if flagged_contents[
+                               (content_type_id, object_id)] is None]
+            if not missing:
+                continue
+            sid = transaction.savepoint(using=self.db)
+            try:
+                bulk_create(FlaggedContent, [FlaggedContent(
+                        content_type_id=content_type_id, object_id=object_id)
+                    for object_id in missing])
+            except IntegrityError:
+                # created in the meantime
+                transaction.savepoint_rollback(sid, using=self.db)
+                for object_id in missing:
+                    flagged_contents[(content_type_id, object_id)] = \
+                            FlaggedContent.objects.get_or_create(
+                                content_type_id=content_type_id,
+                                object_id=object_id)[0]
+            else:
+                transaction.savepoint_commit(sid, using=self.db)
+                for flagged_content in queryset.filter(object_id__in=missing):
+                    flagged_contents[(content_type_id,
+                                      flagged_content.object_id)] = \
+                            flagged_content
+
+        # load the numbers of flags by user, to check the limits
+        by_id = dict((flagged_content.id, flagged_content)
+                     for flagged_content in flagged_contents.values())
+        user_ids = set([record[0].id for record in records])
+        user_counts = {}
+        for id, flagged_content_id, user_id, count in \
+                UserFlagCount.objects.filter(flagged_content__in=by_id.keys(),
+                                             user__in=user_ids)\
+                .values_list('id', 'flagged_content', 'user', 'count'):
+            user_counts[(flagged_content_id, user_id)] = id
+            by_id[flagged_content_id].set_flags_by_user_cache(
+                    User(id=user_id), count)
+
+        # check the records, and update the flagged contents in memory
+        first_status = flag_settings.STATUSES[0][0]
+        counted, changed, new_user_counts = {}, {}, {}
+        chunk_flags = []
+        for record, key in zip(records, keys):
+            if key is None:
+                continue
+            user, content_object, comment, status = record
+            flagged_content = flagged_contents[key]
+            try:
+                allow_comments = flagged_content.content_settings(
+                        'ALLOW_COMMENTS')
+                if allow_comments and not comment:
+                    raise FlagCommentException(_('You must add a comment'))
+                if not allow_comments and comment:
+                    raise FlagCommentException(
+                            _('You are not allowed to add a comment'))
+                new_status = status
+                if not status:
+                    status = flagged_content.status
+                if status == 1:
+                    if user.id not in getattr(flagged_content,
+                                              '_flags_by_user_cache', {}):
+                        flagged_content.set_flags_by_user_cache(user, 0)
+                    flagged_content.assert_can_be_flagged_by_user(user)
+            except FlagException, e:
+                errors.append((record, e))
+                continue
+
+            if new_status:
+                flagged_content.status = status
+                if status != first_status:
+                    flagged_content.moderator_id = user.id
+                changed[flagged_content.id] = flagged_content
+            flag_instance = FlagInstance(flagged_content=flagged_content,
+                                         user=user,
+                                         comment=comment,
+                                         status=status)
+            chunk_flags.append(flag_instance)
+            if status == 1:
+                flagged_content.count += 1
+                flagged_content._flags_by_user_cache[user.id] += 1
+                counted.setdefault(flagged_content.id, []).append(
+                        flag_instance)
+                pair = (flagged_content.id, user.id)
+                if pair not in user_counts:
+                    new_user_counts[pair] = new_user_counts.get(pair, 0) + 1
+                    user_counts[pair] = None
+
+        if not chunk_flags:
+            return
+
+        # update the flagged contents with one query, and read the new
+        # counts (in the same transaction, so they are exact)
+        ids = set([flag_instance.flagged_content_id
+                   for flag_instance in chunk_flags])
+        now = datetime.now()
+        FlaggedContent.objects.bulk_update_for_new_flags(
+                ids,
+                dict((id, len(flags)) for id, flags in counted.items()),
+                dict((id, flagged_content.status)
+                     for id, flagged_content in changed.items()),
+                dict((id, flagged_content.moderator_id)
+                     for id, flagged_content in changed.items()
+                        if flagged_content.moderator_id),
+                dict((id, by_id[id].get_priority_term(len(flags), now))
+                     for id, flags in counted.items()),
+                now)
+        for id, count, priority in FlaggedContent.objects.filter(id__in=ids)\
+                .values_list('id', 'count', 'priority'):
+            by_id[id].count = count
+            by_id[id].priority = priority
+            by_id[id].when_updated = now
+
+        # flags sending mails are saved one by one, to get an id
+        bulk_flags = chunk_flags
+        if send_mails:
+            mail_flags = []
+            for id, flags in counted.items():
+                flagged_content = by_id[id]
+                first_count = flagged_content.count - len(flags) + 1
+                for i, flag_instance in enumerate(flags):
+                    count = first_count + i
+                    if flagged_content.must_send_mails(count):
+                        flag_instance.save_base(force_insert=True)
+                        mail_flags.append(flag_instance)
+                        mails.append((flag_instance, count))
+            if mail_flags:
+                bulk_flags = [flag_instance for flag_instance in chunk_flags
+                              if flag_instance.pk is None]
+        bulk_create(FlagInstance, bulk_flags)
+        flag_instances.extend(chunk_flags)
+
+        # update the numbers of flags by user
+        increments = {}
+        for flag_instance in itertools.chain(*counted.values()):
+            pair = (flag_instance.flagged_content_id, flag_instance.user_id)
+            if user_counts[pair] is not None:
+                increments[user_counts[pair]] = \
+                        increments.get(user_counts[pair], 0) + 1
+        by_increment = {}
+        for id, increment in increments.items():
+            by_increment.setdefault(increment, []).append(id)
+        for increment, user_count_ids in by_increment.items():
+            UserFlagCount.objects.filter(id__in=user_count_ids).update(
+                    count=models.F('count') + increment)
+        if new_user_counts:
+            sid = transaction.savepoint(using=self.db)
+            try:
+                bulk_create(UserFlagCount, [UserFlagCount(
+                        flagged_content_id=flagged_content_id,
+                        user_id=user_id,
+                        count=count)
+                    for (flagged_content_id, user_id), count
+                        in new_user_counts.items()])
+            except IntegrityError:
+                # created in the meantime
+                transaction.savepoint_rollback(sid, using=self.db)
+                for (flagged_content_id, user_id), count \
+                        in new_user_counts.items():
+                    for i in range(count):
+                        UserFlagCount.objects.increment(
+                                by_id[flagged_content_id], User(id=user_id))
+            else:
+                transaction.savepoint_commit(sid, using=self.db)
+
+        # keep the request memo and the shared cache up to date
+        for flagged_content in by_id.values():
+            memo.set_flagged_content(flagged_content.content_type_id,
+                                     flagged_content.object_id,
+                                     flagged_content)
+        for flag_instance in itertools.chain(*counted.values()):
+            memo.increment_flags_by_user(flag_instance.flagged_content_id,
+                                         flag_instance.user_id)
+        flag_cache.set_states(dict(
+                ((flagged_content.content_type_id, flagged_content.object_id),
+                    flagged_content.get_state())
+                for flagged_content in by_id.values()))
+
+    def apply_retention(self, batch_size=1000, now=None):
+        """
+        Move out of the flags table the flags older than the RETENTION_DAYS
+        settings of their model, on resolved flagged contents (with a status
+        which is not the first one), to the FlagInstanceArchive table or to
+        the FlagInstanceAggregate one, depending on the RETENTION_MODE
+        settings, by batches of `batch_size` flags, each one in its own
+        transaction. The counts of the flagged contents are not changed.
+        Return a dict with the number of flags moved for each mode.
+        """
+        if now is None:
+            now = datetime.now()
+        moved = {'archive': 0, 'aggregate': 0}
+        for content_type_id in FlaggedContent.objects.order_by()\
+                .values_list('content_type', flat=True).distinct():
+            days = flag_settings.get_for_model(content_type_id,
+                                               'RETENTION_DAYS')
+            if not days:
+                continue
+            mode = flag_settings.get_for_model(content_type_id,
+                                               'RETENTION_MODE')
+            if mode not in moved:
+                raise ValueError('Invalid RETENTION_MODE %r' % mode)
+
+            queryset = self.filter(
+                    flagged_content__content_type=content_type_id,
+                    when_added__lt=now - timedelta(days=days))\
+                .exclude(flagged_content__status=flag_settings.STATUSES[0][0])\
+                .order_by('id').values_list('id', flat=True)
+            # each batch starts after the last id of the previous one, to
+            # not read again the flags which are kept
+            last_id = 0
+            while True:
+                ids = list(queryset.filter(id__gt=last_id)[:batch_size])
+                if not ids:
+                    break
+                self._move_flags(ids, mode)
+                moved[mode] += len(ids)
+                last_id = ids[-1]
+        return moved
+
+    @transaction.commit_on_success
+    def _move_flags(self, ids, mode):
+        """
+        Move the flags with the given ids to the archive, or to the
+        aggregates, then delete them (and their queued mails)
+        """
+        flags = self.filter(id__in=ids).values_list('id', 'flagged_content',
+                'user', 'when_added', 'comment', 'status')
+        if mode == 'archive':
+            bulk_create(FlagInstanceArchive, [FlagInstanceArchive(id=id,
+                        flagged_content_id=flagged_content_id,
+                        user_id=user_id,
+                        when_added=when_added,
+                        comment=comment,
+                        status=status)
+                for id, flagged_content_id, user_id, when_added, comment,
+                    status in flags])
+        else:
+            FlagInstanceAggregate.objects.add_flags([
+                    (flagged_content_id, when_added.date(), status)
+                for id, flagged_content_id, user_id, when_added, comment,
+                    status in flags])
+        FlagMail.objects.filter(flag_instance__in=ids).delete()
+        self.filter(id__in=ids).delete()
+
 
 class FlagInstance(models.Model):
 
@@ -365,6 +1314,9 @@ class FlagInstance(models.Model):
 
     objects = FlagInstanceManager()
 
+    # set to True on a flag returned again for an idempotency key
+    replayed = False
+
     class Meta:
         ordering = ('-when_added',)
 
@@ -373,7 +1325,7 @@ class FlagInstance(models.Model):
         Show the flagged object in the unicode string
         """
         app_label, model = get_content_type_tuple(
-                self.flagged_content.content_object)
+                self.flagged_content.content_type_id)
         return u'flag on %s.%s #%s by user #%s' % (
                 app_label, model, self.flagged_content.object_id, self.user_id)
 
@@ -385,15 +1337,33 @@ class FlagInstance(models.Model):
 
     def save(self, *args, **kwargs):
         """
-        Save the flag and, if it's a new one, tell it to the flagged_content.
+        Save the flag and, if it's a new one, tell it to the flagged_content
+        and update the number of flags by the user (all in a transaction)
         Also check if set a comment is allowed
-        If a `send_signal` is passed, we pass it to the `flag_added` method
-        of the flagged_content to tell him to send the signal (default False)
-        Idem with `send_mails`, to send emails if settings allow it.
+        If a `send_signal` is passed, we pass it to the `flag_committed`
+        method of the flagged_content to tell him to send the signal (default
+        False), after the commit.
+        Idem with `send_mails`, to send emails if settings allow it (queued
+        mails are saved in the transaction, the other ones sent after it).
+        A `flagged_content_fields` dict can be passed to update these fields
+        of the flagged_content in the same query as its count.
         """
         is_new = not bool(self.id)
         send_signal = kwargs.pop('send_signal', False)
+        mails_count = self._save_in_transaction(*args, **kwargs)
+        if is_new:
+            self.flagged_content.flag_committed(self, send_signal=send_signal,
+                                                mails_count=mails_count)
+
+    @transaction.commit_on_success
+    def _save_in_transaction(self, *args, **kwargs):
+        """
+        Save the flag, in a transaction (see `save`), and return the count
+        for which the mails must be sent after the commit, or None
+        """
+        is_new = not bool(self.id)
         send_mails = kwargs.pop('send_mails', False)
+        flagged_content_fields = kwargs.pop('flagged_content_fields', {})
 
         # check if the user can flag this object
         if is_new and self.status == 1:
@@ -408,32 +1378,78 @@ class FlagInstance(models.Model):
                 raise FlagCommentException(
                         _('You are not allowed to add a comment'))
 
+        if not is_new:
+            saved_status = self._get_saved_status()
+
         super(FlagInstance, self).save(*args, **kwargs)
 
+        # update the number of flags by the user
+        if is_new:
+            if self.status == 1:
+                UserFlagCount.objects.increment(self.flagged_content,
+                                                self.user)
+        elif saved_status == 1 and self.status != 1:
+            UserFlagCount.objects.decrement(self.flagged_content, self.user)
+        elif saved_status != 1 and self.status == 1:
+            UserFlagCount.objects.increment(self.flagged_content, self.user)
+
         # tell the flagged_content that it has a new flag
         if is_new:
-            self.flagged_content.flag_added(self, send_signal=send_signal,
-                send_mails=send_mails)
+            return self.flagged_content.flag_added(self,
+                    send_mails=send_mails, **flagged_content_fields)
+        return None
 
-    def send_mails(self):
+    @transaction.commit_on_success
+    def delete(self, *args, **kwargs):
         """
-        Send mails to alert of the current flag
+        Delete the flag and update the number of flags by the user (all in a
+        transaction). The flags deleted with a queryset (like by the
+        retention, which keeps the counts) are not uncounted.
+        """
+        saved_status = self._get_saved_status()
+        super(FlagInstance, self).delete(*args, **kwargs)
+        if saved_status == 1:
+            UserFlagCount.objects.decrement(self.flagged_content, self.user)
+
+    def _get_saved_status(self):
+        """
+        Return the status of the flag in the database (None if it's not
+        there anymore)
+        """
+        statuses = FlagInstance.objects.filter(id=self.id)\
+                .values_list('status', flat=True)
+        if statuses:
+            return statuses[0]
+        return None
+
+    def get_mail_recipients(self):
+        """
+        Return the list of the email addresses to which send the alert mails
+        for this flag (empty if mails must not be sent)
         """
         recipients = self.content_settings('SEND_MAILS_TO')
         if not (self.content_settings('SEND_MAILS') and recipients):
-            return
+            return []
 
-        # prepare recipients
         recipient_list = []
         for recipient in recipients:
             if isinstance(recipient, basestring):
                 recipient_list.append(recipient)
             else:
                 recipient_list.append(recipient[1])
+        return recipient_list
 
-        # subject and body from templates
-        app_label = self.flagged_content.content_object._meta.app_label
-        model_name = self.flagged_content.content_object._meta.module_name
+    def get_mail_context(self, count=None):
+        """
+        Return the context used to render the alert mails for this flag
+        `count` is the number of flags to display, default to the current
+        count of the flagged content (a queued mail pass the count at the
+        time of the flag)
+        """
+        if count is None:
+            count = self.flagged_content.count
+        app_label, model_name = get_content_type_tuple(
+                self.flagged_content.content_type_id)
 
         context = dict(
             flag=self,
@@ -442,7 +1458,7 @@ class FlagInstance(models.Model):
             app_label=app_label,
             model_name=model_name,
             object=self.flagged_content.content_object,
-            count=self.flagged_content.count,
+            count=count,
 
             object_url=self.flagged_content.get_content_object_absolute_url(),
             object_admin_url=self.flagged_content.\
@@ -453,13 +1469,30 @@ class FlagInstance(models.Model):
 
             site=Site.objects.get_current())
 
-        if self.flagged_content.creator:
+        if self.flagged_content.creator_id:
             context.update(dict(
                 creator=self.flagged_content.creator,
                 creator_url=self.flagged_content.get_creator_absolute_url(),
                 creator_admin_url=self.flagged_content.\
                         get_creator_admin_url()))
 
+        return context
+
+    def send_mails(self, count=None, connection=None, fail_silently=True):
+        """
+        Send mails to alert of the current flag
+        `count` is passed to `get_mail_context`
+        `connection` is the mail backend connection to use (a new one by
+        default)
+        """
+        recipient_list = self.get_mail_recipients()
+        if not recipient_list:
+            return
+
+        # subject and body from templates
+        context = self.get_mail_context(count)
+        app_label, model_name = context['app_label'], context['model_name']
+
         subject = render_to_string([
                 'flag/mail_alert_subject_%s_%s.txt' % (app_label, model_name),
                 'flag/mail_alert_subject.txt'],
@@ -476,19 +1509,14 @@ class FlagInstance(models.Model):
             message=message,
             from_email=self.content_settings('SEND_MAILS_FROM'),
             recipient_list=recipient_list,
-            fail_silently=True)
+            fail_silently=fail_silently,
+            connection=connection)
 
     def get_flagger_admin_url(self):
         """
         Return the admin url for the flagger
         """
-        url = None
-        try:
-            url = urlresolvers.reverse("admin:auth_user_change",
-                args=(self.user_id,))
-        except urlresolvers.NoReverseMatch:
-            pass
-        return url
+        return get_admin_url('auth', 'user', self.user_id)
 
     def get_flagger_absolute_url(self):
         """
@@ -502,6 +1530,458 @@ class FlagInstance(models.Model):
         return url
 
 
+class UserFlagCountManager(models.Manager):
+    """
+    Manager for the UserFlagCount model
+    """
+
+    def get_count(self, flagged_content, user):
+        """
+        Return the number of flags (with a status of 1) by the given user on
+        the given flagged content
+        """
+        counts = self.filter(flagged_content=flagged_content,
+                             user=user).values_list('count', flat=True)
+        if counts:
+            return counts[0]
+        return 0
+
+    def increment(self, flagged_content, user):
+        """
+        Increment the number of flags by the given user on the given flagged
+        content
+        """
+        queryset = self.filter(flagged_content=flagged_content, user=user)
+        if queryset.update(count=models.F('count') + 1):
+            return
+        sid = transaction.savepoint(using=self.db)
+        try:
+            self.create(flagged_content=flagged_content, user=user, count=1)
+        except IntegrityError:
+            # created in the meantime
+            transaction.savepoint_rollback(sid, using=self.db)
+            queryset.update(count=models.F('count') + 1)
+        else:
+            transaction.savepoint_commit(sid, using=self.db)
+
+    def decrement(self, flagged_content, user):
+        """
+        Decrement the number of flags by the given user on the given flagged
+        content (when one of them is deleted, or its status changed)
+        """
+        self.filter(flagged_content=flagged_content, user=user,
+                    count__gt=0).update(count=models.F('count') - 1)
+
+    def rebuild(self, chunk_size=1000):
+        """
+        Delete all counts and compute them again from the FlagInstance
+        objects (and the archived ones), inserted by chunks of `chunk_size`
+        counts.
+        Return the number of counts created.
+        """
+        # flags compacted by the retention can't be counted again by user,
+        # so the counts of their flagged contents are kept
+        aggregated = FlagInstanceAggregate.objects.values('flagged_content')
+        self.exclude(flagged_content__in=aggregated).delete()
+
+        def grouped(model):
+            return model.objects.filter(status=1)\
+                    .exclude(flagged_content__in=aggregated).order_by()\
+                    .values_list('flagged_content', 'user')\
+                    .annotate(count=Count('id'))
+
+        def counts():
+            archived = dict(((flagged_content_id, user_id), count)
+                            for flagged_content_id, user_id, count
+                                in grouped(FlagInstanceArchive))
+            for flagged_content_id, user_id, count in \
+                    grouped(FlagInstance).iterator():
+                yield flagged_content_id, user_id, count + archived.pop(
+                        (flagged_content_id, user_id), 0)
+            for (flagged_content_id, user_id), count in archived.items():
+                yield flagged_content_id, user_id, count
+
+        created, chunk = 0, []
+        for flagged_content_id, user_id, count in counts():
+            chunk.append(UserFlagCount(flagged_content_id=flagged_content_id,
+                                       user_id=user_id,
+                                       count=count))
+            if len(chunk) >= chunk_size:
+                bulk_create(UserFlagCount, chunk)
+                created += len(chunk)
+                chunk = []
+        if chunk:
+            bulk_create(UserFlagCount, chunk)
+            created += len(chunk)
+        return created
+
+
+class UserFlagCount(models.Model):
+    """
+    Number of flags (with a status of 1) by a user on a flagged content,
+    maintained by `FlagInstance.save` and `delete`, to check the
+    LIMIT_SAME_OBJECT_FOR_USER settings without counting flags
+    """
+
+    flagged_content = models.ForeignKey(FlaggedContent,
+                                        related_name='user_counts')
+    user = models.ForeignKey(User, related_name='flag_counts')
+    count = models.PositiveIntegerField(default=0)
+
+    objects = UserFlagCountManager()
+
+    class Meta:
+        unique_together = [("flagged_content", "user")]
+
+    def __unicode__(self):
+        """
+        Show the flagged content, the user and the count
+        """
+        return u'%s flags on flagged content #%s by user #%s' % (
+                self.count, self.flagged_content_id, self.user_id)
+
+
+class FlagMailManager(models.Manager):
+    """
+    Manager for the FlagMail model, adding `add_to_digests` and
+    `send_pending` methods
+    """
+
+    def add_to_digests(self, flag_instance, count):
+        """
+        Add the flag to the next digest of each recipient, sent at the end
+        of the current window of SEND_MAILS_DIGEST seconds (windows are
+        aligned so all flags of a window are sent together)
+        """
+        window = flag_instance.content_settings('SEND_MAILS_DIGEST')
+        now = int(time.time())
+        next_try = datetime.fromtimestamp((now // window + 1) * window)
+        bulk_create(FlagMail, [FlagMail(flag_instance=flag_instance,
+                                        count=count,
+                                        recipient=recipient,
+                                        next_try=next_try)
+                for recipient in flag_instance.get_mail_recipients()])
+
+    def send_pending(self, batch_size=100, max_tries=5, backoff=60,
+                     lease=300):
+        """
+        Send at most `batch_size` mails waiting in the outbox, and at most
+        `batch_size` digests, using only one connection to the mail server.
+        Mails are first claimed with a conditional update, so many workers
+        can run at the same time, and if a worker stops while sending, they
+        are tried again after `lease` seconds. They are deleted once sent.
+        On error, a mail is tried again after `backoff` seconds, doubled at
+        each try, and marked as failed after `max_tries` tries.
+        Return a tuple with the number of mails (and digests) sent and
+        failed.
+        """
+        now = datetime.now()
+        connection = get_connection()
+        connection.open()
+        try:
+            sent, failed = self._send_alerts(connection, now, batch_size,
+                                             max_tries, backoff, lease)
+            digests_sent, digests_failed = self._send_digests(connection,
+                    now, batch_size, max_tries, backoff, lease)
+        finally:
+            connection.close()
+        return sent + digests_sent, failed + digests_failed
+
+    def _send_alerts(self, connection, now, batch_size, max_tries, backoff,
+                     lease):
+        """
+        Send the mails of flags not in a digest (see `send_pending`). The
+        mails of the models without mails to send (see the SEND_MAILS and
+        SEND_MAILS_TO settings) are kept, and postponed.
+        """
+        mails = list(self.filter(failed=False, recipient__isnull=True,
+                                 next_try__lte=now)
+                         .order_by('next_try', 'id')
+                         .select_related('flag_instance__flagged_content',
+                                         'flag_instance__user')
+                         [:batch_size])
+
+        sent, failed = 0, 0
+        for mail in mails:
+            # claim the mail, if not done by another worker
+            if not self.filter(id=mail.id, next_try=mail.next_try)\
+                    .update(next_try=now + timedelta(seconds=lease)):
+                continue
+            # mails disabled (or no recipients) for now: keep the mail,
+            # tried again after the lease, else it would be lost
+            if not mail.flag_instance.get_mail_recipients():
+                continue
+            try:
+                mail.flag_instance.send_mails(count=mail.count,
+                                              connection=connection,
+                                              fail_silently=False)
+            except Exception, e:
+                if mail.set_error(e, max_tries, backoff):
+                    failed += 1
+            else:
+                mail.delete()
+                sent += 1
+
+        return sent, failed
+
+    def _send_digests(self, connection, now, batch_size, max_tries, backoff,
+                      lease):
+        """
+        Send one mail for each recipient with flags in a digest to send,
+        if the last digest sent to him is older than
+        SEND_MAILS_DIGEST_MIN_INTERVAL seconds (see `send_pending`)
+        """
+        recipients = list(self.filter(failed=False, recipient__isnull=False,
+                                      next_try__lte=now)
+                              .order_by()
+                              .values_list('recipient', flat=True)
+                              .distinct()[:batch_size])
+        if not recipients:
+            return 0, 0
+
+        min_interval = flag_settings.SEND_MAILS_DIGEST_MIN_INTERVAL
+        last_digests = dict(FlagMailRecipient.objects.filter(
+                email__in=recipients).values_list('email', 'last_digest'))
+
+        sent, failed = 0, 0
+        for recipient in recipients:
+            queryset = self.filter(failed=False, recipient=recipient,
+                                   next_try__lte=now)
+
+            # too soon for this recipient: postpone its digest
+            last_digest = last_digests.get(recipient)
+            if min_interval and last_digest:
+                allowed = last_digest + timedelta(seconds=min_interval)
+                if allowed > now:
+                    queryset.update(next_try=allowed)
+                    continue
+
+            # claim the mails, if not done by another worker
+            ids = list(queryset.values_list('id', flat=True))
+            claimed_until = now + timedelta(seconds=lease)
+            self.filter(id__in=ids, next_try__lte=now).update(
+                    next_try=claimed_until)
+            mails = sorted(self.filter(id__in=ids, next_try=claimed_until)
+                               .order_by()
+                               .select_related(
+                                    'flag_instance__flagged_content',
+                                    'flag_instance__user'),
+                           key=lambda mail: mail.id)
+            if not mails:
+                continue
+
+            try:
+                self.send_digest(recipient, mails, connection)
+            except Exception, e:
+                mails_failed = [mail.set_error(e, max_tries, backoff)
+                                for mail in mails]
+                if True in mails_failed:
+                    failed += 1
+            else:
+                self.filter(id__in=[mail.id for mail in mails]).delete()
+                FlagMailRecipient.objects.set_last_digest(recipient, now)
+                sent += 1
+
+        return sent, failed
+
+    def send_digest(self, recipient, mails, connection=None):
+        """
+        Send to the recipient one mail for all the given FlagMail objects
+        """
+        context = dict(
+            recipient=recipient,
+            alerts=[mail.flag_instance.get_mail_context(mail.count)
+                    for mail in mails],
+            site=Site.objects.get_current())
+
+        subject = render_to_string('flag/mail_digest_subject.txt',
+                                   context).replace("\n", " ")\
+                                           .replace("\r", " ")
+        message = render_to_string('flag/mail_digest_body.txt', context)
+
+        send_mail(
+            subject=subject,
+            message=message,
+            from_email=mails[0].flag_instance.content_settings(
+                    'SEND_MAILS_FROM'),
+            recipient_list=[recipient],
+            fail_silently=False,
+            connection=connection)
+
+
+class FlagMail(models.Model):
+    """
+    Outbox of the alert mails for a flag, saved in the same transaction as
+    the flag if the SEND_MAILS_QUEUED (or SEND_MAILS_DIGEST) settings is set,
+    and sent by the `flag_mail_worker` management command.
+    For digests, there is one FlagMail for each recipient.
+    """
+
+    flag_instance = models.ForeignKey(FlagInstance, related_name='mails')
+    count = models.PositiveIntegerField()  # count when the flag was added
+    recipient = models.EmailField(null=True, blank=True)  # only for digests
+    when_added = models.DateTimeField(auto_now=False, auto_now_add=True)
+    next_try = models.DateTimeField(default=datetime.now)
+    tries = models.PositiveSmallIntegerField(default=0)
+    last_error = models.TextField(null=True, blank=True)
+    failed = models.BooleanField(default=False)
+
+    objects = FlagMailManager()
+
+    def __unicode__(self):
+        """
+        Show the flag and the state of the mail
+        """
+        if self.failed:
+            state = u'failed'
+        else:
+            state = u'pending'
+        return u'mail for flag #%s (%s, %s tries)' % (
+                self.flag_instance_id, state, self.tries)
+
+    def set_error(self, error, max_tries, backoff):
+        """
+        Save the error raised while sending the mail, and when to try again
+        (after `backoff` seconds, doubled at each try). Return True if the
+        mail is marked as failed because it was tried `max_tries` times.
+        """
+        self.tries += 1
+        self.last_error = force_unicode(repr(error))
+        if self.tries >= max_tries:
+            self.failed = True
+        else:
+            self.next_try = datetime.now() + timedelta(
+                    seconds=backoff * 2 ** (self.tries - 1))
+        self.save()
+        return self.failed
+
+
+class FlagMailRecipientManager(models.Manager):
+    """
+    Manager for the FlagMailRecipient model
+    """
+
+    def set_last_digest(self, email, when):
+        """
+        Save the date of the last digest sent to the given email address
+        """
+        if self.filter(email=email).update(last_digest=when):
+            return
+        sid = transaction.savepoint(using=self.db)
+        try:
+            self.create(email=email, last_digest=when)
+        except IntegrityError:
+            # created in the meantime
+            transaction.savepoint_rollback(sid, using=self.db)
+            self.filter(email=email).update(last_digest=when)
+        else:
+            transaction.savepoint_commit(sid, using=self.db)
+
+
+class FlagMailRecipient(models.Model):
+    """
+    Date of the last digest sent to a recipient, to check the
+    SEND_MAILS_DIGEST_MIN_INTERVAL settings
+    """
+
+    email = models.EmailField(unique=True)
+    last_digest = models.DateTimeField()
+
+    objects = FlagMailRecipientManager()
+
+    def __unicode__(self):
+        """
+        Show the email address and the date of the last digest
+        """
+        return u'last digest to %s at %s' % (self.email, self.last_digest)
+
+
+class FlagInstanceArchive(models.Model):
+    """
+    Flag moved out of the FlagInstance table by the retention (see the
+    RETENTION_DAYS settings) in the 'archive' mode, with the same id
+    """
+
+    id = models.PositiveIntegerField(primary_key=True)
+    flagged_content = models.ForeignKey(FlaggedContent,
+                                        related_name='archived_flags')
+    user = models.ForeignKey(User, related_name='archived_flags')
+    when_added = models.DateTimeField()
+    comment = models.TextField(null=True, blank=True)
+    status = models.PositiveSmallIntegerField(default=1)
+    when_archived = models.DateTimeField(auto_now=False, auto_now_add=True)
+
+    def __unicode__(self):
+        """
+        Show the flagged content and the user
+        """
+        return u'archived flag on flagged content #%s by user #%s' % (
+                self.flagged_content_id, self.user_id)
+
+
+class FlagInstanceAggregateManager(models.Manager):
+    """
+    Manager for the FlagInstanceAggregate model, adding an `add_flags`
+    method
+    """
+
+    def add_flags(self, keys):
+        """
+        Add a flag in the aggregates for each `(flagged_content_id, day,
+        status)` tuple of the given list, creating the missing aggregates
+        """
+        counts = {}
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+
+        existing = {}
+        for id, flagged_content_id, day, status in self.filter(
+                flagged_content__in=set([key[0] for key in counts]),
+                day__in=set([key[1] for key in counts]))\
+                .values_list('id', 'flagged_content', 'day', 'status'):
+            existing[(flagged_content_id, day, status)] = id
+
+        by_increment, missing = {}, []
+        for key, count in counts.items():
+            if key in existing:
+                by_increment.setdefault(count, []).append(existing[key])
+            else:
+                missing.append(FlagInstanceAggregate(flagged_content_id=key[0],
+                                                     day=key[1],
+                                                     status=key[2],
+                                                     count=count))
+        for increment, ids in by_increment.items():
+            self.filter(id__in=ids).update(
+                    count=models.F('count') + increment)
+        bulk_create(FlagInstanceAggregate, missing)
+
+
+class FlagInstanceAggregate(models.Model):
+    """
+    Number of flags, for a flagged content, a day and a status, removed from
+    the FlagInstance table by the retention (see the RETENTION_DAYS settings)
+    in the 'aggregate' mode
+    """
+
+    flagged_content = models.ForeignKey(FlaggedContent,
+                                        related_name='aggregated_flags')
+    day = models.DateField()
+    status = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    objects = FlagInstanceAggregateManager()
+
+    class Meta:
+        unique_together = [("flagged_content", "day", "status")]
+
+    def __unicode__(self):
+        """
+        Show the flagged content, the day, the status and the count
+        """
+        return u'%s flags with status %s on flagged content #%s on %s' % (
+                self.count, self.status, self.flagged_content_id, self.day)
+
+
 def add_flag(flagger, content_type, object_id, content_creator, comment,
         status=None, send_signal=True, send_mails=True):
     """
@@ -0,0 +1,153 @@
+"""
+Moderation queue: the flagged contents with a given status (the first one
+by default), optionally of a model or of a creator, ordered by update date
+or by priority, and read by pages starting after a cursor (keyset paging on
+the sort key and `id`) instead of an offset, and without counting them, so
+the cost of a page doesn't depend on its position or on the size of the
+queue. Each filter and order matches a composite index ending with
+`(when_updated, id)` or `(priority, id)` (see `flag/sql/flaggedcontent.sql`),
+except the priority order of the flagged contents of a creator.
+Used by the moderation queue of the admin (html and json).
+"""
+from datetime import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+
+from flag import settings as flag_settings
+from flag.models import FlaggedContent
+from flag.utils import get_content_type_tuple, get_content_type_id
+
+# format of the `when_updated` part of the cursors
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+# orders of the queue: sort key, and is it descending ?
+ORDERS = {
+    'oldest': ('when_updated', False),
+    'newest': ('when_updated', True),
+    'priority': ('priority', True),
+}
+
+
+def parse_filters(status=None, content_type=None, creator=None, order=None):
+    """
+    Return a dict with the filters to pass to `get_page`, from the given
+    strings (empty ones are ignored), or raise a ValueError if one is invalid
+    """
+    filters = {}
+    if status:
+        filters['status'] = int(status)
+    if content_type:
+        try:
+            filters['content_type'] = get_content_type_id(content_type)
+        except ContentType.DoesNotExist:
+            raise ValueError('Unknown content type %r' % content_type)
+    if creator:
+        filters['creator'] = int(creator)
+    if order:
+        if order not in ORDERS:
+            raise ValueError('Unknown order %r' % order)
+        filters['order'] = order
+    return filters
+
+
+def make_cursor(flagged_content, field):
+    """
+    Return the cursor of the page starting after the given flagged content,
+    for the given sort key
+    """
+    value = getattr(flagged_content, field)
+    if field == 'when_updated':
+        value = value.strftime(CURSOR_DATE_FORMAT)
+    else:
+        value = repr(value)
+    return '%s-%d' % (value, flagged_content.id)
+
+
+def parse_cursor(cursor, field):
+    """
+    Return the `(value of the sort key, id)` tuple of the given cursor, or
+    raise a ValueError if it's invalid
+    """
+    value, sep, id = cursor.rpartition('-')
+    if field == 'when_updated':
+        value = datetime.strptime(value, CURSOR_DATE_FORMAT)
+    else:
+        value = float(value)
+    return value, int(id)
+
+
+def get_page(status=None, content_type=None, creator=None, order='oldest',
+             cursor=None, per_page=50):
+    """
+    Return a tuple `(flagged_contents, next_cursor)` with one page of the
+    moderation queue, starting after the given `cursor` (a ValueError is
+    raised for an invalid one), and the cursor of the next page, or None if
+    it's the last one.
+    The queue can be filtered by status (default to the first one), by
+    content type (see `utils.get_content_type_tuple` for the accepted
+    values) and by creator (a user id), and ordered by update date, the
+    `oldest` (default) or the `newest` first, or by `priority` (see
+    `FlaggedContent.get_priority`).
+    The creators, moderators and flagged objects are loaded with the page.
+    """
+    if status is None:
+        status = flag_settings.STATUSES[0][0]
+    field, descending = ORDERS[order]
+
+    queryset = FlaggedContent.objects.filter(status=status)\
+            .select_related('creator', 'moderator')
+    if content_type is not None:
+        queryset = queryset.filter(
+                content_type=get_content_type_id(content_type))
+    if creator is not None:
+        queryset = queryset.filter(creator=creator)
+
+    if descending:
+        queryset = queryset.order_by('-%s' % field, '-id')
+        lookup = 'lt'
+    else:
+        queryset = queryset.order_by(field, 'id')
+        lookup = 'gt'
+    if cursor:
+        value, id = parse_cursor(cursor, field)
+        # the first condition gives the start of the range in the index
+        queryset = queryset.filter(**{
+                '%s__%se' % (field, lookup): value}).filter(
+                    Q(**{'%s__%s' % (field, lookup): value}) |
+                    Q(**{'id__%s' % lookup: id}))
+
+    flagged_contents = list(queryset[:per_page + 1])
+    next_cursor = None
+    if len(flagged_contents) > per_page:
+        flagged_contents = flagged_contents[:per_page]
+        next_cursor = make_cursor(flagged_contents[-1], field)
+    FlaggedContent.objects.load_content_objects(flagged_contents)
+    return flagged_contents, next_cursor
+
+
+def get_page_data(flagged_contents):
+    """
+    Return a list of dicts (to be serialized in json) describing the given
+    flagged contents (with their flagged objects loaded)
+    """
+    now = datetime.now()
+    data = []
+    for flagged_content in flagged_contents:
+        content_object = flagged_content.content_object
+        if content_object is not None:
+            content_object = unicode(content_object)
+        data.append({
+            'id': flagged_content.id,
+            'content_type': '%s.%s' % get_content_type_tuple(
+                    flagged_content.content_type_id),
+            'object_id': flagged_content.object_id,
+            'object': content_object,
+            'creator_id': flagged_content.creator_id,
+            'status': flagged_content.status,
+            'count': flagged_content.count,
+            'priority': flagged_content.get_priority(now),
+            'moderator_id': flagged_content.moderator_id,
+            'when_updated': flagged_content.when_updated.isoformat(),
+        })
+    return data
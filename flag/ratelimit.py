@@ -0,0 +1,79 @@
+"""
+Optional limit of the rate of flags of each user, for each model, checked
+by the views before any query (see the FLAG_RATE_LIMIT settings).
+Each user has, for each model, a bucket of `flags` tokens, stored in the
+cache defined by FLAG_RATE_LIMIT_CACHE, and refilled at the rate of `flags`
+tokens every `seconds` seconds. Each flag takes a token, and is rejected
+(with a FlagRateLimitExceeded exception) if the bucket is empty.
+The bucket is read and written without lock, so concurrent flags of the
+same user may take the same token: the limit is not exact, but it's enough
+to stop a user flagging a lot of objects from a script.
+"""
+import time
+
+from django.core.cache import get_cache
+from django.utils.translation import ugettext as _
+
+from flag import settings as flag_settings
+from flag.exceptions import FlagRateLimitExceeded
+from flag.utils import get_content_type_tuple
+
+KEY_PREFIX = 'flag:ratelimit'
+
+_backends = {}
+
+
+def get_backend():
+    """
+    Return the cache backend defined by the FLAG_RATE_LIMIT_CACHE settings
+    """
+    name = flag_settings.RATE_LIMIT_CACHE
+    if name not in _backends:
+        _backends[name] = get_cache(name)
+    return _backends[name]
+
+
+def _get_key(user, model):
+    """
+    Return the key of the bucket of the given user for the given model.
+    The model label is lowercased (like by `get_model`), so its case
+    variants, accepted by the views, share the same bucket.
+    """
+    return ('%s:%s:%s.%s' % ((KEY_PREFIX, user.id) +
+                             get_content_type_tuple(model))).lower()
+
+
+def check_rate(user, model, consume=True, now=None):
+    """
+    Take a token from the bucket of the user for the given model (see
+    `utils.get_content_type_tuple` for the accepted values), or only check
+    that there is one if `consume` is False, and raise a
+    FlagRateLimitExceeded exception if the bucket is empty.
+    Staff users are not limited.
+    """
+    rate = flag_settings.get_for_model(model, 'RATE_LIMIT')
+    if not rate or user.is_staff:
+        return
+    try:
+        key = _get_key(user, model)
+    except ValueError:
+        # invalid model, rejected by the view
+        return
+    flags, seconds = rate
+    backend = get_backend()
+    now = now or time.time()
+
+    tokens = flags
+    state = backend.get(key)
+    if state is not None:
+        tokens, when = state
+        tokens = min(flags, tokens + (now - when) * flags / float(seconds))
+
+    if tokens < 1:
+        raise FlagRateLimitExceeded(_('You are flagging too fast, please '
+                'retry in a few seconds'),
+                retry_after=(1 - tokens) * seconds / float(flags))
+
+    if consume:
+        # after `seconds` seconds, the bucket is full again
+        backend.set(key, (tokens - 1, now), seconds)
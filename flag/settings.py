@@ -11,7 +11,21 @@ __all__ = ('ALLOW_COMMENTS',
            'SEND_MAILS',
            'SEND_MAILS_TO',
            'SEND_MAILS_FROM',
-           'SEND_MAILS_RULES')
+           'SEND_MAILS_RULES',
+           'SEND_MAILS_QUEUED',
+           'SEND_MAILS_DIGEST',
+           'SEND_MAILS_DIGEST_MIN_INTERVAL',
+           'CACHE',
+           'CACHE_TIMEOUT',
+           'FORM_CACHE_TIMEOUT',
+           'RETENTION_DAYS',
+           'RETENTION_MODE',
+           'PRIORITY_HALF_LIFE',
+           'PRIORITY_WEIGHT',
+           'RATE_LIMIT',
+           'RATE_LIMIT_CACHE',
+           'IDEMPOTENCY_TIMEOUT',
+           'IDEMPOTENCY_CACHE')
 
 # keep the default values
 _DEFAULTS = dict(
@@ -30,7 +44,21 @@ _DEFAULTS = dict(
     SEND_MAILS_TO=conf.settings.ADMINS,
     SEND_MAILS_FROM=conf.settings.DEFAULT_FROM_EMAIL,
     SEND_MAILS_RULES=[(1, 1), ],
+    SEND_MAILS_QUEUED=False,
+    SEND_MAILS_DIGEST=0,
+    SEND_MAILS_DIGEST_MIN_INTERVAL=0,
     MODELS_SETTINGS={},
+    CACHE=None,
+    CACHE_TIMEOUT=300,
+    FORM_CACHE_TIMEOUT=0,
+    RETENTION_DAYS=0,
+    RETENTION_MODE='archive',
+    PRIORITY_HALF_LIFE=86400,
+    PRIORITY_WEIGHT=1,
+    RATE_LIMIT=None,
+    RATE_LIMIT_CACHE='default',
+    IDEMPOTENCY_TIMEOUT=300,
+    IDEMPOTENCY_CACHE='default',
 )
 
 # Set FLAG_ALLOW_COMMENTS to False in settings to not allow users to
@@ -100,6 +128,33 @@ SEND_MAILS_RULES = getattr(conf.settings,
                            "FLAG_SEND_MAILS_RULES",
                            _DEFAULTS['SEND_MAILS_RULES'])
 
+# Set FLAG_SEND_MAILS_QUEUED to True to not send mails while the flag is
+# added, but save them in an outbox (in the same transaction as the flag), to
+# be sent by the `flag_mail_worker` management command
+# Default to False : mails are sent when the flag is added
+SEND_MAILS_QUEUED = getattr(conf.settings,
+                            "FLAG_SEND_MAILS_QUEUED",
+                            _DEFAULTS['SEND_MAILS_QUEUED'])
+
+# Set FLAG_SEND_MAILS_DIGEST to a number of seconds to not send a mail for
+# each flag (matching the FLAG_SEND_MAILS_RULES rules), but collect them and
+# send, at the end of each window of this number of seconds, only one mail to
+# each recipient, with all the flags of the window. These mails are sent by
+# the `flag_mail_worker` management command (see FLAG_SEND_MAILS_QUEUED)
+# Default to 0 : no digest
+SEND_MAILS_DIGEST = getattr(conf.settings,
+                            "FLAG_SEND_MAILS_DIGEST",
+                            _DEFAULTS['SEND_MAILS_DIGEST'])
+
+# Set FLAG_SEND_MAILS_DIGEST_MIN_INTERVAL to a number of seconds to limit the
+# rate of digests sent to each recipient (whatever the model): a digest is
+# not sent to a recipient before this number of seconds after the previous
+# one (the flags are kept for the next one)
+# Default to 0 : no limit
+SEND_MAILS_DIGEST_MIN_INTERVAL = getattr(conf.settings,
+                                 "FLAG_SEND_MAILS_DIGEST_MIN_INTERVAL",
+                                 _DEFAULTS['SEND_MAILS_DIGEST_MIN_INTERVAL'])
+
 # Use FLAG_MODELS_SETTINGS if you want to override the global settings for a
 # specific model.
 # It's a dict with the string represetation of the model (`myapp.mymodel`) as
@@ -111,11 +166,113 @@ MODELS_SETTINGS = getattr(conf.settings,
                           "FLAG_MODELS_SETTINGS",
                           _DEFAULTS['MODELS_SETTINGS'])
 
+# Set FLAG_CACHE to the name of a cache defined in the CACHES settings to
+# store the status and count of flagged objects in this cache, shared between
+# all processes. This cache is updated each time a flag is added or a status
+# updated.
+# Default to None : no cache used
+CACHE = getattr(conf.settings, "FLAG_CACHE", _DEFAULTS['CACHE'])
+
+# Set FLAG_CACHE_TIMEOUT to the number of seconds the status and count of an
+# object are kept in the cache defined by FLAG_CACHE
+# Default to 300 seconds
+CACHE_TIMEOUT = getattr(conf.settings,
+                        "FLAG_CACHE_TIMEOUT",
+                        _DEFAULTS['CACHE_TIMEOUT'])
+
+# Set FLAG_FORM_CACHE_TIMEOUT to a number of seconds to keep in the cache
+# defined by FLAG_CACHE the forms rendered by the `flag_in_list`
+# templatetag, for each object, user and flag update.
+# As the forms include a timestamp valid for 2 hours, it must be far lower.
+# Default to 0 : the forms are not cached
+FORM_CACHE_TIMEOUT = getattr(conf.settings,
+                             "FLAG_FORM_CACHE_TIMEOUT",
+                             _DEFAULTS['FORM_CACHE_TIMEOUT'])
+
+# Set FLAG_RETENTION_DAYS to a number of days to keep the flags only this
+# number of days on the resolved flagged contents (with a status which is not
+# the first one of FLAG_STATUSES): the `flag_retention` management command
+# moves the older ones out of the flags table (see FLAG_RETENTION_MODE). The
+# counts are not changed.
+# Default to 0 : the flags are kept forever
+RETENTION_DAYS = getattr(conf.settings,
+                         "FLAG_RETENTION_DAYS",
+                         _DEFAULTS['RETENTION_DAYS'])
+
+# Set FLAG_RETENTION_MODE to define what to do with the flags older than
+# FLAG_RETENTION_DAYS : 'archive' to move them in the FlagInstanceArchive
+# table, or 'aggregate' to only keep, in the FlagInstanceAggregate table, the
+# number of flags for each flagged content, day and status
+# Default to 'archive'
+RETENTION_MODE = getattr(conf.settings,
+                         "FLAG_RETENTION_MODE",
+                         _DEFAULTS['RETENTION_MODE'])
+
+# Set FLAG_PRIORITY_HALF_LIFE to the number of seconds after which a flag
+# counts for half in the priority of its flagged content (the priority is the
+# sum of the weights of its flags, with an exponential decay, and is used to
+# order the moderation queue by urgency)
+# This setting cannot be overridden by model (the priorities of different
+# half-lives could not be compared)
+# Default to 86400 seconds (one day)
+PRIORITY_HALF_LIFE = getattr(conf.settings,
+                             "FLAG_PRIORITY_HALF_LIFE",
+                             _DEFAULTS['PRIORITY_HALF_LIFE'])
+
+# Set FLAG_PRIORITY_WEIGHT to the weight of a new flag in the priority of its
+# flagged content (see FLAG_PRIORITY_HALF_LIFE), to give more priority to the
+# flags of some models (0 to not update the priority)
+# Default to 1
+PRIORITY_WEIGHT = getattr(conf.settings,
+                          "FLAG_PRIORITY_WEIGHT",
+                          _DEFAULTS['PRIORITY_WEIGHT'])
+
+# Set FLAG_RATE_LIMIT to a tuple `(flags, seconds)` to limit the rate of
+# flags of each user, for each model: a user can add `flags` flags at once,
+# then one every `seconds / flags` seconds. The flags over the limit are
+# rejected by the views, before any query (with a 429 response). Staff users
+# are not limited
+# Default to None : no limit
+RATE_LIMIT = getattr(conf.settings,
+                     "FLAG_RATE_LIMIT",
+                     _DEFAULTS['RATE_LIMIT'])
+
+# Set FLAG_RATE_LIMIT_CACHE to the name of the cache, defined in the CACHES
+# settings, in which the rate of flags of each user is stored (see
+# FLAG_RATE_LIMIT). It must be shared between all processes (not locmem)
+# Default to 'default'
+RATE_LIMIT_CACHE = getattr(conf.settings,
+                           "FLAG_RATE_LIMIT_CACHE",
+                           _DEFAULTS['RATE_LIMIT_CACHE'])
+
+# Set FLAG_IDEMPOTENCY_TIMEOUT to the number of seconds an idempotency key
+# of a flag is kept: the flags added again with the same key (by the same
+# user) during this time are not added but the first one is returned (for
+# the resends of a form, see the README)
+# Set it to 0 to ignore the idempotency keys
+# Default to 300 seconds
+IDEMPOTENCY_TIMEOUT = getattr(conf.settings,
+                              "FLAG_IDEMPOTENCY_TIMEOUT",
+                              _DEFAULTS['IDEMPOTENCY_TIMEOUT'])
+
+# Set FLAG_IDEMPOTENCY_CACHE to the name of the cache, defined in the CACHES
+# settings, in which the idempotency keys are stored (see
+# FLAG_IDEMPOTENCY_TIMEOUT). It must be shared between all processes (not
+# locmem)
+# Default to 'default'
+IDEMPOTENCY_CACHE = getattr(conf.settings,
+                            "FLAG_IDEMPOTENCY_CACHE",
+                            _DEFAULTS['IDEMPOTENCY_CACHE'])
+
 # do not send mails if no recipients
 if SEND_MAILS and not SEND_MAILS_TO:
     SEND_MAILS = False
 
-_ONLY_GLOBAL_SETTINGS = ('MODELS', 'MODELS_SETTINGS',)
+_ONLY_GLOBAL_SETTINGS = ('MODELS', 'MODELS_SETTINGS', 'CACHE',
+                         'CACHE_TIMEOUT', 'FORM_CACHE_TIMEOUT',
+                         'SEND_MAILS_DIGEST_MIN_INTERVAL',
+                         'PRIORITY_HALF_LIFE', 'RATE_LIMIT_CACHE',
+                         'IDEMPOTENCY_TIMEOUT', 'IDEMPOTENCY_CACHE')
 
 
 def get_for_model(model, name):
@@ -2,3 +2,10 @@ from django.dispatch import Signal
 
 content_flagged = Signal(providing_args=["flagged_content",
                                          "flagged_instance"])
+
+contents_flagged = Signal(providing_args=["flagged_contents",
+                                          "flag_instances"])
+
+contents_moderated = Signal(providing_args=["flagged_content_ids",
+                                            "status",
+                                            "moderator"])
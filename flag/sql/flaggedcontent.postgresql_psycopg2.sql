@@ -0,0 +1,3 @@
+-- partial index on the flagged contents with the status 1 only (the ones
+-- not moderated yet) of a model, ordered by update date
+CREATE INDEX flag_fc_open_ct_updated ON flag_flaggedcontent (content_type_id, when_updated) WHERE status = 1;
@@ -0,0 +1,19 @@
+-- composite indexes for the most frequent queries on flag_flaggedcontent
+-- (executed by syncdb after the creation of the table, see migrations.sql
+-- for existing databases)
+
+-- flagged contents with a given status, ordered by id
+CREATE INDEX flag_fc_status_id ON flag_flaggedcontent (status, id);
+-- flagged contents of a model with a given status, ordered by id
+CREATE INDEX flag_fc_ct_status_id ON flag_flaggedcontent (content_type_id, status, id);
+-- flagged contents with a given status, ordered by update date (and id,
+-- for the moderation queue)
+CREATE INDEX flag_fc_status_updated_id ON flag_flaggedcontent (status, when_updated, id);
+-- flagged contents of a model, or of a creator, with a given status, ordered
+-- by update date and id (moderation queue)
+CREATE INDEX flag_fc_ct_status_updated_id ON flag_flaggedcontent (content_type_id, status, when_updated, id);
+CREATE INDEX flag_fc_creator_status_updated_id ON flag_flaggedcontent (creator_id, status, when_updated, id);
+-- flagged contents (of a model) with a given status, ordered by priority and
+-- id (moderation queue)
+CREATE INDEX flag_fc_status_priority_id ON flag_flaggedcontent (status, priority, id);
+CREATE INDEX flag_fc_ct_status_priority_id ON flag_flaggedcontent (content_type_id, status, priority, id);
@@ -0,0 +1,3 @@
+-- partial index on the flags with the status 1 only (the ones counted),
+-- used to compute the number of flags by user
+CREATE INDEX flag_fi_counted_fc_user ON flag_flaginstance (flagged_content_id, user_id) WHERE status = 1;
@@ -0,0 +1,8 @@
+-- composite indexes for the most frequent queries on flag_flaginstance
+-- (executed by syncdb after the creation of the table, see migrations.sql
+-- for existing databases)
+
+-- flags of a flagged content by a user (with a given status)
+CREATE INDEX flag_fi_fc_user_status ON flag_flaginstance (flagged_content_id, user_id, status);
+-- flags of a flagged content, ordered by date
+CREATE INDEX flag_fi_fc_when_added ON flag_flaginstance (flagged_content_id, when_added);
@@ -0,0 +1,5 @@
+-- indexes for the mails to send, in order, and for the digests of each
+-- recipient (executed by syncdb after the creation of the table, see
+-- migrations.sql for existing databases)
+CREATE INDEX flag_fm_failed_next_try ON flag_flagmail (failed, next_try);
+CREATE INDEX flag_fm_recipient_next_try ON flag_flagmail (recipient, next_try);
@@ -1,12 +1,27 @@
 from django import template
 from django.db.models import ObjectDoesNotExist
+from django.template.loader import get_template
+from django.utils.hashcompat import md5_constructor
+from django.utils.safestring import mark_safe
 
+from flag import settings as flag_settings
+from flag import cache as flag_cache
 from flag.forms import get_default_form
 from flag.views import get_next, get_confirm_url_for_object
-from flag.models import FlaggedContent
+from flag import memo
+from flag.models import FlaggedContent, PREFETCH_CACHE_ATTR
+from flag.utils import get_content_type_id
 
 register = template.Library()
 
+# placeholders used in the forms rendered by `flag_in_list`, replaced by the
+# values of each object
+OBJECT_PK_PLACEHOLDER = '__flag_object_pk__'
+SECURITY_HASH_PLACEHOLDER = '__flag_security_hash__'
+CSRF_TOKEN_PLACEHOLDER = '__flag_csrf_token__'
+
+_csrf_token_template = template.Template('{% csrf_token %}')
+
 
 @register.inclusion_tag("flag/flag_form.html", takes_context=True)
 def flag(context, content_object, creator_field=None, with_status=False):
@@ -32,6 +47,153 @@ def flag_with_status(context, content_object, creator_field=None):
     return flag(context, content_object, creator_field, True)
 
 
+def _render_csrf_token(csrf_token):
+    """
+    Return the html of the `csrf_token` templatetag for the given token
+    """
+    if not csrf_token:
+        return u''
+    return _csrf_token_template.render(
+            template.Context(dict(csrf_token=csrf_token)))
+
+
+def _get_csrf_token_replacement(context):
+    """
+    Return the html of the `csrf_token` templatetag with the placeholder,
+    and with the real token, computed once during the rendering of the
+    template
+    """
+    key = 'flag_csrf_token'
+    if key not in context.render_context:
+        context.render_context[key] = (
+                _render_csrf_token(CSRF_TOKEN_PLACEHOLDER),
+                _render_csrf_token(context.get('csrf_token', None)))
+    return context.render_context[key]
+
+
+def _get_form_skeleton(context, content_object, creator_field, with_status,
+                       next):
+    """
+    Return the form for the model of the given object, and the html of this
+    form with placeholders for the values specific to each object (and for
+    the csrf token).
+    They are computed only once for each model during the rendering of the
+    template, and stored in its `render_context`
+    """
+    key = ('flag_form_skeleton', str(content_object._meta), creator_field,
+           bool(with_status), next)
+    if key not in context.render_context:
+        form = get_default_form(content_object, creator_field, with_status)
+        form.initial['object_pk'] = OBJECT_PK_PLACEHOLDER
+        form.initial['security_hash'] = SECURITY_HASH_PLACEHOLDER
+        html = get_template("flag/flag_form.html").render(
+                template.Context(dict(form=form,
+                                      next=next,
+                                      csrf_token=CSRF_TOKEN_PLACEHOLDER),
+                                 autoescape=context.autoescape))
+        context.render_context[key] = (form, html)
+    return context.render_context[key]
+
+
+def _get_form_cache_key(backend, content_object, user, creator_field,
+                        with_status, next):
+    """
+    Return the key used to store the form rendered by `flag_in_list` for the
+    given object and user, which change each time the object is flagged, or
+    None if its FlaggedContent was not already loaded (by `prefetch_flags`,
+    or in the request memo): a query for each object would cost more than
+    rendering the form.
+    """
+    if hasattr(content_object, PREFETCH_CACHE_ATTR):
+        flagged_content = getattr(content_object, PREFETCH_CACHE_ATTR)
+    else:
+        flagged_content = memo.get_flagged_content(
+                get_content_type_id(content_object),
+                content_object._get_pk_val())
+        if flagged_content is memo.MISSING:
+            return None
+    if flagged_content is None:
+        when_updated = 0
+    else:
+        when_updated = flagged_content.when_updated.strftime(
+                '%Y%m%d%H%M%S%f')
+    options = md5_constructor(repr((creator_field, bool(with_status),
+                                    next))).hexdigest()
+    return flag_cache.make_key(backend, 'form', str(content_object._meta),
+            content_object._get_pk_val(), getattr(user, 'id', None) or 0,
+            when_updated, options)
+
+
+@register.simple_tag(takes_context=True)
+def flag_in_list(context, content_object, creator_field=None,
+                 with_status=False):
+    """
+    This templatetag works like the `flag` one, but is made to be used many
+    times in the same template (in a list of objects) : the form template is
+    rendered only once for each model, and only the values specific to each
+    object are changed.
+    If the FLAG_FORM_CACHE_TIMEOUT settings is set (with FLAG_CACHE), the
+    form is cached for each object, user and flag update, if the flags of
+    the objects were loaded before (with `prefetch_flags`).
+    Usage : {% flag_in_list an_object %}
+    """
+    if not content_object:
+        return ''
+    request = context.get('request', None)
+    next = get_next(request)
+
+    form, skeleton = _get_form_skeleton(context, content_object,
+                                        creator_field, with_status, next)
+
+    html, cache_key = None, None
+    backend = flag_cache.get_backend()
+    if backend and flag_settings.FORM_CACHE_TIMEOUT:
+        cache_key = _get_form_cache_key(backend, content_object,
+                getattr(request, 'user', None), creator_field, with_status,
+                next)
+        html = backend.get(cache_key)
+
+    if html is None:
+        object_pk = str(content_object._get_pk_val())
+        security_hash = form.generate_security_hash(
+                form.initial['content_type'], object_pk,
+                form.initial['timestamp'])
+        html = skeleton.replace(OBJECT_PK_PLACEHOLDER, object_pk)\
+                       .replace(SECURITY_HASH_PLACEHOLDER, security_hash)
+        if cache_key:
+            backend.set(cache_key, html, flag_settings.FORM_CACHE_TIMEOUT)
+
+    # the csrf token is never cached
+    return mark_safe(html.replace(*_get_csrf_token_replacement(context)))
+
+
+@register.simple_tag(takes_context=True)
+def flag_with_status_in_list(context, content_object, creator_field=None):
+    """
+    Helper for the `flag_in_list` templatetag, which set `with_status` to True
+    """
+    return flag_in_list(context, content_object, creator_field, True)
+
+
+@register.simple_tag(takes_context=True)
+def prefetch_flags(context, content_objects, user=None):
+    """
+    This templatetag will load, in a constant number of queries, the flags
+    data for all the given objects (which can be of different models), to be
+    used by the `flag_count`, `flag_status` and `can_be_flagged_by` filters.
+    The flags count for the given user (or the user of the request in the
+    context) is also loaded.
+    Usage : {% prefetch_flags object_list %}
+    Or, with a user : {% prefetch_flags object_list request.user %}
+    """
+    if user is None:
+        request = context.get('request', None)
+        user = getattr(request, 'user', None)
+    if content_objects:
+        FlaggedContent.objects.prefetch_for_objects(content_objects, user)
+    return ''
+
+
 @register.filter
 def flag_count(content_object):
     """
@@ -39,7 +201,8 @@ def flag_count(content_object):
     Usage : {{ some_object|flag_count }}
     """
     try:
-        return FlaggedContent.objects.get_for_object(content_object).count
+        state = FlaggedContent.objects.get_state_for_object(content_object)
+        return state[1] if state else 0
     except:
         return 0
 
@@ -53,10 +216,13 @@ def flag_status(content_object, full=False):
     Usage : {{ some_object|flag_status:"text" }}
     """
     try:
-        flagged_content = FlaggedContent.objects.get_for_object(content_object)
+        state = FlaggedContent.objects.get_state_for_object(content_object)
+        if not state:
+            return None
         if full:
-            return flagged_content.get_status_display()
-        return flagged_content.status
+            return FlaggedContent.objects.get_status_display(content_object,
+                                                             state[0])
+        return state[0]
     except:
         return None
 
@@ -20,3 +20,9 @@ class ModelWithAuthor(models.Model):
 
     def __unicode__(self):
         return self.name
+
+
+class ProxyModelWithoutAuthor(ModelWithoutAuthor):
+
+    class Meta:
+        proxy = True
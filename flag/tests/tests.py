@@ -1,30 +1,53 @@
-from datetime import datetime
+from datetime import date, datetime, timedelta
 from copy import copy
 import time
+import math
+import re
+import os
+import sys
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.contrib.auth.models import User, AnonymousUser
 from django.contrib.contenttypes.models import ContentType
-from django.db import IntegrityError
+from django.db import IntegrityError, connection, transaction
 from django.core.management import call_command
-from django.db.models import loading, ObjectDoesNotExist
+from django.db.models import loading, ObjectDoesNotExist, Sum
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 from django.core import mail
-
-from flag.models import FlaggedContent, FlagInstance, add_flag
-from flag.tests.models import ModelWithoutAuthor, ModelWithAuthor
+from django.core.mail.backends import locmem
+from django.template import Template, Context
+from django.test.signals import template_rendered
+from django.utils import simplejson
+from django.utils.safestring import mark_safe
+from django.utils.unittest import skipUnless
+from StringIO import StringIO
+
+from flag.models import (FlaggedContent, FlagInstance, UserFlagCount,
+        FlagMail, FlagMailRecipient, add_flag, get_priority_sql)
+from flag.tests.models import (ModelWithoutAuthor, ModelWithAuthor,
+        ProxyModelWithoutAuthor)
 from flag import settings as flag_settings
 from flag.exceptions import *
-from flag.signals import content_flagged
+from flag.signals import (content_flagged, contents_flagged,
+                          contents_moderated)
+from flag.admin import InlineFlagInstance, FlaggedContentAdmin
+from flag import models as flag_models
+from flag import memo
+from flag import cache as flag_cache
+from flag import export as flag_export
+from flag import moderation
+from flag import ratelimit
+from flag import idempotency
 from flag.templatetags import flag_tags
 from flag.forms import (FlagForm, FlagFormWithCreator, get_default_form,
         FlagFormWithStatus, FlagFormWithCreatorAndStatus)
 from flag.views import (get_confirm_url_for_object,
                        get_content_object,
                        FlagBadRequest)
-from flag.utils import get_content_type_tuple
+from flag.utils import (get_content_type_tuple, get_content_type_id,
+        clear_content_types, compile_mail_rules, must_send_mail)
 
 
 class BaseTestCase(TestCase):
@@ -501,6 +524,58 @@ class ModelsTestCase(BaseTestCaseWithData):
         flag_instance = add(status=2)
         self.assertEqual(flag_instance.flagged_content.count, previous_count)
 
+    def test_add_queries(self):
+        """
+        Test the number of queries done to add a flag
+        """
+        # the new count is returned by the UPDATE query with postgresql
+        read_count = int(connection.vendor != 'postgresql')
+        ContentType.objects.get_for_model(self.model_without_author)
+
+        def add(status=None):
+            return FlagInstance.objects.add(self.user,
+                                            self.model_without_author,
+                                            comment='comment',
+                                            status=status)
+
+        # first flag: select and insert the flagged content, insert the flag,
+        # try to update and then insert the count by user, and update the
+        # count
+        with self.assertNumQueries(6 + read_count):
+            self.assertEqual(add().flagged_content.count, 1)
+
+        # next ones: select the flagged content, insert the flag, update the
+        # count by user, and update the count
+        with self.assertNumQueries(4 + read_count):
+            self.assertEqual(add().flagged_content.count, 2)
+
+        # a moderation: same thing, status and moderator in the same update
+        with self.assertNumQueries(3 + read_count):
+            flagged_content = add(status=2).flagged_content
+        self.assertEqual(flagged_content.count, 2)
+        self.assertEqual(flagged_content.status, 2)
+        self.assertEqual(flagged_content.moderator, self.user)
+        flagged_content = FlaggedContent.objects.get(id=flagged_content.id)
+        self.assertEqual(flagged_content.count, 2)
+        self.assertEqual(flagged_content.status, 2)
+        self.assertEqual(flagged_content.moderator_id, self.user.id)
+
+        # a limit by user needs to get the count by user
+        add(status=1)
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 10
+        with self.assertNumQueries(5 + read_count):
+            self.assertEqual(add().flagged_content.count, 4)
+
+        # during a request, the flagged content and the count by user are
+        # memoized
+        memo.activate()
+        try:
+            add()
+            with self.assertNumQueries(3 + read_count):
+                self.assertEqual(add().flagged_content.count, 6)
+        finally:
+            memo.deactivate()
+
     def test_count_flags_by_user(self):
         """
         Test if the count_flag_by_users is correct
@@ -514,6 +589,368 @@ class ModelsTestCase(BaseTestCaseWithData):
             self._add_flag(flagged_content, 'comment')
         self.assertEqual(flagged_content.count_flags_by_user(self.user), 10)
 
+    def test_user_flag_count(self):
+        """
+        Test the counts of flags by user, and their rebuild
+        """
+        flagged_content = self._add_flagged_content(self.model_without_author)
+        for i in range(0, 3):
+            self._add_flag(flagged_content, 'comment')
+        self._add_flag(flagged_content, 'comment', status=2)
+        self.assertEqual(UserFlagCount.objects.get_count(flagged_content,
+                                                         self.user), 3)
+        self.assertEqual(UserFlagCount.objects.get_count(flagged_content,
+                                                         self.author), 0)
+
+        # the limit check only reads the count
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 3
+        flagged_content = FlaggedContent.objects.get_for_object(
+                self.model_without_author)
+        with self.assertNumQueries(1):
+            self.assertRaises(ContentAlreadyFlaggedByUserException,
+                              flagged_content.assert_can_be_flagged_by_user,
+                              self.user)
+
+        # deleted flags, and flags with another status, are not counted
+        flags = list(FlagInstance.objects.filter(user=self.user, status=1))
+        flags[0].delete()
+        flags[1].status = 2
+        flags[1].save()
+        self.assertEqual(UserFlagCount.objects.get_count(flagged_content,
+                                                         self.user), 1)
+        flagged_content.assert_can_be_flagged_by_user(self.user)
+        flags[1].status = 1
+        flags[1].save()
+        self.assertEqual(UserFlagCount.objects.get_count(flagged_content,
+                                                         self.user), 2)
+        FlagInstance.objects.filter(user=self.user, status=2).delete()
+        self.assertEqual(UserFlagCount.objects.get_count(flagged_content,
+                                                         self.user), 2)
+
+        # rebuild
+        UserFlagCount.objects.all().update(count=10)
+        FlagInstance.objects.create(flagged_content=flagged_content,
+                                    user=self.author, comment='comment')
+        UserFlagCount.objects.filter(user=self.author).delete()
+        call_command('flag_rebuild_user_counts', stdout=StringIO(),
+                     chunk_size=1)
+        self.assertEqual(dict(UserFlagCount.objects.values_list('user',
+                                                                'count')),
+                         {self.user.id: 2, self.author.id: 1})
+
+    def test_reconcile_counts(self):
+        """
+        Test the `flag_reconcile` command, fixing wrong counts
+        """
+        without_author = self._add_flagged_content(self.model_without_author)
+        with_author = self._add_flagged_content(self.model_with_author)
+        for i in range(0, 3):
+            self._add_flag(without_author, 'comment')
+        self._add_flag(without_author, 'moderation', status=2)
+        self._add_flag(with_author, 'comment')
+        FlaggedContent.objects.filter(id=without_author.id).update(count=10)
+        FlagInstance.objects.filter(flagged_content=with_author).delete()
+
+        def reconcile(**options):
+            stdout = StringIO()
+            call_command('flag_reconcile', stdout=stdout, verbosity=2,
+                         chunk_size=1, **options)
+            return stdout.getvalue()
+
+        self.assertEqual(reconcile(),
+                         'flagged content #%d: count 10, 3 flags\n'
+                         'flagged content #%d: count 1, 0 flags\n'
+                         '2 flagged contents checked, 2 wrong counts, '
+                         '0 fixed\n' % (without_author.id, with_author.id))
+        self.assertTrue(reconcile(fix=True).endswith(
+                '2 flagged contents checked, 2 wrong counts, 2 fixed\n'))
+        self.assertEqual(dict(FlaggedContent.objects.values_list('id',
+                                                                 'count')),
+                         {without_author.id: 3, with_author.id: 0})
+        self.assertEqual(reconcile(),
+                         '2 flagged contents checked, 0 wrong counts, '
+                         '0 fixed\n')
+
+        # only the flagged contents updated or flagged since a date
+        FlaggedContent.objects.update(when_updated=datetime(2012, 1, 1))
+        FlagInstance.objects.update(when_added=datetime(2012, 1, 1))
+        FlagInstance.objects.filter(id=FlagInstance.objects.filter(
+                flagged_content=without_author, status=1)[0].id).update(
+                    when_added=datetime(2012, 3, 1))
+        FlaggedContent.objects.update(count=5)
+        self.assertEqual(reconcile(fix=True, since='2012-02-01'),
+                         'flagged content #%d: count 5, 3 flags\n'
+                         '1 flagged contents checked, 1 wrong counts, '
+                         '1 fixed\n' % without_author.id)
+
+    def test_reconcile_counts_concurrent_flag(self):
+        """
+        Test that a count changed by a flag added while the flags are
+        counted is not fixed with a wrong value
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 0
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        flagged_content = FlaggedContent.objects.get_for_object(
+                self.model_without_author)
+        user, model, added = self.user, self.model_without_author, []
+
+        class RacingSum(Sum):
+            # the flag is added after the flags in the table are counted
+            def add_to_query(self, *args, **kwargs):
+                if not added:
+                    added.append(FlagInstance.objects.add(user, model,
+                                                          comment='comment'))
+                return super(RacingSum, self).add_to_query(*args, **kwargs)
+
+        original_sum = flag_models.Sum
+        flag_models.Sum = RacingSum
+        try:
+            checked, mismatches, fixed = FlaggedContent.objects\
+                    .reconcile_counts(flagged_content.id,
+                                      flagged_content.id + 1, fix=True)
+        finally:
+            flag_models.Sum = original_sum
+        self.assertEqual(len(added), 1)
+        self.assertEqual((checked, fixed), (1, 0))
+        self.assertEqual(FlaggedContent.objects.get(
+                id=flagged_content.id).count, 2)
+
+    def test_retention(self):
+        """
+        Test that the old flags of resolved flagged contents are archived,
+        or aggregated, and that the counts stay right
+        """
+        flagged_contents = [self._add_flagged_content(obj) for obj in (
+                self.model_without_author, self.model_with_author,
+                self.author)]
+        for flagged_content in flagged_contents:
+            for i in range(0, 2):
+                self._add_flag(flagged_content, 'comment %d' % i)
+        for flagged_content in flagged_contents[:2]:
+            self._add_flag(flagged_content, 'moderation', status=2)
+        FlaggedContent.objects.filter(id__in=[flagged_content.id
+                for flagged_content in flagged_contents[:2]]).update(status=2)
+        FlagInstance.objects.update(when_added=datetime(2012, 1, 1, 12))
+        recent = self._add_flag(flagged_contents[0], 'recent', status=2)
+        # the moderation flags added with `create` are counted
+        call_command('flag_reconcile', fix=True, stdout=StringIO())
+
+        flag_settings.RETENTION_DAYS = 30
+        flag_settings.MODELS_SETTINGS = {
+                'tests.modelwithauthor': dict(RETENTION_MODE='aggregate')}
+        try:
+            stdout = StringIO()
+            call_command('flag_retention', stdout=stdout, batch_size=2)
+            self.assertEqual(stdout.getvalue(),
+                             '3 flags archived, 3 flags aggregated\n')
+
+            # only the recent flag and the ones of the open flagged content
+            # are kept
+            self.assertEqual(sorted(FlagInstance.objects.values_list(
+                        'flagged_content', flat=True)),
+                    [flagged_contents[0].id, flagged_contents[2].id,
+                     flagged_contents[2].id])
+            self.assertEqual(FlagInstance.objects.filter(
+                    flagged_content=flagged_contents[0]).get().id, recent.id)
+            self.assertEqual(sorted(flagged_contents[0].archived_flags
+                                    .values_list('comment', 'status')),
+                    [('comment 0', 1), ('comment 1', 1), ('moderation', 2)])
+            self.assertEqual(sorted(flagged_contents[1].aggregated_flags
+                                    .values_list('day', 'status', 'count')),
+                    [(date(2012, 1, 1), 1, 2), (date(2012, 1, 1), 2, 1)])
+
+            # aggregates are incremented by the next runs
+            flag = self._add_flag(FlaggedContent.objects.get(
+                    id=flagged_contents[1].id), 'moderation 2', status=2)
+            FlagInstance.objects.filter(id=flag.id).update(
+                    when_added=datetime(2012, 1, 1, 14))
+            FlagInstance.objects.apply_retention()
+            self.assertEqual(flagged_contents[1].aggregated_flags.get(
+                    status=2).count, 2)
+        finally:
+            flag_settings.MODELS_SETTINGS = {}
+
+        # the counts are not changed, and still right
+        self.assertEqual([FlaggedContent.objects.get(
+                    id=flagged_content.id).count
+                for flagged_content in flagged_contents], [2, 2, 2])
+        stdout = StringIO()
+        call_command('flag_reconcile', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '3 flagged contents checked, '
+                         '0 wrong counts, 0 fixed\n')
+
+        # the counts by user of the aggregated flags are kept
+        call_command('flag_rebuild_user_counts', stdout=StringIO())
+        self.assertEqual(sorted(UserFlagCount.objects.values_list(
+                    'flagged_content', 'count')),
+                sorted([(flagged_content.id, 2)
+                        for flagged_content in flagged_contents]))
+
+    def test_priority(self):
+        """
+        Test that the priority is updated by each counted flag, with a decay,
+        and that it orders the moderation queue
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 0
+        flag_settings.PRIORITY_HALF_LIFE = 3600
+        flag_settings.MODELS_SETTINGS = {
+                'tests.modelwithauthor': dict(PRIORITY_WEIGHT=3,
+                                              PRIORITY_HALF_LIFE=60)}
+        try:
+            for i in range(0, 2):
+                FlagInstance.objects.add(self.user, self.model_without_author,
+                                         comment='comment')
+            without_author = FlaggedContent.objects.get_for_object(
+                    self.model_without_author)
+            self.assertAlmostEqual(without_author.get_priority(), 2, 2)
+            self.assertEqual(FlaggedContent.objects.get(
+                    id=without_author.id).priority, without_author.priority)
+            # each flag counts for half after one hour
+            now = datetime.now()
+            self.assertAlmostEqual(without_author.get_priority(
+                    now + timedelta(hours=1)), 1, 2)
+
+            FlagInstance.objects.add(self.user, self.model_with_author,
+                                     comment='comment')
+            with_author = FlaggedContent.objects.get_for_object(
+                    self.model_with_author)
+            self.assertAlmostEqual(with_author.get_priority(), 3, 2)
+            # the half-life is only global
+            self.assertAlmostEqual(with_author.get_priority(
+                    now + timedelta(hours=1)), 1.5, 2)
+
+            # older flags count less
+            FlagInstance.objects.bulk_add([
+                    (self.user, self.author, 'comment', None),
+                    (self.author, self.author, 'comment', None)])
+            FlaggedContent.objects.filter(content_type=get_content_type_id(
+                    User)).update(priority=FlaggedContent.objects.get(
+                        content_type=get_content_type_id(User)).priority -
+                    math.log(2) * 2)
+            by_author = FlaggedContent.objects.get(
+                    content_type=get_content_type_id(User))
+            self.assertAlmostEqual(by_author.get_priority(), 0.5, 2)
+
+            self.assertEqual([flagged_content.id for flagged_content in
+                              moderation.get_page(order='priority')[0]],
+                             [with_author.id, without_author.id, by_author.id])
+            self.assertEqual(FlaggedContent().get_priority(), 0)
+
+            # the flags not counted don't change the priority
+            priority = without_author.priority
+            FlagInstance.objects.add(self.staff_user,
+                                     self.model_without_author,
+                                     comment='moderation', status=2)
+            self.assertEqual(FlaggedContent.objects.get(
+                    id=without_author.id).priority, priority)
+        finally:
+            flag_settings.MODELS_SETTINGS = {}
+
+    def test_priority_without_weight(self):
+        """
+        Test that the flags of a model with a weight of 0 are counted, but
+        don't change the priority
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 0
+        flag_settings.MODELS_SETTINGS = {
+                'tests.modelwithoutauthor': dict(PRIORITY_WEIGHT=0)}
+        try:
+            FlagInstance.objects.add(self.user, self.model_without_author,
+                                     comment='comment')
+            FlagInstance.objects.bulk_add([
+                    (self.user, self.model_without_author, 'comment', None),
+                    (self.user, self.model_with_author, 'comment', None)])
+        finally:
+            flag_settings.MODELS_SETTINGS = {}
+        without_weight = FlaggedContent.objects.get_for_object(
+                self.model_without_author)
+        self.assertEqual((without_weight.count, without_weight.priority),
+                         (2, 0))
+        self.assertNotEqual(FlaggedContent.objects.get_for_object(
+                self.model_with_author).priority, 0)
+
+    def test_priority_range(self):
+        """
+        Test that the priority is updated without underflow (an error on
+        postgresql, also raised by the EXP function of the sqlite
+        connections) when the priority is empty or far from the new term
+        """
+        # the first counted flag
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        flagged_content = FlaggedContent.objects.get_for_object(
+                self.model_without_author)
+        self.assertAlmostEqual(flagged_content.get_priority(), 1, 2)
+
+        term = flagged_content.get_priority_term(1, datetime.now())
+        qn = connection.ops.quote_name
+        for priority, expected in ((0, term), (term - 2000, term),
+                                   (term + 2000, term + 2000),
+                                   (term, term + math.log(2))):
+            FlaggedContent.objects.filter(id=flagged_content.id).update(
+                    priority=priority)
+            connection.cursor().execute('UPDATE %s SET %s = %s WHERE %s = %%s'
+                    % (qn(FlaggedContent._meta.db_table), qn('priority'),
+                       get_priority_sql(connection, term), qn('id')),
+                    [flagged_content.id])
+            self.assertAlmostEqual(FlaggedContent.objects.get(
+                    id=flagged_content.id).priority, expected, 6)
+
+    def test_idempotency_key(self):
+        """
+        Test that a flag added with an idempotency key is added only once
+        """
+        model = self.model_without_author
+        try:
+            flag = FlagInstance.objects.add(self.user, model, comment='foo',
+                                            idempotency_key='key')
+            self.assertFalse(flag.replayed)
+            replayed = FlagInstance.objects.add(self.user, model,
+                    comment='foo', idempotency_key='key')
+            self.assertEqual(replayed.id, flag.id)
+            self.assertTrue(replayed.replayed)
+            self.assertEqual(FlaggedContent.objects.get_for_object(
+                    model).count, 1)
+            # the keys are by user
+            self.assertNotEqual(FlagInstance.objects.add(self.author, model,
+                    comment='foo', idempotency_key='key').id, flag.id)
+
+            # the key is released on error
+            flag_settings.ALLOW_COMMENTS = False
+            self.assertRaises(FlagCommentException, FlagInstance.objects.add,
+                              self.user, model, comment='foo',
+                              idempotency_key='other')
+            flag_settings.ALLOW_COMMENTS = True
+            self.assertNotEqual(FlagInstance.objects.add(self.user, model,
+                    comment='foo', idempotency_key='other').id, flag.id)
+
+            # a resend during the first call waits for it
+            idempotency.get_backend().set(idempotency._get_key(self.user,
+                    idempotency.get_flag_key('pending', model, 'foo')),
+                    idempotency.PENDING)
+            self.assertRaises(FlagInProgressException,
+                              FlagInstance.objects.add, self.user, model,
+                              comment='foo', idempotency_key='pending')
+
+            # the same key for another object, or another comment
+            other_flag = FlagInstance.objects.add(self.user,
+                    self.model_with_author, comment='foo',
+                    idempotency_key='key')
+            self.assertFalse(other_flag.replayed)
+            self.assertEqual(other_flag.flagged_content.object_id,
+                             self.model_with_author.id)
+            self.assertFalse(FlagInstance.objects.add(self.user, model,
+                    comment='bar', idempotency_key='key').replayed)
+
+            flag_settings.IDEMPOTENCY_TIMEOUT = 0
+            FlagInstance.objects.add(self.user, model, comment='foo',
+                                     idempotency_key='key')
+            self.assertEqual(FlaggedContent.objects.get_for_object(
+                    model).count, 5)
+        finally:
+            idempotency.get_backend().clear()
+
     def test_moderator(self):
         """
         Test the set of the last moderator
@@ -577,6 +1014,151 @@ class ModelsTestCase(BaseTestCaseWithData):
 
         clear_received_signal()
 
+    def test_bulk_add(self):
+        """
+        Test the addition of many flags at once, with the rules of `add`
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_RULES = [(1, 1), (2, 3)]
+        self._add_flag(self._add_flagged_content(self.model_without_author),
+                       'old')
+        FlaggedContent.objects.filter(object_id=self.model_without_author.id)\
+                .update(count=1)
+
+        records = [
+            (self.user, self.model_without_author, 'one', None),
+            # the limit by user is raised
+            (self.user, self.model_without_author, 'two', None),
+            (self.author, self.model_without_author, 'three', None),
+            # a comment is needed
+            (self.author, self.model_with_author, None, None),
+            (self.author, self.model_with_author, 'four', None),
+            (self.user, self.model_with_author, 'five', None),
+            (self.staff_user, self.model_with_author, 'moderation', 2),
+            # not counted, the status is now 2
+            (self.user, self.model_with_author, 'six', None),
+        ]
+        received = []
+
+        def receive_signal(sender, signal, **kwargs):
+            received.append(kwargs)
+        contents_flagged.connect(receive_signal)
+        mail.outbox = []
+        try:
+            flag_instances, errors = FlagInstance.objects.bulk_add(records,
+                    send_signal=True, send_mails=True, chunk_size=5)
+        finally:
+            contents_flagged.disconnect(receive_signal)
+
+        self.assertEqual([flag_instance.comment
+                          for flag_instance in flag_instances],
+                         ['one', 'three', 'four', 'five', 'moderation',
+                          'six'])
+        self.assertEqual([(record[2], e.__class__) for record, e in errors],
+                         [('two', ContentAlreadyFlaggedByUserException),
+                          (None, FlagCommentException)])
+
+        without_author = FlaggedContent.objects.get_for_object(
+                self.model_without_author)
+        with_author = FlaggedContent.objects.get_for_object(
+                self.model_with_author)
+        self.assertEqual((without_author.count, without_author.status), (3, 1))
+        self.assertEqual((with_author.count, with_author.status,
+                          with_author.moderator_id),
+                         (2, 2, self.staff_user.id))
+        self.assertEqual(sorted(with_author.flag_instances.values_list(
+                    'comment', 'status')),
+                [('five', 1), ('four', 1), ('moderation', 2), ('six', 2)])
+        self.assertEqual(sorted(UserFlagCount.objects.values_list(
+                    'flagged_content', 'user', 'count')),
+                sorted([(without_author.id, self.user.id, 2),
+                        (without_author.id, self.author.id, 1),
+                        (with_author.id, self.author.id, 1),
+                        (with_author.id, self.user.id, 1)]))
+
+        # mails for the counts 2 (not 3) without author, and 1 and 2 with
+        # author
+        self.assertEqual(sorted([message.body.split('Total flags: ')[1][0]
+                                 for message in mail.outbox]),
+                         ['1', '2', '2'])
+        self.assertEqual(len(received), 1)
+        self.assertEqual(len(received[0]['flag_instances']), 6)
+        self.assertEqual(len(received[0]['flagged_contents']), 2)
+
+        # the number of queries doesn't depend on the number of records
+        if hasattr(FlagInstance.objects, 'bulk_create'):
+            users = [User.objects.create_user('%s-bulk-%s' % (
+                        self.USER_BASE, i), 'bulk-%s@example.com' % i)
+                     for i in range(0, 20)]
+            self.assertNumQueries(6, FlagInstance.objects.bulk_add,
+                    [(user, self.model_without_author, 'bulk', None)
+                        for user in users])
+            self.assertEqual(FlaggedContent.objects.get_for_object(
+                    self.model_without_author).count, 23)
+
+    def test_set_status(self):
+        """
+        Test the status change of many flagged contents at once
+        """
+        flagged_contents = [self._add_flagged_content(obj) for obj in (
+                self.model_without_author, self.model_with_author,
+                self.author)]
+        self._add_flag(flagged_contents[0], 'comment')
+        flagged_contents[0].count = 1
+        flagged_contents[0].save()
+        queryset = FlaggedContent.objects.filter(
+                id__in=[fc.id for fc in flagged_contents[:2]])
+
+        # no bulk change to the first status, only valid statuses
+        self.assertRaises(ValueError, FlaggedContent.objects.set_status,
+                          queryset, 1, self.staff_user, 'comment')
+        self.assertRaises(ValueError, FlaggedContent.objects.set_status,
+                          queryset, 6, self.staff_user, 'comment')
+        # a comment is needed
+        self.assertRaises(FlagCommentException,
+                          FlaggedContent.objects.set_status,
+                          queryset, 2, self.staff_user)
+
+        received = []
+
+        def receive_signal(sender, signal, **kwargs):
+            received.append(kwargs)
+        contents_moderated.connect(receive_signal)
+        try:
+            # chunks of 1 flagged content: 2 UPDATE + 2 INSERT + 1 SELECT
+            self.assertNumQueries(5, FlaggedContent.objects.set_status,
+                                  queryset, 2, self.staff_user, 'spam',
+                                  chunk_size=1)
+        finally:
+            contents_moderated.disconnect(receive_signal)
+
+        self.assertEqual(len(received), 1)
+        self.assertEqual(sorted(received[0]['flagged_content_ids']),
+                         sorted([fc.id for fc in flagged_contents[:2]]))
+        self.assertEqual(received[0]['status'], 2)
+        self.assertEqual(received[0]['moderator'], self.staff_user)
+
+        self.assertEqual(dict(FlaggedContent.objects.values_list(
+                    'id', 'status')),
+                {flagged_contents[0].id: 2, flagged_contents[1].id: 2,
+                 flagged_contents[2].id: 1})
+        self.assertEqual(FlaggedContent.objects.get(
+                id=flagged_contents[0].id).count, 1)
+        self.assertEqual(FlaggedContent.objects.filter(
+                moderator=self.staff_user).count(), 2)
+        self.assertEqual(sorted(FlagInstance.objects.filter(
+                    user=self.staff_user).values_list(
+                        'flagged_content', 'status', 'comment')),
+                sorted([(fc.id, 2, 'spam') for fc in flagged_contents[:2]]))
+
+        # the comment is not saved if comments are not allowed
+        flag_settings.ALLOW_COMMENTS = False
+        FlaggedContent.objects.set_status(FlaggedContent.objects.filter(
+                id=flagged_contents[2].id), 3, self.staff_user, 'spam')
+        self.assertEqual(FlagInstance.objects.get(
+                flagged_content=flagged_contents[2]).comment, None)
+
     def test_mails(self):
         """
         Test if mails are correctly send
@@ -652,6 +1234,274 @@ class ModelsTestCase(BaseTestCaseWithData):
         self.assertTrue("The flagged object was created by %s" % (
             self.model_with_author.author.username  in mail.outbox[0].body))
 
+    def test_mail_rules(self):
+        """
+        Test the compiled SEND_MAILS_RULES, and that moderation flags don't
+        send mails again
+        """
+        rules = [[1, 1], [4, 3], [10, 5]]
+        self.assertEqual([count for count in range(0, 26)
+                          if must_send_mail(rules, count)],
+                         [1, 2, 3, 4, 7, 10, 15, 20, 25])
+        self.assertTrue(compile_mail_rules(rules) is
+                        compile_mail_rules(tuple(map(tuple, rules))))
+        self.assertEqual([count for count in range(0, 10)
+                          if must_send_mail([(4, 0), (2, 2)], count)],
+                         [2])
+        self.assertFalse(must_send_mail([], 1))
+
+        flag_settings.SEND_MAILS = True
+        mail.outbox = []
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', send_mails=True)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertTrue("Total flags: 1" in mail.outbox[0].body)
+        FlagInstance.objects.add(self.staff_user, self.model_without_author,
+                                 comment='comment', status=2,
+                                 send_mails=True)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_queued_mails(self):
+        """
+        Test mails saved in the outbox and sent by the worker
+        """
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_QUEUED = True
+        mail.outbox = []
+
+        for i in range(0, 2):
+            FlagInstance.objects.add(self.user, self.model_without_author,
+                                     comment='comment', send_mails=True)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(list(FlagMail.objects.order_by('id').values_list(
+                'count', flat=True)), [1, 2])
+
+        # send them
+        self.assertEqual(FlagMail.objects.send_pending(), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertTrue("Total flags: 1" in mail.outbox[0].body)
+        self.assertTrue("Total flags: 2" in mail.outbox[1].body)
+        self.assertEqual(FlagMail.objects.count(), 0)
+        self.assertEqual(FlagMail.objects.send_pending(), (0, 0))
+
+        # kept while mails are disabled
+        mail.outbox = []
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', send_mails=True)
+        flag_settings.SEND_MAILS = False
+        try:
+            self.assertEqual(FlagMail.objects.send_pending(), (0, 0))
+        finally:
+            flag_settings.SEND_MAILS = True
+        self.assertEqual(FlagMail.objects.count(), 1)
+        FlagMail.objects.update(next_try=datetime.now())
+        self.assertEqual(FlagMail.objects.send_pending(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+
+        # errors
+        mail.outbox = []
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', send_mails=True)
+
+        def send_messages(self, messages):
+            raise IOError('mail server down')
+
+        original_send_messages = locmem.EmailBackend.send_messages
+        locmem.EmailBackend.send_messages = send_messages
+        try:
+            self.assertEqual(FlagMail.objects.send_pending(backoff=0,
+                                                           max_tries=2),
+                             (0, 0))
+            flag_mail = FlagMail.objects.get()
+            self.assertEqual(flag_mail.tries, 1)
+            self.assertFalse(flag_mail.failed)
+            self.assertTrue('mail server down' in flag_mail.last_error)
+
+            # not tried again before the backoff
+            FlagMail.objects.update(next_try=datetime(2100, 1, 1))
+            self.assertEqual(FlagMail.objects.send_pending(), (0, 0))
+            self.assertEqual(FlagMail.objects.get().tries, 1)
+
+            # failed after `max_tries` tries
+            FlagMail.objects.update(next_try=datetime.now())
+            self.assertEqual(FlagMail.objects.send_pending(backoff=0,
+                                                           max_tries=2),
+                             (0, 1))
+            self.assertTrue(FlagMail.objects.get().failed)
+            self.assertEqual(FlagMail.objects.send_pending(), (0, 0))
+        finally:
+            locmem.EmailBackend.send_messages = original_send_messages
+        self.assertEqual(len(mail.outbox), 0)
+
+        # worker command
+        FlagMail.objects.all().delete()
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment', send_mails=True)
+        stdout = StringIO()
+        call_command('flag_mail_worker', stdout=stdout)
+        self.assertEqual(stdout.getvalue(), '1 mails sent, 0 failed\n')
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_digest_mails(self):
+        """
+        Test mails collected in digests for each recipient
+        """
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_TO = ['foo@example.com',
+                                       ('Bar', 'bar@example.com')]
+        mail.outbox = []
+        flag_settings.MODELS_SETTINGS = {
+            'tests.modelwithoutauthor': dict(SEND_MAILS_DIGEST=60)}
+        try:
+            self._test_digest_mails()
+        finally:
+            flag_settings.MODELS_SETTINGS = {}
+
+    def _test_digest_mails(self):
+        """
+        Body of `test_digest_mails`, with a digest for `ModelWithoutAuthor`
+        """
+
+        def add(flagged_object):
+            return FlagInstance.objects.add(self.user, flagged_object,
+                                            comment='comment',
+                                            send_mails=True)
+
+        for i in range(0, 3):
+            add(self.model_without_author)
+        # not in digest
+        add(self.model_with_author)
+        self.assertEqual(len(mail.outbox), 1)
+
+        # one mail by recipient for each flag, to send at the end of the
+        # window
+        self.assertEqual(FlagMail.objects.count(), 6)
+        self.assertEqual(set(FlagMail.objects.values_list('recipient',
+                                                          flat=True)),
+                         set(['foo@example.com', 'bar@example.com']))
+        next_try = FlagMail.objects.values_list('next_try', flat=True)[0]
+        self.assertTrue(next_try > datetime.now())
+        self.assertEqual(next_try.second, 0)
+        self.assertEqual(FlagMail.objects.send_pending(), (0, 0))
+
+        # end of the window: one mail by recipient
+        mail.outbox = []
+        FlagMail.objects.update(next_try=datetime.now())
+        self.assertEqual(FlagMail.objects.send_pending(), (2, 0))
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox),
+                         ['bar@example.com', 'foo@example.com'])
+        self.assertTrue('3 objects were flagged' in mail.outbox[0].subject)
+        for count in range(1, 4):
+            self.assertTrue('Total flags: %d' % count in mail.outbox[0].body)
+        self.assertEqual(FlagMail.objects.count(), 0)
+        self.assertEqual(FlagMailRecipient.objects.count(), 2)
+
+        # too soon for a new digest
+        flag_settings.SEND_MAILS_DIGEST_MIN_INTERVAL = 3600
+        mail.outbox = []
+        add(self.model_without_author)
+        FlagMail.objects.update(next_try=datetime.now())
+        self.assertEqual(FlagMail.objects.send_pending(), (0, 0))
+        self.assertEqual(len(mail.outbox), 0)
+        last_digest = FlagMailRecipient.objects.values_list('last_digest',
+                                                            flat=True)[0]
+        self.assertEqual(set(FlagMail.objects.values_list('next_try',
+                                                          flat=True)),
+                         set([last_digest + timedelta(seconds=3600)]))
+
+    def test_content_type_registry(self):
+        """
+        Test the resolution of content types
+        """
+        content_type_ids = [ContentType.objects.get_for_model(model).id
+                            for model in (ModelWithAuthor, ModelWithoutAuthor)]
+        flag_settings.MODELS = ('tests.modelwithauthor',
+                                'tests.modelwithoutauthor')
+        clear_content_types()
+
+        # all the models of FLAG_MODELS in one query
+        with self.assertNumQueries(1):
+            self.assertEqual(get_content_type_tuple(content_type_ids[0]),
+                             ('tests', 'modelwithauthor'))
+            self.assertEqual(get_content_type_tuple(str(content_type_ids[1])),
+                             ('tests', 'modelwithoutauthor'))
+            self.assertEqual(get_content_type_id('tests.modelwithauthor'),
+                             content_type_ids[0])
+            self.assertEqual(get_content_type_id(self.model_without_author),
+                             content_type_ids[1])
+        self.assertEqual(get_content_type_tuple(ModelWithAuthor),
+                         ('tests', 'modelwithauthor'))
+
+        # other content types
+        user_content_type = ContentType.objects.get_for_model(User)
+        self.assertEqual(get_content_type_id('auth.user'),
+                         user_content_type.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_content_type_tuple(user_content_type.id),
+                             ('auth', 'user'))
+
+        # a proxy model has the content type of its concrete model
+        self.assertEqual(get_content_type_id(ProxyModelWithoutAuthor),
+                         content_type_ids[1])
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        self.assertEqual(list(FlaggedContent.objects.filter_for_model(
+                ProxyModelWithoutAuthor, True)),
+                [self.model_without_author.id])
+
+        # subclasses of the accepted types
+        self.assertEqual(get_content_type_tuple(mark_safe(u'auth.user')),
+                         ('auth', 'user'))
+        self.assertEqual(get_content_type_tuple(mark_safe(
+                str(user_content_type.id))), ('auth', 'user'))
+
+        # errors
+        self.assertRaises(ValueError, get_content_type_tuple, 'foobar')
+        self.assertRaises(ValueError, get_content_type_tuple, object())
+        self.assertRaises(ContentType.DoesNotExist, get_content_type_id,
+                          'foo.bar')
+
+        # filter_for_model doesn't join the content types table
+        self._add_flagged_content(self.model_with_author)
+        queryset = FlaggedContent.objects.filter_for_model(ModelWithAuthor)
+        self.assertFalse('django_content_type' in str(queryset.query))
+        with self.assertNumQueries(1):
+            self.assertEqual(len(queryset), 1)
+        self.assertEqual(list(FlaggedContent.objects.filter_for_model(
+                'foo.bar', True)), [])
+
+    def test_content_object_not_loaded(self):
+        """
+        Test that the flagged object is only loaded when really needed
+        """
+        flagged_content = self._add_flagged_content(self.model_with_author,
+                                                    self.author)
+        get_content_type_tuple(flagged_content.content_type_id)
+        flag_instance = self._add_flag(flagged_content, 'comment')
+
+        flagged_content = FlaggedContent.objects.get(id=flagged_content.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(unicode(flagged_content),
+                             u'tests.modelwithauthor #%s' %
+                                self.model_with_author.id)
+            self.assertEqual(flagged_content.content_settings('STATUSES'),
+                             flag_settings.STATUSES)
+            self.assertEqual(flagged_content.get_status_display(),
+                             dict(flag_settings.STATUSES)[1])
+            flagged_content.get_content_object_admin_url()
+            flagged_content.get_creator_admin_url()
+        # only the check of the existence of the row, and the update
+        with self.assertNumQueries(2):
+            flagged_content.save()
+
+        flag_instance = FlagInstance.objects.select_related(
+                'flagged_content').get(id=flag_instance.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(unicode(flag_instance),
+                             u'flag on tests.modelwithauthor #%s by user #%s' %
+                                (self.model_with_author.id, self.user.id))
+
     def test_get_for_object(self):
         """
         Test the get_for_object helper
@@ -666,6 +1516,30 @@ class ModelsTestCase(BaseTestCaseWithData):
         self.assertEqual(flagged_content,
             FlaggedContent.objects.get_for_object(self.model_without_author))
 
+    def test_get_for_objects(self):
+        """
+        Test the get_for_objects helper
+        """
+        objects = [self.model_without_author, self.model_with_author]
+
+        # nothing flagged
+        self.assertEqual(FlaggedContent.objects.get_for_objects(objects), {})
+        self.assertEqual(FlaggedContent.objects.get_for_objects([]), {})
+
+        # flag only one object
+        flagged_content = self._add_flagged_content(self.model_with_author)
+        content_type = ContentType.objects.get_for_model(
+                self.model_with_author)
+        self.assertEqual(FlaggedContent.objects.get_for_objects(objects),
+                {(content_type.id, self.model_with_author.id):
+                    flagged_content})
+
+        # objects of many models in only one query
+        self._add_flagged_content(self.model_without_author)
+        with self.assertNumQueries(1):
+            result = FlaggedContent.objects.get_for_objects(objects)
+        self.assertEqual(len(result), 2)
+
     def test_get_or_create_for_object(self):
         """
         Test the get_or_create_for_object
@@ -888,6 +1762,102 @@ class FlagTemplateTagsTestCase(BaseTestCaseWithData):
         self.assertFalse(flag_tags.can_be_flagged_by(self.model_with_author,
                                                      Exception))
 
+    def test_prefetch_flags(self):
+        """
+        Test the `prefetch_flags` templatetag
+        """
+        objects = [self.model_without_author, self.model_with_author]
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+
+        flagged_content = self._add_flagged_content(self.model_with_author)
+        self._add_flag(flagged_content, comment='comment')
+
+        template = Template('{% load flag_tags %}'
+                            '{% prefetch_flags objects user %}')
+        self.assertEqual(template.render(Context(dict(objects=objects,
+                                                      user=self.user))), '')
+
+        # all filters now use prefetched data
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_count(self.model_with_author), 1)
+            self.assertEqual(flag_tags.flag_count(self.model_without_author),
+                             0)
+            self.assertEqual(flag_tags.flag_status(self.model_with_author),
+                             flag_settings.STATUSES[0][0])
+            self.assertEqual(unicode(flag_tags.flag_status(
+                                self.model_with_author, True)),
+                             unicode(flag_settings.STATUSES[0][1]))
+            self.assertEqual(
+                    flag_tags.flag_status(self.model_without_author), None)
+            self.assertTrue(flag_tags.can_be_flagged_by(
+                    self.model_with_author, self.user))
+            self.assertTrue(flag_tags.can_be_flagged_by(
+                    self.model_without_author, self.user))
+
+        # prefetched data are updated when a flag is added
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_count(self.model_with_author), 2)
+            self.assertFalse(flag_tags.can_be_flagged_by(
+                    self.model_with_author, self.user))
+
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        self.assertEqual(flag_tags.flag_count(self.model_without_author), 1)
+
+    def test_request_memo(self):
+        """
+        Test that the filters use the request memo
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+
+        def use_all_filters(content_object):
+            flag_tags.flag_count(content_object)
+            flag_tags.flag_status(content_object)
+            flag_tags.flag_status(content_object, True)
+            flag_tags.can_be_flagged_by(content_object, self.user)
+
+        flagged_content = self._add_flagged_content(self.model_with_author)
+        self._add_flag(flagged_content, comment='comment')
+        ContentType.objects.get_for_model(self.model_without_author)
+
+        # outside a request, nothing is memoized
+        self.assertFalse(memo.is_active())
+
+        memo.activate()
+        try:
+            # one query for the flagged content, and one for the user's count
+            with self.assertNumQueries(2):
+                use_all_filters(self.model_with_author)
+                use_all_filters(self.model_with_author)
+
+            # negative results are memoized too
+            with self.assertNumQueries(1):
+                use_all_filters(self.model_without_author)
+                use_all_filters(self.model_without_author)
+
+            # adding a flag updates the memo
+            FlagInstance.objects.add(self.user, self.model_with_author,
+                                     comment='comment')
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                        flag_tags.flag_count(self.model_with_author), 2)
+                self.assertFalse(flag_tags.can_be_flagged_by(
+                        self.model_with_author, self.user))
+
+            FlagInstance.objects.add(self.user, self.model_without_author,
+                                     comment='comment')
+            with self.assertNumQueries(0):
+                self.assertEqual(
+                        flag_tags.flag_count(self.model_without_author), 1)
+        finally:
+            memo.deactivate()
+
+        # the memo is dropped at the end of each request
+        self.client.get('/')
+        self.assertFalse(memo.is_active())
+
     def test_flag_confirm_url(self):
         """
         Test the `flag_confirm_url` filter (and also urls btw)
@@ -967,6 +1937,229 @@ class FlagTemplateTagsTestCase(BaseTestCaseWithData):
         result = flag_tags.flag_with_status({}, self.model_without_author)
         self.assertTrue(isinstance(result['form'], FlagFormWithStatus))
 
+    def _render_flag_in_list(self, objects, csrf_token='csrf-token',
+                             prefetch=False):
+        """
+        Render the `flag_in_list` templatetag for each object (after the
+        `prefetch_flags` one if `prefetch` is True), and return the html and
+        the data posted by each form
+        """
+        template = '{% load flag_tags %}{% for obj in objects %}' \
+                   '{% flag_in_list obj %}{% endfor %}'
+        if prefetch:
+            template = template.replace('{% for',
+                                        '{% prefetch_flags objects %}{% for')
+        template = Template(template)
+        html = template.render(Context(dict(objects=objects,
+                                            csrf_token=csrf_token)))
+        forms = html.split('</form>')[:-1]
+        self.assertEqual(len(forms), len(objects))
+        forms_data = []
+        for form in forms:
+            forms_data.append(dict(re.findall(
+                    r'name="(content_type|object_pk|timestamp|'
+                    r'security_hash)" value="([^"]*)"', form)))
+        return html, forms_data
+
+    def test_flag_in_list(self):
+        """
+        Test the `flag_in_list` templatetag
+        """
+        objects = [self.model_without_author,
+                   ModelWithoutAuthor.objects.create(name='baz'),
+                   self.model_with_author]
+
+        rendered_templates = []
+
+        def template_rendered_listener(sender, template, **kwargs):
+            rendered_templates.append(template.name)
+        template_rendered.connect(template_rendered_listener)
+        try:
+            html, forms_data = self._render_flag_in_list(objects)
+        finally:
+            template_rendered.disconnect(template_rendered_listener)
+
+        # the form template is rendered only once per model
+        self.assertEqual(rendered_templates.count('flag/flag_form.html'), 2)
+
+        # each form is valid for its object
+        for obj, data in zip(objects, forms_data):
+            self.assertEqual(data['object_pk'], str(obj.pk))
+            form = FlagForm(target_object=obj,
+                            data=dict(data, comment='comment'))
+            self.assertTrue(form.is_valid())
+        self.assertEqual(html.count("value='csrf-token'"), 3)
+
+        # same forms as with the `flag` templatetag
+        form = flag_tags.flag({}, self.model_with_author)['form']
+        for name in form.fields:
+            self.assertTrue('name="%s"' % name in html)
+
+        # no object
+        self.assertEqual(flag_tags.flag_in_list({}, None), '')
+
+    def test_flag_in_list_cache(self):
+        """
+        Test the cache of the forms rendered by `flag_in_list`
+        """
+        flag_settings.CACHE = 'default'
+        flag_settings.FORM_CACHE_TIMEOUT = 60
+        flag_cache.get_backend().clear()
+        objects = [self.model_without_author]
+
+        # not cached without prefetched flags: no query for each object
+        self._render_flag_in_list(objects + [self.model_with_author])
+        with self.assertNumQueries(0):
+            self._render_flag_in_list(objects + [self.model_with_author])
+
+        html, forms_data = self._render_flag_in_list(objects, 'token1', True)
+        time.sleep(1)
+        html2, forms_data2 = self._render_flag_in_list(objects, 'token2',
+                                                       True)
+
+        # the same form is used, but not the same csrf token
+        self.assertEqual(forms_data, forms_data2)
+        self.assertTrue("value='token2'" in html2)
+        self.assertFalse("value='token1'" in html2)
+
+        # a new flag invalidates the cached form
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        html3, forms_data3 = self._render_flag_in_list(objects, 'token2',
+                                                       True)
+        self.assertNotEqual(forms_data[0]['timestamp'],
+                            forms_data3[0]['timestamp'])
+
+
+class FlagCacheTestCase(BaseTestCaseWithData):
+    """
+    Class to test the shared cache of flagged objects states
+    """
+
+    def setUp(self):
+        """
+        Use the default (local memory) cache
+        """
+        super(FlagCacheTestCase, self).setUp()
+        flag_settings.CACHE = 'default'
+        flag_cache.get_backend().clear()
+        ContentType.objects.get_for_model(self.model_without_author)
+        ContentType.objects.get_for_model(self.model_with_author)
+
+    def test_state_cached(self):
+        """
+        Test that the state is read from the cache, and updated on writes
+        """
+        # no cache: the database is used
+        flag_settings.CACHE = None
+        self.assertEqual(FlaggedContent.objects.get_state_for_object(
+                self.model_with_author), None)
+        flag_settings.CACHE = 'default'
+
+        # negative results are cached
+        with self.assertNumQueries(1):
+            self.assertEqual(flag_tags.flag_count(self.model_with_author), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_count(self.model_with_author), 0)
+            self.assertEqual(flag_tags.flag_status(self.model_with_author),
+                             None)
+
+        # adding a flag updates the cache
+        FlagInstance.objects.add(self.user, self.model_with_author,
+                                 comment='comment')
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_count(self.model_with_author), 1)
+            self.assertEqual(flag_tags.flag_status(self.model_with_author),
+                             flag_settings.STATUSES[0][0])
+
+        # and updating a status too
+        FlagInstance.objects.add(self.staff_user, self.model_with_author,
+                                 comment='comment', status=2)
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_status(self.model_with_author),
+                             2)
+            self.assertEqual(flag_tags.flag_count(self.model_with_author), 1)
+
+        # deleting too
+        FlaggedContent.objects.get_for_object(self.model_with_author).delete()
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_count(self.model_with_author), 0)
+
+    def test_generation(self):
+        """
+        Test that bumping the generation invalidates all entries
+        """
+        flagged_content = self._add_flagged_content(self.model_with_author)
+        self._add_flag(flagged_content, comment='comment')
+        self.assertEqual(flag_tags.flag_count(self.model_with_author), 1)
+
+        # update the database without the cache knowing it
+        FlaggedContent.objects.filter(id=flagged_content.id).update(count=5)
+        self.assertEqual(flag_tags.flag_count(self.model_with_author), 1)
+
+        flag_cache.bump_generation()
+        self.assertEqual(flag_tags.flag_count(self.model_with_author), 5)
+
+    def test_single_flight(self):
+        """
+        Test that when an other process is loading an entry, we wait for it
+        """
+        backend = flag_cache.get_backend()
+        content_type = ContentType.objects.get_for_model(
+                self.model_with_author)
+        key = flag_cache._get_key(backend, content_type.id,
+                                  self.model_with_author.id)
+        loaded = []
+
+        def load():
+            loaded.append(True)
+            return (1, 3)
+
+        # someone else is loading it, and set it while we wait
+        backend.add('%s:lock' % key, 1)
+        flag_cache.set_state(content_type.id, self.model_with_author.id,
+                             (1, 2))
+        self.assertEqual(flag_cache.get_state(content_type.id,
+                self.model_with_author.id, load), (1, 2))
+        self.assertEqual(loaded, [])
+
+        # someone else is loading it, but too slowly
+        backend.delete(key)
+        self.assertEqual(flag_cache.get_state(content_type.id,
+                self.model_with_author.id, load), (1, 3))
+        self.assertEqual(loaded, [True])
+
+        # we are the one loading it
+        backend.delete('%s:lock' % key)
+        self.assertEqual(flag_cache.get_state(content_type.id,
+                self.model_with_author.id, load), (1, 3))
+        self.assertEqual(backend.get(key), (1, 3))
+        self.assertEqual(backend.get('%s:lock' % key), None)
+
+    def test_warm_flag_cache(self):
+        """
+        Test the `warm_flag_cache` management command
+        """
+        for obj in (self.model_with_author, self.model_without_author):
+            flagged_content = self._add_flagged_content(obj)
+            self._add_flag(flagged_content, comment='comment')
+        flagged_content.status = 2
+        flagged_content.save()
+        flag_cache.bump_generation()
+
+        call_command('warm_flag_cache', stdout=StringIO())
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_count(self.model_with_author), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(flag_tags.flag_status(
+                    self.model_without_author), 2)
+
+        flag_cache.bump_generation()
+        call_command('warm_flag_cache', all=True, stdout=StringIO())
+        with self.assertNumQueries(0):
+            self.assertEqual(flag_tags.flag_status(
+                    self.model_without_author), 2)
+
 
 class FlagFormTestCase(BaseTestCaseWithData):
     """
@@ -1158,6 +2351,9 @@ class FlagViewsTestCase(BaseTestCaseWithData):
         """
         Test the "flag" view
         """
+        # the same form is sent again to add more flags
+        flag_settings.IDEMPOTENCY_TIMEOUT = 0
+
         # get default form data
         form = get_default_form(self.model_without_author)
         form_data = dict((key, form[key].value()) for key in form.fields)
@@ -1277,6 +2473,238 @@ class FlagViewsTestCase(BaseTestCaseWithData):
         self.assertEqual(flagged_content.status, 3)
         self.assertEqual(flagged_content.moderator.id, self.staff_user.id)
 
+    def test_rate_limit(self):
+        """
+        Test that the users flagging too fast are rejected before any query
+        on the flag tables
+        """
+        flag_settings.RATE_LIMIT = (2, 60)
+        flag_settings.IDEMPOTENCY_TIMEOUT = 0
+        flag_settings.MODELS_SETTINGS = {
+                'tests.modelwithauthor': dict(RATE_LIMIT=None)}
+        form = get_default_form(self.model_without_author)
+        form_data = dict((key, form[key].value()) for key in form.fields)
+        form_data.update(dict(csrf_token=None, comment='comment'))
+        url = reverse('flag')
+        confirm_url = get_confirm_url_for_object(self.model_without_author)
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+        try:
+            for i in range(0, 2):
+                resp = self.client.post(url, copy(form_data))
+                self.assertTrue(isinstance(resp, HttpResponseRedirect))
+            self.assertEqual(FlagInstance.objects.count(), 2)
+
+            use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            try:
+                resp = self.client.post(url, copy(form_data))
+                queries = [query['sql'] for query in connection.queries
+                           if 'flag_' in query['sql']]
+            finally:
+                connection.use_debug_cursor = use_debug_cursor
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp['Retry-After'], '30')
+            self.assertEqual(queries, [])
+            self.assertEqual(FlagInstance.objects.count(), 2)
+
+            resp = self.client.post(url, copy(form_data),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertEqual(resp.status_code, 429)
+            self.assertAlmostEqual(simplejson.loads(resp.content)[
+                    'retry_after'], 30, 0)
+            self.assertEqual(self.client.get(confirm_url).status_code, 429)
+
+            # the case variants of the model label share the same bucket
+            app_label, model = form_data['content_type'].split('.')
+            form_data['content_type'] = '%s.%s' % (app_label, model.upper())
+            resp = self.client.post(url, copy(form_data))
+            self.assertEqual(resp.status_code, 429)
+
+            # other models have their own limit
+            self.assertEqual(self.client.get(get_confirm_url_for_object(
+                    self.model_with_author)).status_code, 200)
+
+            # the bucket is refilled with the time
+            self.assertRaises(FlagRateLimitExceeded, ratelimit.check_rate,
+                              self.user, self.model_without_author,
+                              now=time.time() + 10)
+            self.assertNotRaises(ratelimit.check_rate, self.user,
+                                 self.model_without_author,
+                                 now=time.time() + 31)
+            self.assertNotRaises(ratelimit.check_rate, self.staff_user,
+                                 self.model_without_author)
+        finally:
+            flag_settings.MODELS_SETTINGS = {}
+            ratelimit.get_backend().clear()
+
+    def test_post_view_resent(self):
+        """
+        Test that a form sent again doesn't add a flag again, unless the
+        client gives another idempotency key, or another status or comment
+        is sent with the form
+        """
+        form = get_default_form(self.model_without_author)
+        form_data = dict((key, form[key].value()) for key in form.fields)
+        form_data.update(dict(csrf_token=None, comment='comment'))
+        url = reverse('flag')
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+        try:
+            for i in range(0, 2):
+                self.client.post(url, copy(form_data))
+            self.assertEqual(FlagInstance.objects.count(), 1)
+            data = copy(form_data)
+            data['comment'] = 'other comment'
+            self.client.post(url, data)
+            self.assertEqual(FlagInstance.objects.count(), 2)
+
+            for key in ('a', 'b', 'b'):
+                self.client.post(url, copy(form_data),
+                                 HTTP_X_IDEMPOTENCY_KEY=key)
+            data = copy(form_data)
+            data['idempotency_key'] = 'b'
+            self.client.post(url, data)
+            self.assertEqual(FlagInstance.objects.count(), 4)
+            self.assertEqual(FlaggedContent.objects.get_for_object(
+                    self.model_without_author).count, 4)
+
+            # the same form of status sent with another status
+            form = get_default_form(self.model_without_author,
+                                    with_status=True)
+            form_data = dict((key, form[key].value()) for key in form.fields)
+            form_data.update(dict(csrf_token=None, comment='moderation'))
+            self.client.login(username=self.staff_user.username,
+                              password=self.USER_BASE)
+            for status in (2, 3):
+                data = copy(form_data)
+                data['status'] = status
+                self.client.post(url, data)
+            self.assertEqual(FlaggedContent.objects.get_for_object(
+                    self.model_without_author).status, 3)
+        finally:
+            idempotency.get_backend().clear()
+
+    def test_json_view(self):
+        """
+        Test the "flag_json" view, returning the new state or an error code
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 2
+        form = get_default_form(self.model_without_author)
+        form_data = dict((key, form[key].value()) for key in form.fields)
+        form_data.update(dict(csrf_token=None, comment='comment'))
+        url = reverse('flag_json')
+
+        def post(key, **changes):
+            data = copy(form_data)
+            data.update(changes, idempotency_key=key)
+            resp = self.client.post(url, data)
+            self.assertEqual(resp['Content-Type'], 'application/json')
+            return resp.status_code, simplejson.loads(resp.content)
+
+        self.assertEqual(post('1'), (403, {'error': 'login_required',
+                'message': 'You must be logged in to flag'}))
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+        self.assertEqual(self.client.get(url).status_code, 405)
+
+        self.assertEqual(post('1'), (200, {'count': 1, 'status': 1,
+                                           'can_flag_again': True}))
+        self.assertEqual(post('2'), (200, {'count': 2, 'status': 1,
+                                           'can_flag_again': False}))
+        # a replay returns the current state
+        self.assertEqual(post('1'), (200, {'count': 2, 'status': 1,
+                                           'can_flag_again': False}))
+        status, data = post('3')
+        self.assertEqual((status, data['error']),
+                         (400, 'already_flagged_by_user'))
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+                self.model_without_author).count, 2)
+
+        status, data = post('4', comment='')
+        self.assertEqual((status, data['error']), (400, 'invalid_form'))
+        self.assertTrue('comment' in data['errors'])
+        self.assertEqual(post('5', security_hash='z' * 40)[1]['error'],
+                         'bad_request')
+        self.assertEqual(post('6', status='2'),
+                (403, {'error': 'only_staff_can_update_status',
+                       'message': "Only staff can update a flag's status"}))
+
+        flag_settings.RATE_LIMIT = (1, 60)
+        try:
+            post('7')
+            status, data = post('8')
+            self.assertEqual((status, data['error']),
+                             (429, 'rate_limit_exceeded'))
+            self.assertTrue(data['retry_after'] > 0)
+            data = copy(form_data)
+            data['idempotency_key'] = '9'
+            response = self.client.post(url, data)
+            self.assertTrue(int(response['Retry-After']) > 0)
+        finally:
+            ratelimit.get_backend().clear()
+            idempotency.get_backend().clear()
+
+    def test_states_view(self):
+        """
+        Test the "flag_states" view, with a fixed number of queries and an
+        ETag
+        """
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 1
+        FlagInstance.objects.add(self.user, self.model_without_author,
+                                 comment='comment')
+        keys = ['tests.modelwithoutauthor:%d' % self.model_without_author.id,
+                'tests.modelwithauthor:%d' % self.model_with_author.id]
+        url = reverse('flag_states')
+
+        def get(keys, **headers):
+            use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            try:
+                resp = self.client.get(url, {'keys': ','.join(keys)},
+                                       **headers)
+            finally:
+                connection.use_debug_cursor = use_debug_cursor
+            return resp, len(connection.queries)
+
+        # anonymous
+        resp = get(keys)[0]
+        self.assertEqual(simplejson.loads(resp.content)['states'][keys[1]],
+                         {'count': 0, 'status': None, 'can_flag': False})
+
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+        resp, num_queries = get(keys)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(simplejson.loads(resp.content), {'states': {
+                keys[0]: {'count': 1, 'status': 1, 'can_flag': False},
+                keys[1]: {'count': 0, 'status': None, 'can_flag': True}}})
+
+        # more objects, same number of queries
+        more_keys = keys + ['auth.user:%d' % user.id for user in
+                            (self.user, self.author, self.staff_user)]
+        for user in (self.author, self.staff_user):
+            self._add_flagged_content(user)
+        more_resp, more_num_queries = get(more_keys)
+        self.assertEqual(more_num_queries, num_queries)
+        self.assertEqual(len(simplejson.loads(more_resp.content)['states']),
+                         5)
+
+        # not modified
+        resp, num_queries_304 = get(keys, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+        self.assertTrue(num_queries_304 < num_queries)
+        FlagInstance.objects.add(self.author, self.model_without_author,
+                                 comment='comment')
+        resp = get(keys, HTTP_IF_NONE_MATCH=resp['ETag'])[0]
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(simplejson.loads(resp.content)['states'][keys[0]][
+                'count'], 2)
+
+        for keys in (['tests.foo:1'], ['tests.modelwithauthor:foo'],
+                     ['tests.modelwithauthor:1'] * 201):
+            self.assertEqual(get(keys)[0].status_code, 400)
+
     def test_add_flag_compatibility(self):
         """
         Test the old "add_flag" function, kept for compatibility
@@ -1291,3 +2719,631 @@ class FlagViewsTestCase(BaseTestCaseWithData):
         self.assertTrue(isinstance(flag_instance, FlagInstance))
         self.assertEqual(flag_instance.flagged_content.content_object,
                          self.model_with_author)
+
+
+class FlagExportTestCase(BaseTestCaseWithData):
+    """
+    Test the export of flags
+    """
+
+    def test_flag_export(self):
+        """
+        Test the `flag_export` command, with the filters and formats
+        """
+        without_author = self._add_flagged_content(self.model_without_author)
+        with_author = self._add_flagged_content(self.model_with_author)
+        flags = [self._add_flag(without_author, u'comment, "\xe9"'),
+                 self._add_flag(with_author, 'comment 2'),
+                 self._add_flag(without_author, 'moderation', status=2)]
+        FlagInstance.objects.filter(id=flags[0].id).update(
+                when_added=datetime(2012, 1, 1))
+
+        def export(**options):
+            stdout, stderr = StringIO(), StringIO()
+            call_command('flag_export', stdout=stdout, stderr=stderr,
+                         chunk_size=1, **options)
+            return stdout.getvalue(), stderr.getvalue()
+
+        output, summary = export()
+        self.assertEqual(summary, '3 flags exported\n')
+        lines = output.splitlines()
+        self.assertEqual(lines[0], ','.join(flag_export.FIELDS))
+        self.assertEqual(lines[1], '%d,2012-01-01T00:00:00,%d,1,'
+                         '"comment, ""\xc3\xa9""",%d,tests.modelwithoutauthor,'
+                         '%d,1,2' % (flags[0].id, self.user.id,
+                                     without_author.id,
+                                     self.model_without_author.id))
+        self.assertEqual([line.split(',')[0] for line in lines[2:]],
+                         [str(flags[1].id), str(flags[2].id)])
+
+        output = export(format='jsonl',
+                        content_type='tests.modelwithoutauthor',
+                        since='2012-01-02')[0]
+        rows = [simplejson.loads(line) for line in output.splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['id'], flags[2].id)
+        self.assertEqual(rows[0]['comment'], 'moderation')
+        self.assertEqual(rows[0]['content_type'], 'tests.modelwithoutauthor')
+
+        self.assertEqual(export(status='2', until='2012-01-02')[1],
+                         '0 flags exported\n')
+        self.assertRaises(ValueError, flag_export.parse_filters,
+                          since='yesterday')
+        self.assertRaises(ValueError, flag_export.parse_filters,
+                          content_type='tests.foo')
+
+        # constant memory: no model instances, and one query by chunk
+        rows = flag_export.iter_flags(chunk_size=2)
+        self.assertNumQueries(1, rows.next)
+        self.assertTrue(isinstance(rows.next(), tuple))
+        self.assertNumQueries(1, rows.next)
+        self.assertNumQueries(1, list, rows)
+
+
+class FlagModerationTestCase(BaseTestCaseWithData):
+    """
+    Test the moderation queue
+    """
+
+    def test_get_page(self):
+        """
+        Test the keyset paging of the queue, with the filters and orders
+        """
+        flagged_contents = [
+                self._add_flagged_content(self.model_without_author),
+                self._add_flagged_content(self.model_with_author, self.author),
+                self._add_flagged_content(self.author),
+                self._add_flagged_content(self.user, self.author)]
+        moderated = self._add_flagged_content(self.staff_user)
+        moderated.status = 2
+        moderated.save()
+        # same date for the two first ones, to check the paging on the ids
+        for flagged_content, day in zip(flagged_contents, (1, 1, 2, 3)):
+            FlaggedContent.objects.filter(id=flagged_content.id).update(
+                    when_updated=datetime(2012, 1, day))
+        ids = [flagged_content.id for flagged_content in flagged_contents]
+
+        def get_ids(**filters):
+            result, cursor = [], None
+            while True:
+                page, cursor = moderation.get_page(cursor=cursor, per_page=2,
+                                                   **filters)
+                result.extend(flagged_content.id for flagged_content in page)
+                if not cursor:
+                    return result
+
+        self.assertEqual(get_ids(), ids)
+        self.assertEqual(get_ids(order='newest'), ids[::-1])
+        self.assertEqual(get_ids(status=2), [moderated.id])
+        self.assertEqual(get_ids(content_type=User), ids[2:])
+        self.assertEqual(get_ids(creator=self.author.id, order='newest'),
+                         [ids[3], ids[1]])
+
+        page, cursor = moderation.get_page(per_page=3)
+        self.assertEqual(cursor, '20120102000000000000-%d' % ids[2])
+        # the flagged objects are loaded with the page
+        self.assertNumQueries(0, lambda: [flagged_content.content_object
+                                          for flagged_content in page])
+        self.assertEqual(moderation.get_page(per_page=4)[1], None)
+
+        self.assertRaises(ValueError, moderation.get_page, cursor='foo')
+        self.assertRaises(ValueError, moderation.parse_filters, order='count')
+        self.assertEqual(moderation.parse_cursor('-1.5-3', 'priority'),
+                         (-1.5, 3))
+        self.assertRaises(ValueError, moderation.parse_filters,
+                          content_type='tests.foo')
+        self.assertEqual(moderation.parse_filters(status='2', creator='',
+                                                  order='newest'),
+                         {'status': 2, 'order': 'newest'})
+
+
+class FlagAdminTestCase(BaseTestCaseWithData):
+    """
+    Test the admin of the flagged contents
+    """
+
+    def setUp(self):
+        """
+        Log in as a superuser
+        """
+        super(FlagAdminTestCase, self).setUp()
+        self.staff_user.is_superuser = True
+        self.staff_user.save()
+        self.client.login(username=self.staff_user.username,
+                          password=self.USER_BASE)
+        self.url = reverse('admin:flag_flaggedcontent_changelist')
+
+    def _get_changelist(self):
+        """
+        Return the number of queries done to get the changelist, and the
+        response
+        """
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get(self.url)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        # the queries are reset when the request starts
+        return len(connection.queries), response
+
+    def test_changelist(self):
+        """
+        Test that the number of queries of the changelist doesn't depend on
+        the number of displayed flagged contents
+        """
+        self._add_flagged_content(self.model_with_author, self.author)
+        self._add_flagged_content(self.model_without_author)
+        flagged_content = self._add_flagged_content(self.author)
+        flagged_content.moderator = self.staff_user
+        flagged_content.save()
+        num_queries, response = self._get_changelist()
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<a href="%s">%s</a>' % (
+                reverse('admin:auth_user_change', args=(self.author.id,)),
+                self.author.username))
+
+        # more flagged contents, of all content types
+        for i in range(0, 5):
+            user = User.objects.create_user('%s-more-%s' % (self.USER_BASE, i),
+                                            'more-%s@example.com' % i)
+            self._add_flagged_content(user, self.author)
+            self._add_flagged_content(ModelWithAuthor.objects.create(
+                    name='more %s' % i, author=user), user)
+        self.assertEqual(self._get_changelist()[0], num_queries)
+
+    def _get_change_form(self, flagged_content, cursor=None):
+        """
+        Return the number of queries done to get the change form of the
+        given flagged content, and the response
+        """
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        data = {}
+        if cursor:
+            data['flags_after'] = cursor
+        try:
+            response = self.client.get(reverse(
+                    'admin:flag_flaggedcontent_change',
+                    args=(flagged_content.id,)), data)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+        return len(connection.queries), response
+
+    def test_flags_inline(self):
+        """
+        Test that the flags inline is paginated, with a summary by status,
+        and that its number of queries doesn't depend on the number of flags
+        """
+        flagged_content = self._add_flagged_content(self.model_without_author)
+        flags = [self._add_flag(flagged_content, comment='comment %d' % i)
+                 for i in range(0, 3)]
+        flags.append(self._add_flag(flagged_content, 'moderation', status=2))
+        # same date for all flags, to check the paging on the ids
+        FlagInstance.objects.update(when_added=datetime(2012, 1, 1))
+
+        per_page = InlineFlagInstance.per_page
+        InlineFlagInstance.per_page = 3
+        try:
+            response = self._get_change_form(flagged_content)[1]
+            self.assertEqual(response.status_code, 200)
+            formset = response.context['inline_admin_formsets'][0].formset
+            self.assertEqual([flag.id for flag in formset.get_queryset()],
+                             [flag.id for flag in reversed(flags[1:])])
+            self.assertContains(response, 'flagged: 3')
+            self.assertContains(response, 'flag rejected by moderator: 1')
+            self.assertNotContains(response, 'comment 1')
+            self.assertContains(response, 'flags_after=%s' %
+                                formset.next_cursor)
+
+            response = self._get_change_form(flagged_content,
+                                             formset.next_cursor)[1]
+            formset = response.context['inline_admin_formsets'][0].formset
+            self.assertEqual([flag.id for flag in formset.get_queryset()],
+                             [flags[0].id])
+            self.assertEqual(formset.next_cursor, None)
+
+            # an invalid cursor shows the first page
+            response = self._get_change_form(flagged_content, 'foo')[1]
+            formset = response.context['inline_admin_formsets'][0].formset
+            self.assertEqual(len(formset.get_queryset()), 3)
+            num_queries = self._get_change_form(flagged_content)[0]
+
+            for i in range(0, 10):
+                self._add_flag(flagged_content, 'more')
+            self.assertEqual(self._get_change_form(flagged_content)[0],
+                             num_queries)
+        finally:
+            InlineFlagInstance.per_page = per_page
+
+        response = self.client.get(reverse('admin:flag_flaginstance_comment',
+                                           args=(flags[1].id,)))
+        self.assertEqual(response.content, 'comment 1')
+
+        # the status of the flags of a page can be changed, and they can be
+        # deleted, even if flags were added in the meantime
+        response = self._get_change_form(flagged_content)[1]
+        data = {}
+        formsets = [inline_admin_formset.formset for inline_admin_formset
+                    in response.context['inline_admin_formsets']]
+        for form in [response.context['adminform'].form] + [form
+                for formset in formsets
+                    for form in [formset.management_form] + formset.forms]:
+            for bound_field in form:
+                value = bound_field.value()
+                if value is not None:
+                    data[bound_field.html_name] = value
+        first, second = formsets[0].get_queryset()[:2]
+        data['moderator'] = self.staff_user.id
+        data['%s-0-status' % formsets[0].prefix] = 2
+        data['%s-1-DELETE' % formsets[0].prefix] = 'on'
+        self._add_flag(flagged_content, 'newer')
+        response = self.client.post(reverse('admin:flag_flaggedcontent_change',
+                                            args=(flagged_content.id,)), data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(FlagInstance.objects.get(id=first.id).status, 2)
+        self.assertFalse(FlagInstance.objects.filter(id=second.id).exists())
+
+    def test_set_status_action(self):
+        """
+        Test the actions setting the status of the selected flagged contents
+        """
+        flagged_contents = [self._add_flagged_content(obj) for obj in (
+                self.model_without_author, self.model_with_author)]
+        data = {'action': 'set_status_5',
+                '_selected_action': [fc.id for fc in flagged_contents]}
+
+        # a form is shown to ask the comment
+        response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'content removed by moderator')
+        self.assertEqual(FlaggedContent.objects.filter(status=5).count(), 0)
+
+        # the comment is needed
+        data['post'] = 'yes'
+        response = self.client.post(self.url, data)
+        self.assertContains(response, 'You must add a comment')
+        self.assertEqual(FlaggedContent.objects.filter(status=5).count(), 0)
+
+        # a status not allowed for one of the models
+        data['comment'] = 'spam'
+        flag_settings.MODELS_SETTINGS = {'tests.modelwithauthor': dict(
+                STATUSES=flag_settings.STATUSES[:2])}
+        try:
+            response = self.client.post(self.url, data, follow=True)
+        finally:
+            flag_settings.MODELS_SETTINGS = {}
+        self.assertContains(response, 'No flagged content updated')
+        self.assertEqual(FlaggedContent.objects.filter(status=5).count(), 0)
+
+        response = self.client.post(self.url, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(FlaggedContent.objects.filter(status=5,
+                moderator=self.staff_user).count(), 2)
+
+    def test_export(self):
+        """
+        Test the streamed export of the flags
+        """
+        flagged_content = self._add_flagged_content(self.model_without_author)
+        flag_instance = self._add_flag(flagged_content, 'comment')
+        url = reverse('admin:flag_flaginstance_export')
+
+        response = self.client.get(self.url)
+        self.assertContains(response, '%s?format=jsonl' % url)
+
+        response = self.client.get(url, {'format': 'jsonl', 'status': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(simplejson.loads(response.content)['id'],
+                         flag_instance.id)
+
+        response = self.client.get(url, {'format': 'csv', 'status': '2'})
+        self.assertEqual(response.content.splitlines(),
+                         [','.join(flag_export.FIELDS)])
+
+        self.assertEqual(self.client.get(url, {'format': 'xml'}).status_code,
+                         400)
+        self.assertEqual(self.client.get(url, {'until': 'foo'}).status_code,
+                         400)
+
+    def test_moderation_queue(self):
+        """
+        Test the moderation queue, as html and json, and that the number of
+        queries is the same for all pages
+        """
+        for obj in (self.model_without_author, self.author, self.user):
+            self._add_flagged_content(obj, self.author)
+        url = reverse('admin:flag_flaggedcontent_queue')
+        json_url = reverse('admin:flag_flaggedcontent_queue_json')
+
+        response = self.client.get(self.url)
+        self.assertContains(response, url)
+
+        list_per_page = FlaggedContentAdmin.list_per_page
+        FlaggedContentAdmin.list_per_page = 1
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            response = self.client.get(url, {'content_type': 'auth.user'})
+            num_queries = len(connection.queries)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, self.author.username)
+            next_url = response.context['next_url']
+            self.assertTrue(next_url)
+
+            response = self.client.get(url + next_url)
+            self.assertEqual(len(connection.queries), num_queries)
+            self.assertContains(response, self.user.username)
+            self.assertEqual(response.context['next_url'], None)
+
+            response = self.client.get(json_url, {'order': 'newest'})
+            data = simplejson.loads(response.content)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertEqual(data['results'][0]['object'],
+                             self.user.username)
+            self.assertEqual(data['results'][0]['creator_id'], self.author.id)
+            self.assertTrue(data['next'])
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            FlaggedContentAdmin.list_per_page = list_per_page
+
+        self.assertEqual(self.client.get(json_url, {'after': 'foo'})\
+                .status_code, 400)
+        self.assertEqual(self.client.get(url, {'status': 'foo'}).status_code,
+                         400)
+
+    @skipUnless(os.environ.get('FLAG_BENCHMARK_ROWS'),
+                'set FLAG_BENCHMARK_ROWS to run the admin benchmark')
+    def test_changelist_benchmark(self):
+        """
+        Display the changelist with FLAG_BENCHMARK_ROWS flagged contents (of
+        3 content types, and mostly for deleted objects) and check that the
+        number of queries doesn't change
+        """
+        rows = int(os.environ['FLAG_BENCHMARK_ROWS'])
+        for obj in (self.author, self.model_with_author,
+                    self.model_without_author):
+            self._add_flagged_content(obj)
+        num_queries = self._get_changelist()[0]
+
+        content_type_ids = [ContentType.objects.get_for_model(model).id
+                            for model in (User, ModelWithAuthor,
+                                          ModelWithoutAuthor)]
+        cursor = connection.cursor()
+        now = datetime.now()
+        for start in range(0, rows, 10000):
+            cursor.executemany(
+                'INSERT INTO flag_flaggedcontent (content_type_id, '
+                'object_id, status, count, when_updated) '
+                'VALUES (%s, %s, 1, 1, %s)',
+                [(content_type_ids[i % 3], 1000000 + i, now)
+                    for i in range(start, min(start + 10000, rows))])
+
+        start = time.time()
+        response_queries, response = self._get_changelist()
+        duration = time.time() - start
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_queries, num_queries)
+        sys.stderr.write('\nadmin changelist with %d flagged contents: '
+                         '%.3fs, %d queries\n' % (rows, duration,
+                                                  response_queries))
+
+
+class FlagTransactionTestCase(BaseTestCaseWithData):
+    """
+    Tests run with real transactions
+    """
+    _fixture_setup = TransactionTestCase._fixture_setup.im_func
+    _fixture_teardown = TransactionTestCase._fixture_teardown.im_func
+
+    def tearDown(self):
+        """
+        Delete the staff user, not deleted by the parent class
+        """
+        self.staff_user.delete()
+        super(FlagTransactionTestCase, self).tearDown()
+
+    def test_mails_and_signal_after_commit(self):
+        """
+        Test that the signal and the mails not queued are sent after the
+        commit of the flag, so the flagged content is not locked meanwhile
+        """
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_RULES = [(1, 1)]
+        mail.outbox = []
+        managed = []
+
+        def receiver(sender, **kwargs):
+            managed.append(('signal', transaction.is_managed()))
+
+        def send_messages(backend, messages):
+            managed.append(('mail', transaction.is_managed()))
+            return original_send_messages(backend, messages)
+
+        original_send_messages = locmem.EmailBackend.send_messages
+        locmem.EmailBackend.send_messages = send_messages
+        content_flagged.connect(receiver)
+        try:
+            FlagInstance.objects.add(self.user, self.model_without_author,
+                                     comment='comment', send_signal=True,
+                                     send_mails=True)
+        finally:
+            content_flagged.disconnect(receiver)
+            locmem.EmailBackend.send_messages = original_send_messages
+        self.assertEqual(managed, [('signal', False), ('mail', False)])
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class QueryPlanTestCase(BaseTestCaseWithData):
+    """
+    Check, with the sqlite `EXPLAIN QUERY PLAN`, that the queries made by
+    the managers and the views on the flag tables use an index
+    """
+
+    # the sqlite module commits before an `EXPLAIN`, so the tests can't be
+    # run in a transaction rolled back at the end
+    _fixture_setup = TransactionTestCase._fixture_setup.im_func
+    _fixture_teardown = TransactionTestCase._fixture_teardown.im_func
+
+    def tearDown(self):
+        """
+        Delete the staff user, not deleted by the parent class
+        """
+        self.staff_user.delete()
+        super(QueryPlanTestCase, self).tearDown()
+
+    def _capture_queries(self, func, *args, **kwargs):
+        """
+        Call the given function and return the queries (sql and params) it
+        made
+        """
+        queries = []
+
+        def last_executed_query(cursor, sql, params):
+            queries.append((sql, params))
+            return original(cursor, sql, params)
+
+        original = connection.ops.last_executed_query
+        use_debug_cursor = connection.use_debug_cursor
+        connection.ops.last_executed_query = last_executed_query
+        connection.use_debug_cursor = True
+        try:
+            func(*args, **kwargs)
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            del connection.ops.last_executed_query
+        return queries
+
+    def _get_full_scans(self, queries):
+        """
+        Return the queries, with the matching plan line, doing a full scan
+        of one of the flag tables, or sorting rows without an index
+        """
+        full_scan = re.compile(r'\bSCAN (TABLE )?flag_\w+( AS \w+)?\s*$|'
+                               r'\bTEMP B-TREE FOR ORDER BY\b')
+        cursor = connection.cursor()
+        result = []
+        for sql, params in queries:
+            if not re.match(r'\s*(SELECT|UPDATE|DELETE)\b', sql, re.I):
+                continue
+            cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+            for row in cursor.fetchall():
+                if full_scan.search(row[-1]):
+                    result.append((sql, row[-1]))
+        return result
+
+    def assertUseIndexes(self, func, *args, **kwargs):
+        """
+        Check that all the queries made by the function use an index
+        """
+        queries = self._capture_queries(func, *args, **kwargs)
+        self.assertTrue(queries)
+        full_scans = self._get_full_scans(queries)
+        if full_scans:
+            raise self.failureException('Without index:\n%s' % '\n'.join(
+                    '%s\n    => %s' % full_scan for full_scan in full_scans))
+
+    def test_detect_full_scan(self):
+        """
+        Test that a full scan is detected
+        """
+        if connection.vendor != 'sqlite':
+            return
+        self.assertRaises(self.failureException, self.assertUseIndexes,
+                          lambda: list(FlagInstance.objects.filter(
+                                comment='comment')))
+
+    def test_managers(self):
+        """
+        Test the queries of the managers
+        """
+        if connection.vendor != 'sqlite':
+            return
+        flag_settings.LIMIT_SAME_OBJECT_FOR_USER = 5
+        model = self.model_without_author
+        objects = [self.model_without_author, self.model_with_author]
+
+        self.assertUseIndexes(FlagInstance.objects.add, self.user, model,
+                              comment='comment')
+        self.assertUseIndexes(FlagInstance.objects.add, self.staff_user, model,
+                              comment='moderation', status=2)
+        self.assertUseIndexes(FlaggedContent.objects.get_for_object, model)
+        self.assertUseIndexes(FlaggedContent.objects.get_state_for_object,
+                              model)
+        self.assertUseIndexes(FlaggedContent.objects.get_for_objects, objects)
+        self.assertUseIndexes(FlaggedContent.objects.prefetch_for_objects,
+                              objects, self.user)
+        self.assertUseIndexes(
+                FlaggedContent.objects.get_or_create_for_object,
+                self.model_with_author)
+        self.assertUseIndexes(lambda: list(
+                FlaggedContent.objects.filter_for_model(
+                    ModelWithoutAuthor).filter(status=1)))
+        self.assertUseIndexes(lambda: list(
+                FlaggedContent.objects.filter_for_model(
+                    ModelWithoutAuthor, True).filter(status=2)))
+        self.assertUseIndexes(lambda: list(
+                FlaggedContent.objects.filter(status=1)[:10]))
+        self.assertUseIndexes(lambda: list(
+                FlaggedContent.objects.filter(status=2).order_by(
+                    'when_updated')[:10]))
+
+        flagged_content = FlaggedContent.objects.get_for_object(model)
+        self.assertUseIndexes(lambda: list(
+                flagged_content.flag_instances.all()))
+        self.assertUseIndexes(lambda: list(
+                flagged_content.flag_instances.filter(user=self.user,
+                                                      status=1)))
+        self.assertUseIndexes(UserFlagCount.objects.get_count,
+                              flagged_content, self.user)
+        self.assertUseIndexes(UserFlagCount.objects.increment,
+                              flagged_content, self.user)
+        self.assertUseIndexes(FlagInstance.objects.bulk_add, [
+                (self.author, obj, 'bulk', None) for obj in objects])
+        for filters in ({}, {'order': 'newest'}, {'status': 2},
+                        {'content_type': User}, {'creator': self.author.id}):
+            cursor = '20120101000000000000-1'
+            self.assertUseIndexes(moderation.get_page, cursor=cursor,
+                                  **filters)
+        for filters in ({}, {'content_type': User}):
+            self.assertUseIndexes(moderation.get_page, order='priority',
+                                  cursor='1234.5-1', **filters)
+        self.assertUseIndexes(FlaggedContent.objects.set_status,
+                              FlaggedContent.objects.filter(status=1), 3,
+                              self.staff_user, 'moderation')
+
+        flag_settings.SEND_MAILS = True
+        flag_settings.SEND_MAILS_QUEUED = True
+        self.assertUseIndexes(FlagInstance.objects.add, self.user, model,
+                              comment='comment', send_mails=True)
+        self.assertUseIndexes(FlagMail.objects.send_pending)
+        flag_settings.SEND_MAILS_DIGEST = 60
+        self.assertUseIndexes(FlagInstance.objects.add, self.user, model,
+                              comment='comment', send_mails=True)
+        FlagMail.objects.update(next_try=datetime.now())
+        self.assertUseIndexes(FlagMail.objects.send_pending)
+
+        self.assertUseIndexes(flagged_content.delete)
+
+    def test_views(self):
+        """
+        Test the queries of the views
+        """
+        if connection.vendor != 'sqlite':
+            return
+        url = get_confirm_url_for_object(self.model_without_author)
+        self.client.login(username=self.user.username,
+                          password=self.USER_BASE)
+
+        self.assertUseIndexes(self.client.get, url)
+        form = get_default_form(self.model_without_author)
+        data = dict((key, form[key].value()) for key in form.fields)
+        data.update(dict(csrf_token=None, comment='comment'))
+        self.assertUseIndexes(self.client.post, reverse('flag'), data)
+        self.assertEqual(FlaggedContent.objects.get_for_object(
+                self.model_without_author).count, 1)
+        self.assertUseIndexes(self.client.get, url)
+        self.assertUseIndexes(self.client.get, reverse('flag_states'), {
+                'keys': 'tests.modelwithoutauthor:%d,auth.user:%d' % (
+                    self.model_without_author.id, self.author.id)})
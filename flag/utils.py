@@ -1,4 +1,98 @@
+import operator
+from datetime import datetime
+from bisect import bisect_right
+
+from django.conf import settings
+from django.core import urlresolvers
 from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from django.db.models.signals import post_syncdb
+
+
+# registry of the resolved content types: `(app_label, model)` tuples by
+# content type id, and ids by tuple. Filled for all the models of the
+# FLAG_MODELS settings in one query when first needed (see
+# `warm_content_types`), then when other content types are resolved
+_tuples_by_id = {}
+_ids_by_tuple = {}
+_warmed = []
+
+
+def _register_content_type(content_type):
+    """
+    Add the given ContentType in the registry
+    """
+    key = (content_type.app_label, content_type.model)
+    _tuples_by_id[content_type.id] = key
+    _ids_by_tuple[key] = content_type.id
+
+
+def warm_content_types():
+    """
+    Load in the registry, in only one query, the content types of all the
+    models of the FLAG_MODELS settings (done only once)
+    """
+    if _warmed:
+        return
+    _warmed.append(True)
+
+    from flag import settings as flag_settings
+    if not flag_settings.MODELS:
+        return
+    query = reduce(operator.or_, [
+            Q(app_label=app_label, model=model)
+                for app_label, model in [name.split('.', 1)
+                                         for name in flag_settings.MODELS]])
+    for content_type in ContentType.objects.filter(query):
+        _register_content_type(content_type)
+
+
+def clear_content_types(**kwargs):
+    """
+    Empty the registry (called after a syncdb or a flush, which may create
+    content types with new ids)
+    """
+    _tuples_by_id.clear()
+    _ids_by_tuple.clear()
+    del _warmed[:]
+
+
+post_syncdb.connect(clear_content_types,
+                    dispatch_uid='flag.utils.clear_content_types')
+
+
+def _tuple_from_id(content_type_id):
+    content_type_id = int(content_type_id)
+    if content_type_id not in _tuples_by_id:
+        warm_content_types()
+        if content_type_id not in _tuples_by_id:
+            _register_content_type(
+                    ContentType.objects.get_for_id(content_type_id))
+    return _tuples_by_id[content_type_id]
+
+
+def _tuple_from_string(content_type):
+    if content_type.isdigit():
+        return _tuple_from_id(content_type)
+    if '.' not in content_type:
+        raise ValueError('%r is not a "app_label.model_name" string' %
+                         content_type)
+    return tuple(content_type.split('.', 1))
+
+
+def _tuple_from_content_type(content_type):
+    return content_type.app_label, content_type.model
+
+
+# functions returning the tuple, for each type of "something" not a model
+# (looked up by exact type first, for speed)
+_tuple_resolvers = {
+    int: _tuple_from_id,
+    long: _tuple_from_id,
+    str: _tuple_from_string,
+    unicode: _tuple_from_string,
+    ContentType: _tuple_from_content_type,
+}
 
 
 def get_content_type_tuple(content_type):
@@ -10,31 +104,134 @@ def get_content_type_tuple(content_type):
      - a model
      - an instance of a model
      - a `app_label.model_name` string
+    A ValueError is raised if it's none of them.
     """
+    resolver = _tuple_resolvers.get(type(content_type))
+    if resolver is not None:
+        return resolver(content_type)
+    # subclasses (safe strings, proxy content types...)
+    for klass, resolver in _tuple_resolvers.items():
+        if isinstance(content_type, klass):
+            return resolver(content_type)
+
+    # a model (or an instance of a model)
+    try:
+        meta = content_type._meta
+    except AttributeError:
+        raise ValueError('Cannot get a content type from %r' % content_type)
+    return meta.app_label, meta.module_name
 
-    # check if integer, as integer or string => content_type id
-    if isinstance(content_type, int) or (
+
+def get_content_type_id(content_type):
+    """
+    Return the id of the content type of "something" (see
+    `get_content_type_tuple`), from the registry if possible.
+    Raise ContentType.DoesNotExist if there is no such content type.
+    """
+    if isinstance(content_type, ContentType):
+        return content_type.id
+    if isinstance(content_type, (int, long)) or (
             isinstance(content_type, basestring) and content_type.isdigit()):
-        ctype = ContentType.objects.get_for_id(content_type)
-        app_label, model = ctype.app_label, ctype.model
+        return int(content_type)
+
+    key = get_content_type_tuple(content_type)
+    if key not in _ids_by_tuple:
+        warm_content_types()
+        if key not in _ids_by_tuple:
+            if hasattr(content_type, '_meta'):
+                ctype = ContentType.objects.get_for_model(content_type)
+            else:
+                ctype = ContentType.objects.get_by_natural_key(*key)
+            _register_content_type(ctype)
+            # a proxy model has the content type of its concrete model
+            _ids_by_tuple[key] = ctype.id
+    return _ids_by_tuple[key]
+
+
+# admin change urls, split around an object id, by urlconf and model (see
+# `get_admin_url`)
+_admin_urls = {}
+_ADMIN_URL_OBJECT_ID = '987654321'
+
 
-    # check if string => 'app_label.model_name'
-    elif isinstance(content_type, basestring):
+def get_admin_url(app_label, model_name, object_id):
+    """
+    Return the url of the admin change page of the given object, or None if
+    there is no such page. The url is reversed only once for each model.
+    """
+    key = (urlresolvers.get_urlconf() or settings.ROOT_URLCONF,
+           urlresolvers.get_script_prefix(), app_label, model_name)
+    if key not in _admin_urls:
         try:
-            app_label, model = content_type.split('.', 1)
-        except Exception, e:
-            raise e
+            _admin_urls[key] = urlresolvers.reverse(
+                    'admin:%s_%s_change' % (app_label, model_name),
+                    args=(_ADMIN_URL_OBJECT_ID,)).rsplit(
+                        _ADMIN_URL_OBJECT_ID, 1)
+        except urlresolvers.NoReverseMatch:
+            _admin_urls[key] = None
+    parts = _admin_urls[key]
+    if parts is None:
+        return None
+    return '%s%s%s' % (parts[0], object_id, parts[1])
 
-    # check if its a content_type object
-    elif isinstance(content_type, ContentType):
-        app_label, model = content_type.app_label, content_type.model
 
-    # check if a model (or an instance of a model)
+def bulk_create(model, objects):
+    """
+    Insert the given (unsaved) instances of the given model in the database,
+    in only one query if `bulk_create` is available (django >= 1.4), else one
+    by one, but without calling their `save` method
+    """
+    manager = model._default_manager
+    if hasattr(manager, 'bulk_create'):
+        manager.bulk_create(objects)
     else:
+        for obj in objects:
+            obj.save_base(force_insert=True)
+
+
+# formats accepted by `parse_date`
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def parse_date(value):
+    """
+    Return a datetime from a string in one of the DATE_FORMATS (used by the
+    management commands), or raise a ValueError
+    """
+    for date_format in DATE_FORMATS:
         try:
-            app_label = content_type._meta.app_label
-            model = content_type._meta.module_name
-        except Exception, e:
-            raise e
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid date %r, the format must be "YYYY-MM-DD" or '
+                     '"YYYY-MM-DD HH:MM:SS"' % value)
+
+
+# SEND_MAILS_RULES compiled by `compile_mail_rules`
+_compiled_mail_rules = {}
+
 
-    return app_label, model
+def compile_mail_rules(rules):
+    """
+    Return the given SEND_MAILS_RULES rules compiled in a tuple of two
+    lists: the minimum counts, sorted, and the matching steps, to be searched
+    with `bisect`. The compiled rules are memoized.
+    """
+    key = tuple([tuple(rule) for rule in rules])
+    if key not in _compiled_mail_rules:
+        ordered_rules = sorted(key)
+        _compiled_mail_rules[key] = ([rule[0] for rule in ordered_rules],
+                                     [rule[1] for rule in ordered_rules])
+    return _compiled_mail_rules[key]
+
+
+def must_send_mail(rules, count):
+    """
+    Return True if, according to the given SEND_MAILS_RULES rules, a mail
+    must be sent when the count of flags of an object reaches `count`
+    """
+    min_counts, steps = compile_mail_rules(rules)
+    index = bisect_right(min_counts, count) - 1
+    if index < 0 or not steps[index]:
+        return False
+    return not (count - min_counts[index]) % steps[index]
@@ -1,6 +1,8 @@
+import math
 import urlparse
 
-from django.http import Http404, HttpResponseBadRequest
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+        HttpResponseNotModified)
 from django.shortcuts import redirect, render
 from django.template.loader import render_to_string
 from django.db.models import get_model
@@ -11,6 +13,9 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext as _
 from django.contrib import messages
 from django.utils.html import escape
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import parse_etags, quote_etag
 
 from django.conf import settings
 
@@ -18,7 +23,10 @@ from flag import settings as flag_settings
 from flag.forms import (FlagForm, FlagFormWithCreator, get_default_form,
         FlagFormWithStatus, FlagFormWithCreatorAndStatus)
 from flag.models import FlaggedContent, FlagInstance
-from flag.exceptions import FlagException, OnlyStaffCanUpdateStatus
+from flag.exceptions import (FlagException, OnlyStaffCanUpdateStatus,
+        FlagRateLimitExceeded, FlagInProgressException)
+from flag.ratelimit import check_rate
+from flag.utils import get_content_type_id
 
 
 def _validate_next_parameter(request, next):
@@ -61,6 +69,26 @@ class FlagBadRequest(HttpResponseBadRequest):
                                             {"why": why})
 
 
+class FlagRateLimited(HttpResponse):
+    """
+    Response returned when a user flags too fast (see the FLAG_RATE_LIMIT
+    settings), with the error as json for ajax requests, else as text, and
+    the number of seconds to wait in the `Retry-After` header
+    """
+    status_code = 429
+
+    def __init__(self, request, exception):
+        if request.is_ajax():
+            super(FlagRateLimited, self).__init__(simplejson.dumps({
+                    'error': unicode(exception),
+                    'retry_after': exception.retry_after,
+                }), mimetype='application/json')
+        else:
+            super(FlagRateLimited, self).__init__(unicode(exception),
+                    mimetype='text/plain; charset=utf-8')
+        self['Retry-After'] = str(int(math.ceil(exception.retry_after)))
+
+
 def get_confirm_url_for_object(content_object,
                                creator_field=None,
                                with_status=False):
@@ -132,75 +160,111 @@ def assert_user_can_change_status(user):
     raise OnlyStaffCanUpdateStatus("Only staff can update a flag's status")
 
 
-@login_required
-def flag(request):
+def get_flag_form(request):
     """
-    Validate the form and create the flag.
-    In all cases, redirect to the `next` parameter.
+    Return a tuple `(content_object, form)` with the object to flag and the
+    form (bound but not validated) posted in the request, or a FlagBadRequest
+    response if the object or the security data are invalid.
+    Raise an OnlyStaffCanUpdateStatus exception if a status is posted by a
+    user who is not staff.
     """
+    post_data = request.POST.copy()
 
-    if request.method == 'POST':
-        post_data = request.POST.copy()
+    # only staff can update status
+    with_status = 'status' in post_data
+    if with_status:
+        assert_user_can_change_status(request.user)
+
+    # the object to flag
+    content_object = get_content_object(post_data.get("content_type"),
+                                        post_data.get('object_pk'))
+
+    if (isinstance(content_object, HttpResponseBadRequest)):
+            return content_object
 
-        # only staff can update status
-        with_status = 'status' in post_data
+    # get the form class regrding if we have a creator_field
+    form_class = FlagForm
+
+    if 'creator_field' in post_data:
+        form_class = FlagFormWithCreator
         if with_status:
-            try:
-                assert_user_can_change_status(request.user)
-            except OnlyStaffCanUpdateStatus, e:
-                return FlagBadRequest(str(e))
+            form_class = FlagFormWithCreatorAndStatus
+    elif with_status:
+        form_class = FlagFormWithStatus
 
-        # the object to flag
-        object_pk = post_data.get('object_pk')
-        content_object = get_content_object(post_data.get("content_type"),
-                                            object_pk)
+    form = form_class(target_object=content_object, data=post_data)
 
-        if (isinstance(content_object, HttpResponseBadRequest)):
-                return content_object
+    if form.security_errors():
+        return FlagBadRequest(
+            "The flag form failed security verification: %s" % \
+                escape(str(form.security_errors())))
 
-        content_type = ContentType.objects.get_for_model(content_object)
+    return content_object, form
 
-        # get the form class regrding if we have a creator_field
-        form_class = FlagForm
 
-        if 'creator_field' in post_data:
-            form_class = FlagFormWithCreator
-            if with_status:
-                form_class = FlagFormWithCreatorAndStatus
-        elif with_status:
-            form_class = FlagFormWithStatus
+def add_flag_from_form(request, content_object, form):
+    """
+    Add the flag of the given (valid) form and return it, or raise a
+    FlagException if the user cannot add it
+    """
+    # manage creator
+    creator = None
+    if form.__class__ == FlagFormWithCreator:
+        creator_field = form.cleaned_data['creator_field']
+        if creator_field:
+            creator = getattr(content_object,
+                              creator_field,
+                              None)
+
+    # manage comment
+    if flag_settings.get_for_model(content_object, 'ALLOW_COMMENTS'):
+        comment = form.cleaned_data['comment']
+    else:
+        comment = None
 
-        form = form_class(target_object=content_object, data=post_data)
+    # manage status
+    status = form.cleaned_data.get('status', None) or None
 
-        if form.security_errors():
-            return FlagBadRequest(
-                "The flag form failed security verification: %s" % \
-                    escape(str(form.security_errors())))
+    # the key given by the client, else the one of the form, to add the flag
+    # only once if the form is sent again
+    idempotency_key = request.POST.get('idempotency_key') or \
+            request.META.get('HTTP_X_IDEMPOTENCY_KEY') or \
+            form.get_idempotency_key()
 
-        if form.is_valid():
+    # add the flag, the manager checks the user can do it
+    return FlagInstance.objects.add(request.user, content_object, creator,
+        comment, status, send_signal=True, send_mails=True,
+        idempotency_key=idempotency_key)
 
-            # manage creator
-            creator = None
-            if form_class == FlagFormWithCreator:
-                creator_field = form.cleaned_data['creator_field']
-                if creator_field:
-                    creator = getattr(content_object,
-                                      creator_field,
-                                      None)
-
-            # manage comment
-            if flag_settings.get_for_model(content_object, 'ALLOW_COMMENTS'):
-                comment = form.cleaned_data['comment']
-            else:
-                comment = None
 
-            # manage status
-            status = form.cleaned_data.get('status', None) or None
+@login_required
+def flag(request):
+    """
+    Validate the form and create the flag.
+    In all cases, redirect to the `next` parameter.
+    """
+
+    if request.method == 'POST':
+
+        # reject the users flagging too fast, before any query
+        try:
+            check_rate(request.user, request.POST.get('content_type', ''))
+        except FlagRateLimitExceeded, e:
+            return FlagRateLimited(request, e)
+
+        try:
+            result = get_flag_form(request)
+        except OnlyStaffCanUpdateStatus, e:
+            return FlagBadRequest(str(e))
+        if isinstance(result, HttpResponseBadRequest):
+            return result
+        content_object, form = result
+
+        if form.is_valid():
 
             # add the flag, but check the user can do it
             try:
-                FlagInstance.objects.add(request.user, content_object, creator,
-                    comment, status, send_signal=True, send_mails=True)
+                add_flag_from_form(request, content_object, form)
             except FlagException, e:
                 if not request.is_ajax():
                     messages.error(request, unicode(e))
@@ -211,11 +275,12 @@ def flag(request):
 
         else:
             # form not valid, we return to the confirm page
+            content_type = ContentType.objects.get_for_model(content_object)
 
             return confirm(request,
                 app_label=content_type.app_label,
                 object_name=content_type.model,
-                object_id=object_pk,
+                object_id=content_object.pk,
                 form=form)
 
     else:
@@ -229,6 +294,177 @@ def flag(request):
         raise Http404
 
 
+# http status of the errors of the `flag_json` view, by exception (the other
+# ones are 400)
+JSON_ERROR_STATUSES = {
+    FlagRateLimitExceeded: 429,
+    FlagInProgressException: 409,
+    OnlyStaffCanUpdateStatus: 403,
+}
+
+
+class FlagJsonResponse(HttpResponse):
+    """
+    Response of the `flag_json` view: the given data in json
+    """
+
+    def __init__(self, data, status=200):
+        super(FlagJsonResponse, self).__init__(simplejson.dumps(data),
+                mimetype='application/json', status=status)
+
+
+def flag_json_error(code, message, status=400, **extra):
+    """
+    Return a FlagJsonResponse with the given error code (see the `code`
+    attributes in `flag.exceptions`) and message, and the given extra data
+    """
+    extra.update(error=code, message=unicode(message))
+    return FlagJsonResponse(extra, status=status)
+
+
+def flag_json(request):
+    """
+    Validate the form and create the flag, like the `flag` view, but return
+    the new state of the flagged content as json:
+    `{"count": ..., "status": ..., "can_flag_again": ...}`, without reading
+    it again (but for a flag sent again with the same idempotency key, as
+    the state kept with the first flag may be outdated), or an error:
+    `{"error": <code>, "message": ...}` (with `errors`, by field, for an
+    invalid form, and `retry_after`, also in the `Retry-After` header, when
+    the user flags too fast)
+    """
+    if not request.user.is_authenticated():
+        return flag_json_error('login_required',
+                               _('You must be logged in to flag'), 403)
+    if request.method != 'POST':
+        return flag_json_error('invalid_access', 'Invalid access', 405)
+
+    try:
+        check_rate(request.user, request.POST.get('content_type', ''))
+        result = get_flag_form(request)
+        if isinstance(result, HttpResponseBadRequest):
+            return flag_json_error('bad_request', 'Bad request')
+        content_object, form = result
+        if not form.is_valid():
+            return flag_json_error('invalid_form', 'Invalid form',
+                    errors=dict((name, map(unicode, errors))
+                                for name, errors in form.errors.items()))
+        flag_instance = add_flag_from_form(request, content_object, form)
+    except FlagException, e:
+        extra = {}
+        if isinstance(e, FlagRateLimitExceeded):
+            extra['retry_after'] = e.retry_after
+        response = flag_json_error(e.code, e,
+                                   JSON_ERROR_STATUSES.get(e.__class__, 400),
+                                   **extra)
+        if isinstance(e, FlagRateLimitExceeded):
+            response['Retry-After'] = str(int(math.ceil(e.retry_after)))
+        return response
+
+    flagged_content = flag_instance.flagged_content
+    if flag_instance.replayed:
+        flagged_content = FlaggedContent.objects.get(id=flagged_content.id)
+    return FlagJsonResponse({
+        'count': flagged_content.count,
+        'status': flagged_content.status,
+        'can_flag_again': flagged_content.can_be_flagged_by_user(
+                request.user),
+    })
+
+
+# maximum number of objects in a request to the `flag_states` view
+MAX_STATES = 200
+
+
+def parse_state_key(key):
+    """
+    Return a tuple `(content_type_id, object_id)` from a
+    `app_label.model:object_id` key, or raise a ValueError if it's invalid
+    """
+    model, sep, object_id = key.partition(':')
+    try:
+        content_type_id = get_content_type_id(model)
+    except ContentType.DoesNotExist:
+        raise ValueError('Unknown model %r' % model)
+    return content_type_id, int(object_id)
+
+
+def get_states_etag(user, keys, flagged_contents):
+    """
+    Return the ETag of the states of the given keys for the given user,
+    derived from the update dates (changed by each flag or moderation), the
+    counts and the statuses of the given flagged contents
+    """
+    parts = [str(user.id)]
+    for key in keys:
+        flagged_content = flagged_contents.get(key)
+        if flagged_content is None:
+            parts.append('-')
+        else:
+            parts.append('%s:%s:%s:%s' % (flagged_content.id,
+                    flagged_content.when_updated.strftime('%Y%m%d%H%M%S%f'),
+                    flagged_content.count, flagged_content.status))
+    return md5_constructor(','.join(parts)).hexdigest()
+
+
+def flag_states(request):
+    """
+    Return in json the state of the objects given, as a comma separated list
+    of `app_label.model:object_id` keys, in the `keys` parameter:
+    `{"states": {<key>: {"count": ..., "status": ..., "can_flag": ...}}}`
+    (`status` is null for the objects never flagged), with a fixed number of
+    queries, whatever the number of objects (at most MAX_STATES).
+    The response has an ETag (see `get_states_etag`): if it matches the
+    `If-None-Match` header, a 304 response is returned, without loading the
+    flags of the user nor serializing the states.
+    """
+    names = [name for name in request.GET.get('keys', '').split(',') if name]
+    if len(names) > MAX_STATES:
+        return flag_json_error('too_many_keys',
+                               'At most %d keys are allowed' % MAX_STATES)
+    try:
+        keys = [parse_state_key(name) for name in names]
+    except ValueError, e:
+        return flag_json_error('invalid_key', e)
+
+    flagged_contents = FlaggedContent.objects.get_for_keys(keys)
+
+    etag = get_states_etag(request.user, keys, flagged_contents)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+        response['ETag'] = quote_etag(etag)
+        return response
+
+    user = request.user
+    can_flag = user.is_authenticated()
+    if can_flag:
+        FlaggedContent.objects.load_flags_by_user(flagged_contents.values(),
+                                                  user)
+
+    states = {}
+    for name, key in zip(names, keys):
+        flagged_content = flagged_contents.get(key)
+        if flagged_content is None:
+            states[name] = {
+                'count': 0,
+                'status': None,
+                'can_flag': can_flag and
+                    FlaggedContent.objects.model_can_be_flagged(key[0]),
+            }
+        else:
+            states[name] = {
+                'count': flagged_content.count,
+                'status': flagged_content.status,
+                'can_flag': can_flag and
+                    FlaggedContent.objects.model_can_be_flagged(key[0]) and
+                    flagged_content.can_be_flagged_by_user(user),
+            }
+
+    response = FlagJsonResponse({'states': states})
+    response['ETag'] = quote_etag(etag)
+    return response
+
+
 @login_required
 def confirm(request, app_label, object_name, object_id, form=None):
     """
@@ -236,6 +472,15 @@ def confirm(request, app_label, object_name, object_id, form=None):
     The template rendered is flag/confirm.html but it can be overrided for
     each model by defining a template flag/confirm_applabel_modelname.html
     """
+    # don't display the form to the users flagging too fast (already checked
+    # if called by the `flag` view)
+    if form is None:
+        try:
+            check_rate(request.user, '%s.%s' % (app_label, object_name),
+                       consume=False)
+        except FlagRateLimitExceeded, e:
+            return FlagRateLimited(request, e)
+
     content_object = get_content_object('%s.%s' % (app_label, object_name),
                                         object_id)
     if (isinstance(content_object, HttpResponseBadRequest)):
@@ -22,3 +22,98 @@ alter table flag_flaginstance drop when_recalled;
 -- add a status field
 alter table flag_flaginstance add status smallint CHECK (status >= 0) default 1 not null;
 
+
+----------------
+-- 0.4 => 0.5 --
+----------------
+
+-- flag_userflagcount
+
+-- number of flags by user on each flagged content
+create table flag_userflagcount (
+    id serial not null primary key,
+    flagged_content_id integer not null references flag_flaggedcontent (id) deferrable initially deferred,
+    user_id integer not null references auth_user (id) deferrable initially deferred,
+    count integer CHECK (count >= 0) not null,
+    unique (flagged_content_id, user_id)
+);
+create index flag_userflagcount_user_id on flag_userflagcount (user_id);
+-- then fill it with: ./manage.py flag_rebuild_user_counts
+
+-- indexes (also created by syncdb, from the files in flag/sql/)
+
+create index flag_fi_fc_user_status on flag_flaginstance (flagged_content_id, user_id, status);
+create index flag_fi_fc_when_added on flag_flaginstance (flagged_content_id, when_added);
+create index flag_fi_counted_fc_user on flag_flaginstance (flagged_content_id, user_id) where status = 1;
+create index flag_fc_status_id on flag_flaggedcontent (status, id);
+create index flag_fc_ct_status_id on flag_flaggedcontent (content_type_id, status, id);
+create index flag_fc_status_updated_id on flag_flaggedcontent (status, when_updated, id);
+create index flag_fc_ct_status_updated_id on flag_flaggedcontent (content_type_id, status, when_updated, id);
+create index flag_fc_creator_status_updated_id on flag_flaggedcontent (creator_id, status, when_updated, id);
+create index flag_fc_open_ct_updated on flag_flaggedcontent (content_type_id, when_updated) where status = 1;
+
+-- flag_flagmail
+
+-- outbox of the alert mails (see the FLAG_SEND_MAILS_QUEUED settings)
+create table flag_flagmail (
+    id serial not null primary key,
+    flag_instance_id integer not null references flag_flaginstance (id) deferrable initially deferred,
+    count integer CHECK (count >= 0) not null,
+    recipient varchar(75),
+    when_added timestamp with time zone not null,
+    next_try timestamp with time zone not null,
+    tries smallint CHECK (tries >= 0) not null,
+    last_error text,
+    failed boolean not null
+);
+create index flag_flagmail_flag_instance_id on flag_flagmail (flag_instance_id);
+create index flag_fm_failed_next_try on flag_flagmail (failed, next_try);
+create index flag_fm_recipient_next_try on flag_flagmail (recipient, next_try);
+
+-- flag_flagmailrecipient
+
+-- date of the last digest sent to each recipient
+create table flag_flagmailrecipient (
+    id serial not null primary key,
+    email varchar(75) not null unique,
+    last_digest timestamp with time zone not null
+);
+
+-- flag_flaginstancearchive
+
+-- flags moved by the retention (see the FLAG_RETENTION_DAYS settings)
+create table flag_flaginstancearchive (
+    id integer CHECK (id >= 0) not null primary key,
+    flagged_content_id integer not null references flag_flaggedcontent (id) deferrable initially deferred,
+    user_id integer not null references auth_user (id) deferrable initially deferred,
+    when_added timestamp with time zone not null,
+    comment text,
+    status smallint CHECK (status >= 0) not null,
+    when_archived timestamp with time zone not null
+);
+create index flag_flaginstancearchive_flagged_content_id on flag_flaginstancearchive (flagged_content_id);
+create index flag_flaginstancearchive_user_id on flag_flaginstancearchive (user_id);
+
+-- flag_flaginstanceaggregate
+
+-- number of flags by day and status, compacted by the retention
+create table flag_flaginstanceaggregate (
+    id serial not null primary key,
+    flagged_content_id integer not null references flag_flaggedcontent (id) deferrable initially deferred,
+    day date not null,
+    status smallint CHECK (status >= 0) not null,
+    count integer CHECK (count >= 0) not null,
+    unique (flagged_content_id, day, status)
+);
+create index flag_flaginstanceaggregate_flagged_content_id on flag_flaginstanceaggregate (flagged_content_id);
+
+-- flag_flaggedcontent
+
+-- priority of the flagged contents (log of the decayed sum of the weights of
+-- their flags, see FlaggedContent.get_priority)
+alter table flag_flaggedcontent add priority double precision not null default 0;
+-- approximation from the count and the date of the last flag, for the
+-- default FLAG_PRIORITY_HALF_LIFE (86400) and FLAG_PRIORITY_WEIGHT (1)
+update flag_flaggedcontent set priority = ln(count) + ln(2) * extract(epoch from (when_updated - timestamp '2000-01-01')) / 86400 where count > 0;
+create index flag_fc_status_priority_id on flag_flaggedcontent (status, priority, id);
+create index flag_fc_ct_status_priority_id on flag_flaggedcontent (content_type_id, status, priority, id);